@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""
+Batch processing of many input files with process_hits_v2.py on any number of hosts
+
+The input files are split into work units stored as JSON files in a queue directory
+shared by all hosts. Any number of workers claim units by atomically moving them from
+todo/ to claimed/, run process_hits_v2.py on them in a separate output directory and
+move them to done/ or failed/. The results of all units are then merged in unit order.
+
+  ./batch_hits.py submit QUEUE -n 10 <input files> -- -tra --no_plots
+  ./batch_hits.py work QUEUE              [on every host, as many times as needed]
+  ./batch_hits.py status QUEUE
+  ./batch_hits.py requeue QUEUE           [moves failed units back to todo/]
+  ./batch_hits.py merge QUEUE OUTPUT_DIR
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import argparse
+import subprocess
+import pandas as pd
+
+from modules.analysis.monitoring import Monitor
+from process_hits_v2 import build_parser
+
+QUEUE_STATES = ['todo', 'claimed', 'done', 'failed']
+PROCESS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'process_hits_v2.py')
+
+
+def queue_dirs(queue):
+    """Paths of the state directories and of the unit outputs"""
+    dirs = dict([(state, os.path.join(queue, state)) for state in QUEUE_STATES])
+    dirs['units'] = os.path.join(queue, 'units')
+    return dirs
+
+
+def unit_files(queue, state):
+    """Sorted names of the unit files in a state directory"""
+    return sorted(os.path.basename(path) for path in glob.glob(os.path.join(queue, state, 'unit_*.json')))
+
+
+def unit_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def submit(queue, inputs, files_per_unit, options):
+    """Splits input files into work units and puts them into the queue"""
+    dirs = queue_dirs(queue)
+    for path in dirs.values():
+        if not os.path.exists(path):
+            os.makedirs(path)
+    existing = sum(len(unit_files(queue, state)) for state in QUEUE_STATES)
+    if existing:
+        print('WARNING: Queue {0:s} already contains {1:d} units'.format(queue, existing))
+        print('         New units are numbered after them')
+    inputs = [os.path.abspath(os.path.expandvars(path)) for path in inputs]
+    for path in inputs:
+        if not os.path.exists(path):
+            print('--- ERROR ---')
+            print('file not found: {0:s}'.format(path))
+            sys.exit(1)
+    n_units = 0
+    for start in range(0, len(inputs), files_per_unit):
+        unit = {
+            'id': existing + n_units,
+            'inputs': inputs[start:start + files_per_unit],
+            'options': options,
+        }
+        name = 'unit_{0:06d}.json'.format(unit['id'])
+        # Writing to a temporary name first so that workers never see a partial file
+        tmp_path = os.path.join(queue, '.' + name)
+        with open(tmp_path, 'w') as outfile:
+            json.dump(unit, outfile, indent=1)
+        os.rename(tmp_path, os.path.join(dirs['todo'], name))
+        n_units += 1
+    print('### Submitted {0:d} units with {1:d} input files to {2:s}'.format(n_units, len(inputs), queue))
+
+
+def claim(queue):
+    """Claims the first available unit, returns its name or None if the queue is empty"""
+    dirs = queue_dirs(queue)
+    for name in unit_files(queue, 'todo'):
+        try:
+            # Rename is atomic: only one worker can succeed
+            os.rename(os.path.join(dirs['todo'], name), os.path.join(dirs['claimed'], name))
+        except OSError:
+            continue
+        return name
+    return None
+
+
+def run_unit(queue, name):
+    """Runs process_hits_v2.py on the input files of a unit in its own output directory"""
+    dirs = queue_dirs(queue)
+    with open(os.path.join(dirs['claimed'], name)) as infile:
+        unit = json.load(infile)
+    out_dir = os.path.join(dirs['units'], unit_name(name))
+    if not os.path.exists(os.path.join(out_dir, 'plots')):
+        os.makedirs(os.path.join(out_dir, 'plots'))
+    with open(os.path.join(out_dir, 'worker.json'), 'w') as outfile:
+        json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'start': time.time()}, outfile)
+    # All outputs of a unit are produced as a single group, with the event table and counters for merging
+    cmd = [sys.executable, PROCESS_SCRIPT] + unit['options'] + ['--summary', '-g', str(len(unit['inputs']))] + unit['inputs']
+    with open(os.path.join(out_dir, 'log.txt'), 'w') as log:
+        status = subprocess.call(cmd, cwd=out_dir, stdout=log, stderr=subprocess.STDOUT)
+    # The output of process_hits_v2.py is only complete if the counters were written at the end
+    if status == 0 and not glob.glob(os.path.join(out_dir, 'text', '*', '*_summary.json')):
+        status = -1
+    state = 'done' if status == 0 else 'failed'
+    os.rename(os.path.join(dirs['claimed'], name), os.path.join(dirs[state], name))
+    return status
+
+
+def work(queue, max_units=None):
+    """Processes units from the queue until it is empty"""
+    n_done = 0
+    while max_units is None or n_done < max_units:
+        name = claim(queue)
+        if name is None:
+            break
+        print('### Processing {0:s}'.format(name))
+        status = run_unit(queue, name)
+        if status != 0:
+            print('WARNING: Processing of {0:s} failed with status {1:d}'.format(name, status))
+            print('         See {0:s}'.format(os.path.join(queue_dirs(queue)['units'], unit_name(name), 'log.txt')))
+        n_done += 1
+    print('### Processed {0:d} units'.format(n_done))
+
+
+def status(queue):
+    for state in QUEUE_STATES:
+        print('{0:8s} {1:d}'.format(state, len(unit_files(queue, state))))
+
+
+def requeue(queue, claimed=False):
+    """Moves failed units, and optionally claimed ones of dead workers, back to todo/"""
+    dirs = queue_dirs(queue)
+    states = ['failed', 'claimed'] if claimed else ['failed']
+    n_units = 0
+    for state in states:
+        for name in unit_files(queue, state):
+            os.rename(os.path.join(dirs[state], name), os.path.join(dirs['todo'], name))
+            n_units += 1
+    print('### Moved {0:d} units back to the queue'.format(n_units))
+
+
+### Outputs of a unit that are not merged, left in the directory of the unit
+UNMERGED_OUTPUTS = ['_quicklook.json', '_calibration.json', '_profile.json', '_plots.csv']
+
+
+def unit_outputs(queue, name):
+    """Output files of a processed unit: text, event table, counters, histograms, tracks and cut flow"""
+    out_dir = os.path.join(queue_dirs(queue)['units'], unit_name(name))
+    summary = glob.glob(os.path.join(out_dir, 'text', '*', '*_summary.json'))[0]
+    base = summary[:-len('_summary.json')]
+    return {
+        'text': base + '.txt',
+        'events': base + '_events.csv',
+        'summary': summary,
+        'dqm': base + '_dqm.npz',
+        'tracks': base + '_tracks.csv',
+        'cutflow': base + '_cutflow.csv',
+        'unmerged': [base + suffix for suffix in UNMERGED_OUTPUTS if os.path.exists(base + suffix)],
+    }
+
+
+def trigger_mode(queue, name):
+    """Whether a unit was processed with the external trigger [-e], its event numbers being those of the hardware"""
+    with open(os.path.join(queue_dirs(queue)['done'], name)) as infile:
+        unit = json.load(infile)
+    return build_parser().parse_args(unit['options'] + unit['inputs']).event
+
+
+def merge(queue, output_dir):
+    """Merges the outputs of all processed units in the order of units
+
+    Without the external trigger, event numbers are counted separately in each unit, so they
+    are shifted to follow the last event of the previous unit in the text output, the event table
+    and the tracks table. Event numbers of the trigger [-e] are kept as they are. The tables get
+    a UNIT column with the unit each row comes from, and the cut flows are added up.
+    """
+    names = unit_files(queue, 'done')
+    pending = sum(len(unit_files(queue, state)) for state in ['todo', 'claimed', 'failed'])
+    if pending:
+        print('WARNING: {0:d} units are not processed yet, merging only {1:d} done units'.format(pending, len(names)))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    totals = {}
+    tables = []
+    tracks = []
+    cutflow = None
+    unmerged = []
+    monitor = Monitor(binning={})
+    offset = 0
+    with open(os.path.join(output_dir, 'merged.txt'), 'w') as outfile:
+        for name in names:
+            outputs = unit_outputs(queue, name)
+            if trigger_mode(queue, name):
+                offset = 0
+            n_max = -1
+            if os.path.exists(outputs['text']):
+                with open(outputs['text']) as infile:
+                    for line in infile:
+                        event, rest = line.split(' ', 1)
+                        n_max = max(n_max, int(event))
+                        outfile.write('{0:d} {1:s}'.format(int(event) + offset, rest))
+            df = pd.read_csv(outputs['events'])
+            if len(df):
+                n_max = max(n_max, int(df['EVENT_NR'].max()))
+                df['EVENT_NR'] += offset
+            df.insert(0, 'UNIT', unit_name(name))
+            tables.append(df)
+            if os.path.exists(outputs['tracks']):
+                df = pd.read_csv(outputs['tracks'])
+                df['EVENT_NR'] += offset
+                df.insert(0, 'UNIT', unit_name(name))
+                tracks.append(df)
+            if os.path.exists(outputs['cutflow']):
+                df = pd.read_csv(outputs['cutflow'], index_col='cut')
+                cutflow = df if cutflow is None else cutflow.add(df, fill_value=0).reindex(list(cutflow.index) + [cut for cut in df.index if cut not in cutflow.index])
+            unmerged.extend(outputs['unmerged'])
+            with open(outputs['summary']) as infile:
+                summary = json.load(infile)
+            for key, value in summary.items():
+                if key == 'inputs':
+                    totals.setdefault(key, []).extend(value)
+                else:
+                    totals[key] = totals.get(key, 0) + value
+            if os.path.exists(outputs['dqm']):
+                monitor.merge(Monitor.load(outputs['dqm']))
+            offset += n_max + 1
+    if tables:
+        pd.concat(tables, ignore_index=True).to_csv(os.path.join(output_dir, 'merged_events.csv'), index=False)
+    # Rows of the merged tracks table follow the lines of merged.txt, so query.py can serve them
+    if tracks:
+        pd.concat(tracks, ignore_index=True).to_csv(os.path.join(output_dir, 'merged_tracks.csv'), index=False, float_format='%.6g')
+    if cutflow is not None:
+        cutflow.astype(int).to_csv(os.path.join(output_dir, 'merged_cutflow.csv'))
+    totals['units'] = len(names)
+    with open(os.path.join(output_dir, 'merged_summary.json'), 'w') as outfile:
+        json.dump(totals, outfile, indent=1, sort_keys=True)
+    monitor.save(os.path.join(output_dir, 'merged_dqm.npz'))
+    print('### Merged {0:d} units with {1:d} events into {2:s}'.format(len(names), totals.get('events', 0), output_dir))
+    if unmerged:
+        print('WARNING: {0:d} outputs of the units are not merged, they are only in the directories of the units:'.format(len(unmerged)))
+        for path in unmerged:
+            print('         {0:s}'.format(path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batch processing of input files with process_hits_v2.py through a shared queue directory')
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser('submit', help='Split input files into work units')
+    p.add_argument('queue', help='Queue directory shared by all workers')
+    p.add_argument('-n', '--files', metavar='N', type=int, default=1, help='Number of input files per unit [default: 1]')
+    p.add_argument('inputs', metavar='FILE', nargs='+', help='Input files, followed by -- and the options of process_hits_v2.py')
+    p = subparsers.add_parser('work', help='Process units until the queue is empty')
+    p.add_argument('queue', help='Queue directory shared by all workers')
+    p.add_argument('-m', '--max_units', metavar='N', type=int, default=None, help='Maximum number of units to process')
+    p = subparsers.add_parser('status', help='Print numbers of units in each state')
+    p.add_argument('queue', help='Queue directory shared by all workers')
+    p = subparsers.add_parser('requeue', help='Move failed units back to the queue')
+    p.add_argument('queue', help='Queue directory shared by all workers')
+    p.add_argument('--claimed', action='store_true', default=False, help='Also move claimed units [only if their workers are dead]')
+    p = subparsers.add_parser('merge', help='Merge outputs of all processed units')
+    p.add_argument('queue', help='Queue directory shared by all workers')
+    p.add_argument('output', help='Output directory of the merged results')
+
+    # Options after -- are passed to process_hits_v2.py unchanged
+    argv = sys.argv[1:]
+    options = []
+    if '--' in argv:
+        options = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+
+    if args.command == 'submit':
+        submit(args.queue, args.inputs, args.files, options)
+    elif args.command == 'work':
+        work(args.queue, args.max_units)
+    elif args.command == 'status':
+        status(args.queue)
+    elif args.command == 'requeue':
+        requeue(args.queue, args.claimed)
+    elif args.command == 'merge':
+        merge(args.queue, args.output)
+    else:
+        parser.print_help()
@@ -0,0 +1,80 @@
+"""Per-event compute budget: work exceeding it falls back to cheaper approximations, with the event flagged"""
+
+import time
+import threading
+import contextlib
+
+### Flags of the approximations used for an event, combined as bits
+MEANTIMER_REDUCED = 1                # meantimer run only on the first hit of each channel
+SEGMENTS_HOUGH = 2                   # local segments found by the Hough transform instead of all combinations
+BUDGET_FLAGS = {MEANTIMER_REDUCED: 'meantimer on first hits', SEGMENTS_HOUGH: 'Hough segments'}
+
+
+class EventWork(object):
+    """Approximations used while processing one event"""
+
+    def __init__(self):
+        self.flags = 0
+        self.start = time.perf_counter()
+
+    def elapsed(self):
+        """Time spent on the event so far [us]"""
+        return (time.perf_counter() - self.start)*1e6
+
+
+class ComputeBudget(object):
+    """Maximum number of combinations tried for one chamber of an event and time spent on an event [us], None for no limit
+
+    The stages wrap each event in event(), and the combinatorial steps ask exceeded() before
+    looping over their combinations: over the budget, the flag of the cheaper approximation
+    they use instead is set on the event being processed in the current thread. The time is
+    checked at the same points, so the steps still to run on a slow event are approximated.
+    """
+
+    def __init__(self, combinations=None, microseconds=None):
+        self.combinations = combinations
+        self.microseconds = microseconds
+        # Event being processed by each thread
+        self.current = threading.local()
+
+    @property
+    def limited(self):
+        return self.combinations is not None or self.microseconds is not None
+
+    def __str__(self):
+        limits = []
+        if self.combinations is not None:
+            limits.append('{0:d} combinations'.format(self.combinations))
+        if self.microseconds is not None:
+            limits.append('{0:g} us'.format(self.microseconds))
+        return ' or '.join(limits) if limits else 'no limit'
+
+    def event(self):
+        """Context collecting the flags of one event"""
+        if not self.limited:
+            return contextlib.nullcontext(EventWork())
+        return self._event()
+
+    @contextlib.contextmanager
+    def _event(self):
+        previous = getattr(self.current, 'work', None)
+        self.current.work = EventWork()
+        try:
+            yield self.current.work
+        finally:
+            self.current.work = previous
+
+    def exceeded(self, combinations, flag):
+        """Whether a number of combinations or the time spent on the current event is over the budget, flagging the event if it is"""
+        work = getattr(self.current, 'work', None)
+        over = self.combinations is not None and combinations > self.combinations
+        if not over and self.microseconds is not None and work is not None:
+            over = work.elapsed() > self.microseconds
+        if over and work is not None:
+            work.flags |= flag
+        return over
+
+
+def describe(flags):
+    """Names of the approximations in a combination of flags"""
+    return ', '.join([name for flag, name in sorted(BUDGET_FLAGS.items()) if flags & flag])
@@ -0,0 +1,80 @@
+"""Detection of noisy and dead channels from their hit rates, with masks of them applied when reading the input"""
+
+import numpy as np
+import pandas as pd
+
+from modules.analysis.config import NCHANNELS, DURATION, NOISY_RATE_FACTOR, DEAD_RATE_FACTOR, BURST_WINDOW, NOISY_BURST_FRACTION
+from modules.analysis.geometry import GEOMETRY, N_TDC_CHANNEL
+
+### Columns of the channel table saved as a mask file
+CHANNEL_COLUMNS = ['FPGA', 'TDC_CHANNEL', 'SL', 'TDC_CHANNEL_NORM', 'HITS', 'RATE', 'BURST_FRACTION', 'STATUS']
+
+
+def physical_channels():
+    """Flat positions in the geometry tables of all channels with a wire"""
+    channel_norm = GEOMETRY.channel_norm.ravel()
+    return np.flatnonzero((GEOMETRY.sl.ravel() >= 0) & (channel_norm >= 1) & (channel_norm <= NCHANNELS))
+
+
+def channel_table(fpga, channels, orbits, times, burst_window=BURST_WINDOW):
+    """Hits, rate [Hz] and fraction of hits in bursts of every physical channel, from the hits of a run
+
+    A hit is part of a burst if it follows the previous hit in the same channel by less than
+    `burst_window` ns. The rate is averaged over the orbits between the first and the last hit.
+    """
+    positions = physical_channels()
+    keys = GEOMETRY.index(fpga, channels)
+    times = np.asarray(times, dtype=np.float64)
+    sel = np.isin(keys, positions)
+    keys, times = keys[sel], times[sel]
+    # Time-ordered hits of each channel with a single sort
+    order = np.lexsort((times, keys))
+    keys, times = keys[order], times[order]
+    burst = np.r_[False, (keys[1:] == keys[:-1]) & (np.diff(times) < burst_window)] if len(keys) else np.zeros(0, dtype=bool)
+    size = N_TDC_CHANNEL * (int(positions.max()) // N_TDC_CHANNEL + 1)
+    hits = np.bincount(keys, minlength=size)[positions]
+    bursts = np.bincount(keys[burst], minlength=size)[positions]
+    duration = (float(np.max(orbits)) - float(np.min(orbits)) + 1) * DURATION['orbit'] * 1e-9 if len(orbits) else np.inf
+    return pd.DataFrame({
+        'FPGA': positions // N_TDC_CHANNEL,
+        'TDC_CHANNEL': positions % N_TDC_CHANNEL,
+        'SL': GEOMETRY.lookup('sl', positions),
+        'TDC_CHANNEL_NORM': GEOMETRY.lookup('channel_norm', positions),
+        'HITS': hits,
+        'RATE': hits / duration,
+        'BURST_FRACTION': np.where(hits > 0, bursts / np.maximum(hits, 1), 0.),
+    })
+
+
+def flag_channels(table, noisy_factor=NOISY_RATE_FACTOR, dead_factor=DEAD_RATE_FACTOR, burst_fraction=NOISY_BURST_FRACTION):
+    """Sets the STATUS of every channel of the table to noisy, dead or ok
+
+    Rates are compared to the median rate of the channels with hits in the same SL,
+    so a few hot channels don't shift the reference and SLs with different rates are fine.
+    """
+    median = table[table['HITS'] > 0].groupby('SL')['RATE'].median()
+    reference = table['SL'].map(median).fillna(0.).values
+    rate = table['RATE'].values
+    noisy = (rate > noisy_factor * reference) | (table['BURST_FRACTION'].values > burst_fraction)
+    dead = rate < dead_factor * reference
+    # A whole SL without hits is reported as dead as well
+    dead |= reference == 0
+    table['STATUS'] = np.where(noisy, 'noisy', np.where(dead, 'dead', 'ok'))
+    return table
+
+
+def save_mask(table, path):
+    """Writes the channel table with the status of every channel into a CSV file"""
+    table[CHANNEL_COLUMNS].to_csv(path, index=False, float_format='%.6g')
+
+
+def load_mask(path):
+    """Flat positions in the geometry tables of the channels not flagged as ok in a mask file"""
+    table = pd.read_csv(path)
+    table = table[table['STATUS'] != 'ok']
+    return np.unique(GEOMETRY.index(table['FPGA'].values, table['TDC_CHANNEL'].values))
+
+
+def masked(fpga, channels, mask):
+    """Whether each hit is in one of the masked channels"""
+    return np.isin(GEOMETRY.index(fpga, channels), mask)
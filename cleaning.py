@@ -0,0 +1,53 @@
+"""Cleaning of repeated hits in the same channel: duplicates within the dead time and afterpulses"""
+
+import numpy as np
+
+from modules.analysis.config import NCHANNELS, HIT_DEAD_TIME, AFTERPULSE_WINDOW
+
+
+def repeated_hits(sl, channels, times, dead_time=HIT_DEAD_TIME, afterpulse_window=AFTERPULSE_WINDOW, remove_afterpulses=False):
+    """Flags repeated hits of each physical channel with a single sort over (SL, channel, time)
+
+    A hit following the last kept hit in the same channel by less than `dead_time` ns is a duplicate,
+    by less than `afterpulse_window` ns an afterpulse. Duplicates are never kept, afterpulses only
+    if they are not removed. Returns both flags in the input order.
+    """
+    sl = np.asarray(sl, dtype=np.int64)
+    channels = np.asarray(channels, dtype=np.int64)
+    times = np.asarray(times, dtype=np.float64)
+    duplicate = np.zeros(len(times), dtype=bool)
+    afterpulse = np.zeros(len(times), dtype=bool)
+    # Only physical channels can have afterpulses, trigger and event-number hits are kept as they are
+    idx = np.flatnonzero((sl >= 0) & (channels >= 1) & (channels <= NCHANNELS))
+    if len(idx) < 2:
+        return duplicate, afterpulse
+    idx = idx[np.lexsort((times[idx], channels[idx], sl[idx]))]
+    same = (sl[idx[1:]] == sl[idx[:-1]]) & (channels[idx[1:]] == channels[idx[:-1]])
+    t = times[idx]
+    # Hits further than the window from the previous hit are further from the last kept one too:
+    # only the few closer ones are checked one by one, against the time of the last kept hit
+    kept_time = t.copy()
+    for k in np.flatnonzero(same & (np.diff(t) < afterpulse_window)) + 1:
+        dt = t[k] - kept_time[k - 1]
+        if dt < dead_time:
+            duplicate[idx[k]] = True
+        elif dt < afterpulse_window:
+            afterpulse[idx[k]] = True
+        if duplicate[idx[k]] or (afterpulse[idx[k]] and remove_afterpulses):
+            kept_time[k] = kept_time[k - 1]
+    return duplicate, afterpulse
+
+
+def clean_hits(hits, remove_afterpulses=False):
+    """Removes duplicate hits from the dataframe and tags afterpulses in the AFTERPULSE column
+
+    Afterpulses are removed as well if requested. Returns the mask of kept rows
+    in the original order and the numbers of duplicates and afterpulses found.
+    """
+    duplicate, afterpulse = repeated_hits(hits['SL'].values, hits['TDC_CHANNEL_NORM'].values, hits['TIME_ABS'].values,
+                                          remove_afterpulses=remove_afterpulses)
+    hits['AFTERPULSE'] = afterpulse
+    keep = ~(duplicate | afterpulse) if remove_afterpulses else ~duplicate
+    if not keep.all():
+        hits.drop(hits.index[~keep], inplace=True)
+    return keep, int(duplicate.sum()), int(afterpulse.sum())
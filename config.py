@@ -24,11 +24,29 @@ VDRIFT    = XCELL*0.5 / TDRIFT     # drift velocity in mm/ns
 TRIGGER_TIME_ARRAY = np.array([DURATION['orbit'], DURATION['bx'], DURATION['tdc']])
 ### Minimum time [bx] between groups of hits with EVENT_NR to be considered as belonging to separate events
 EVENT_TIME_GAP = 1000/DURATION['bx']
+### Maximum time [ns] by which hits inside one input file can be out of order (reorder buffer of the event building)
+STREAM_REORDER_WINDOW = DURATION['orbit']
 ### Criteria for input hits for meantimer
 NHITS_SL = (1, 10)  # (min, max) number of hits in a superlayer to be considered in the event
 MEANTIMER_ANGLES = [(-0.2, 0.1), (-0.2, 0.1), (-0.1, 0.2), (-0.1, 0.2)]
 MEANTIMER_CLUSTER_SIZE = 2  # minimum number of meantimer solutions in a cluster to calculate mean t0
 MEANTIMER_SL_MULT_MIN = 2  # minimum number of different SLs in a cluster of meantimer solutions
+### Repeated hits in the same channel [ns after the previous hit in the channel]
+HIT_DEAD_TIME = DURATION['bx']       # closer hits are duplicates of the previous one
+AFTERPULSE_WINDOW = TDRIFT           # closer hits are afterpulses of the previous one
+### Quick look [--prescale]: orbits are sampled in blocks of this size, spread over the whole run
+QUICKLOOK_BLOCK_ORBITS = 1000
+### Number of events evaluated together by each cut of a selection
+CUTFLOW_BATCH_EVENTS = 100000
+### Noisy and dead channels [--find_channels]: rates compared to the median rate of the channels in the same SL
+NOISY_RATE_FACTOR = 10.              # noisy above this many times the median rate
+DEAD_RATE_FACTOR = 0.05              # dead below this fraction of the median rate
+BURST_WINDOW = TDRIFT                # hits closer than this [ns] to the previous hit in the channel are part of a burst
+NOISY_BURST_FRACTION = 0.5           # noisy if a larger fraction of the hits are part of bursts
+### Trigger t0 calibration [--calibrate_tzero]: TIME0 - meantimer t0 fitted against the trigger time differences
+CALIBRATION_MIN_EVENTS = 10          # minimum number of events with a meantimer t0 for a fit
+CALIBRATION_CLIP = 3.                # events further than this many robust standard deviations from the fit are rejected
+CALIBRATION_ITERATIONS = 10          # maximum number of fits rejecting outliers
 
 
 # Parameters of the DAQ signals [must be optimised according to the exact setup performance]
@@ -0,0 +1,119 @@
+"""Declarative event selection: cuts evaluated cheapest first over batches of events, with a cut-flow table"""
+
+import numpy as np
+
+from modules.analysis.config import CUTFLOW_BATCH_EVENTS
+
+### Relative costs of the cuts: vectorised over all events of a batch, or looping over single events
+COST_VECTORISED = 1.
+COST_PER_EVENT = 1000.
+
+
+class Cut(object):
+    """Test of a batch of events from the quantities it needs, returning whether each event passes"""
+
+    def __init__(self, name, test, needs=(), cost=COST_VECTORISED):
+        self.name = name
+        self.test = test
+        self.needs = list(needs)
+        self.cost = float(cost)
+
+
+class Selection(object):
+    """Cuts declared with their cost and the per-event quantities they need
+
+    Quantities are functions of an array of event indices returning one value [row] per event.
+    Cuts are evaluated in order of increasing cost, in the order of declaration for equal costs,
+    on batches of events. Each cut only sees the events that passed the previous ones, and each
+    quantity is computed once per batch, for the events left when the first cut needing it runs:
+    events rejected by cheap cuts never reach the expensive quantities.
+    """
+
+    def __init__(self, batch_size=CUTFLOW_BATCH_EVENTS):
+        self.batch_size = int(batch_size)
+        self.quantities = {}
+        self.cuts = []
+
+    def quantity(self, name, func):
+        self.quantities[name] = func
+
+    def cut(self, name, test, needs=(), cost=COST_VECTORISED):
+        for need in needs:
+            if need not in self.quantities:
+                raise KeyError('Quantity {0:s} needed by cut {1:s} is not declared'.format(need, name))
+        self.cuts.append(Cut(name, test, needs, cost))
+
+    def ordered(self):
+        """Cuts in the order of evaluation"""
+        return sorted(self.cuts, key=lambda cut: cut.cost)
+
+    def apply(self, idx, cutflow=None):
+        """Indices of the events passing all cuts, adding the events entering and passing each cut to cutflow"""
+        idx = np.asarray(idx, dtype=np.int64)
+        cuts = self.ordered()
+        if cutflow is not None:
+            cutflow.declare([cut.name for cut in cuts])
+        passed = [np.zeros(0, dtype=np.int64)]
+        for first in range(0, len(idx), self.batch_size):
+            batch = idx[first:first + self.batch_size]
+            # Positions of the remaining events in the batch, and the values of quantities computed so far
+            pos = np.arange(len(batch))
+            cache = {}
+            for cut in cuts:
+                if len(pos) == 0:
+                    ok = np.zeros(0, dtype=bool)
+                else:
+                    values = [self.values(name, batch, pos, cache) for name in cut.needs]
+                    ok = np.asarray(cut.test(*values), dtype=bool)
+                if cutflow is not None:
+                    cutflow.count(cut.name, len(pos), int(ok.sum()))
+                pos = pos[ok]
+            passed.append(batch[pos])
+        return np.concatenate(passed)
+
+    def values(self, name, batch, pos, cache):
+        """Values of a quantity for the remaining events of a batch, computed the first time they are needed"""
+        if name not in cache:
+            cache[name] = (pos, np.asarray(self.quantities[name](batch[pos])))
+        computed, values = cache[name]
+        if len(computed) == len(pos):
+            return values
+        return values[np.searchsorted(computed, pos)]
+
+
+class CutFlow(object):
+    """Numbers of events entering and passing each cut, in the order of evaluation"""
+
+    def __init__(self):
+        self.names = []
+        self.entered = {}
+        self.passed = {}
+
+    def declare(self, names):
+        for name in names:
+            if name not in self.entered:
+                self.names.append(name)
+                self.entered[name] = 0
+                self.passed[name] = 0
+
+    def count(self, name, entered, passed):
+        self.declare([name])
+        self.entered[name] += int(entered)
+        self.passed[name] += int(passed)
+
+    def table(self):
+        """List of (cut, events entering, events passing)"""
+        return [(name, self.entered[name], self.passed[name]) for name in self.names]
+
+    def report(self):
+        """Prints the events surviving each cut"""
+        print('### Cut flow: events entering and passing each cut')
+        for name, entered, passed in self.table():
+            print('    {0:<20s} {1:10d} {2:10d}   {3:7.2%}'.format(name, entered, passed, passed / entered if entered else 0.))
+
+    def save(self, path):
+        """Writes the cut-flow table into a CSV file"""
+        with open(path, 'w') as outfile:
+            outfile.write('cut,entered,passed\n')
+            for row in self.table():
+                outfile.write('{0:s},{1:d},{2:d}\n'.format(*row))
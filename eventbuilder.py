@@ -0,0 +1,123 @@
+"""Event building for trigger-less runs by merging time-ordered streams of hits"""
+
+import numpy as np
+
+from modules.analysis.config import STREAM_REORDER_WINDOW
+
+
+class StreamMerger(object):
+    """K-way merge of time-ordered hit streams with on-the-fly grouping of hits into events
+
+    Hits of each stream may arrive out of order by up to `window` ns. They are kept in a small
+    reorder buffer until no stream can deliver an earlier hit anymore, then released in time order
+    and grouped into events: a new event starts after a time gap larger than `gap` ns.
+    """
+
+    def __init__(self, n_streams, gap, window=STREAM_REORDER_WINDOW):
+        self.gap = gap
+        self.window = window
+        self.pending_idx = [np.empty(0, dtype=np.int64) for _ in range(n_streams)]
+        self.pending_time = [np.empty(0, dtype=np.float64) for _ in range(n_streams)]
+        self.time_max = np.full(n_streams, -np.inf)
+        self.closed = np.zeros(n_streams, dtype=bool)
+        # Hits earlier than this time have already been released
+        self.released = -np.inf
+        self.last_time = None
+        self.last_event = -1
+
+    def watermarks(self):
+        """Earliest time each stream can still deliver"""
+        return np.where(self.closed, np.inf, self.time_max - self.window)
+
+    def feed(self, stream, idx, times):
+        """Adds the next block of hits of a stream to the reorder buffer"""
+        if len(times) == 0:
+            return
+        if times.min() < self.released:
+            raise ValueError('hits of stream {0:d} are out of order by more than {1:.0f} ns'.format(stream, self.window))
+        self.pending_idx[stream] = np.concatenate([self.pending_idx[stream], idx])
+        self.pending_time[stream] = np.concatenate([self.pending_time[stream], times])
+        self.time_max[stream] = max(self.time_max[stream], times.max())
+
+    def close(self, stream):
+        """Marks a stream as exhausted"""
+        self.closed[stream] = True
+
+    def pop(self):
+        """Releases buffered hits that can't be preceded by any future hit
+
+        Returns indices of the released hits in time order and their event numbers
+        """
+        limit = self.watermarks().min()
+        idx, times = [], []
+        for stream in range(len(self.pending_idx)):
+            ready = self.pending_time[stream] < limit
+            if not ready.any():
+                continue
+            idx.append(self.pending_idx[stream][ready])
+            times.append(self.pending_time[stream][ready])
+            self.pending_idx[stream] = self.pending_idx[stream][~ready]
+            self.pending_time[stream] = self.pending_time[stream][~ready]
+        self.released = max(self.released, limit)
+        if not idx:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        idx = np.concatenate(idx)
+        times = np.concatenate(times)
+        order = np.argsort(times, kind='stable')
+        idx, times = idx[order], times[order]
+        # Starting a new event at each time gap, continuing the event numbering of the previous release
+        gaps = np.diff(times, prepend=times[0] if self.last_time is None else self.last_time) > self.gap
+        events = self.last_event + np.cumsum(gaps)
+        if self.last_time is None:
+            events += 1
+        self.last_time = times[-1]
+        self.last_event = events[-1]
+        return idx, events
+
+    def advance(self):
+        """Returns the open stream that is lagging behind the most, or None if all are closed"""
+        marks = self.watermarks()
+        if np.isinf(marks).all():
+            return None
+        return int(np.argmin(marks))
+
+
+def build_events(times, offsets, gap, window=STREAM_REORDER_WINDOW, block=65536):
+    """Assigns event numbers to hits stored as consecutive time-ordered streams
+
+    `offsets` lists the first hit of each stream in `times`. Returns the event number of each hit
+    in the input order, without sorting or copying the whole table.
+    """
+    n_hits = len(times)
+    events = np.empty(n_hits, dtype=np.int32)
+    if n_hits == 0:
+        return events
+    bounds = list(offsets) + [n_hits]
+    starts = np.array(bounds[:-1], dtype=np.int64)
+    ends = np.array(bounds[1:], dtype=np.int64)
+    merger = StreamMerger(len(starts), gap, window)
+    try:
+        # Reading the first block of each stream, then always the stream that lags behind
+        pending = list(range(len(starts)))
+        while True:
+            stream = pending.pop() if pending else merger.advance()
+            if stream is None:
+                break
+            end = min(starts[stream] + block, ends[stream])
+            merger.feed(stream, np.arange(starts[stream], end), times[starts[stream]:end])
+            starts[stream] = end
+            if end == ends[stream]:
+                merger.close(stream)
+            if pending:
+                continue
+            idx, evt = merger.pop()
+            events[idx] = evt
+        idx, evt = merger.pop()
+        events[idx] = evt
+    except ValueError as e:
+        print('WARNING: {0:s}'.format(str(e)))
+        print('         Falling back to sorting all hits by time')
+        order = np.argsort(times, kind='stable')
+        gaps = np.diff(times[order], prepend=times[order[:1]]) > gap
+        events[order] = np.cumsum(gaps)
+    return events
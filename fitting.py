@@ -0,0 +1,64 @@
+"""Least-squares line fits of local segments from solvers precomputed for every pattern of hit layers"""
+
+import numpy as np
+
+from modules.analysis.geometry import GEOMETRY
+
+### Maximum difference in mm between a z coordinate and a layer position to use the precomputed solvers
+Z_TOLERANCE = 1e-3
+
+
+def line_solvers(zs):
+    """Pseudo-inverse of the design matrix of x = slope*z + intercept and the projector onto the residuals"""
+    design = np.column_stack([np.asarray(zs, dtype=np.float64), np.ones(len(zs))])
+    pinv = np.linalg.pinv(design)
+    return pinv, np.eye(len(zs)) - design.dot(pinv)
+
+
+class LineFitTable(object):
+    """Solvers of the straight-line fit of points with one hit per layer, for every subset of the layers
+
+    Within a chamber z can only take the values of z_pts, so the design matrix of a fit only depends
+    on which layers contribute. For the layers in bit mask `mask` (bit i for z_pts[i]), the fit of
+    points x measured in those layers in increasing z is (slope, intercept) = pinv[mask].x, and
+    its sum of squared residuals is |proj[mask].x|^2: one small dot product for any number of fits.
+    """
+
+    def __init__(self, z_pts=GEOMETRY.z_pts):
+        self.z_pts = np.sort(np.asarray(z_pts, dtype=np.float64))
+        n = len(self.z_pts)
+        self.pinv = {}
+        self.proj = {}
+        for mask in range(1, 1 << n):
+            self.pinv[mask], self.proj[mask] = line_solvers(self.z_pts[[i for i in range(n) if mask >> i & 1]])
+
+    def mask(self, zs):
+        """Bit mask of the layers at increasing positions zs, None if they are not distinct layer positions"""
+        zs = np.asarray(zs, dtype=np.float64)
+        idx = np.abs(zs[:, np.newaxis] - self.z_pts[np.newaxis, :]).argmin(axis=1)
+        if np.any(np.abs(self.z_pts[idx] - zs) > Z_TOLERANCE) or np.any(np.diff(idx) <= 0):
+            return None
+        return int(np.bitwise_or.reduce(np.left_shift(1, idx)))
+
+    def solvers(self, zs):
+        """Pseudo-inverse and residual projector for points at increasing positions zs"""
+        mask = self.mask(zs)
+        if mask is None:
+            # Positions not matching the layers [e.g. shifted by hand]: solving the fit on the spot
+            return line_solvers(zs)
+        return self.pinv[mask], self.proj[mask]
+
+    def fit(self, zs, xs):
+        """Fits lines to each row of xs measured at positions zs
+
+        Returns arrays of slopes, intercepts and sums of squared residuals, one per row
+        """
+        xs = np.atleast_2d(np.asarray(xs, dtype=np.float64))
+        pinv, proj = self.solvers(zs)
+        coefs = xs.dot(pinv.T)
+        chisq = (xs.dot(proj.T)**2).sum(axis=1)
+        return coefs[:, 0], coefs[:, 1], chisq
+
+
+# Solvers for the layers of the detector geometry, shared by all local reconstructions
+LINE_FITS = LineFitTable()
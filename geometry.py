@@ -0,0 +1,91 @@
+"""Geometry of the detector with per-channel lookup tables built from the configuration"""
+
+import numpy as np
+
+from modules.analysis.config import NCHANNELS, XCELL, ZCELL, Z_SEP, TIME_OFFSET_SL
+
+#    layer #             cell numbering scheme
+#      1         |    1    |    5    |    9    |
+#      2              |    3    |    7    |   11    |
+#      3         |    2    |    6    |   10    |
+#      4              |    4    |    8    |   12    |
+
+### Position of a wire inside its group of 4 channels, indexed by TDC_CHANNEL % 4
+CHANNEL_LAYER      = np.array([4,            1,            3,            2,         ], dtype=np.uint8)
+CHANNEL_X_CHSHIFT  = np.array([-1,           0,            -1,           0,         ], dtype=np.int8)
+CHANNEL_X_POSSHIFT = np.array([0.5,          0,            0,            0.5,       ], dtype=np.float16)
+CHANNEL_Z_POS      = np.array([ZCELL*0.5,    ZCELL*3.5,    ZCELL*1.5,    ZCELL*2.5, ], dtype=np.float16)
+
+### Both FPGA and TDC_CHANNEL are stored as uint8, so a 256x256 table covers every possible hit
+N_FPGA = 256
+N_TDC_CHANNEL = 256
+
+
+class Geometry(object):
+    """Lookup tables of SL, layer, wire position and chamber offsets indexed by (FPGA, TDC_CHANNEL)"""
+
+    def __init__(self, nchannels=NCHANNELS, xcell=XCELL, zcell=ZCELL, z_sep=Z_SEP, time_offset_sl=TIME_OFFSET_SL):
+        self.nchannels = nchannels
+        self.xcell = xcell
+        self.zcell = zcell
+        self.z_sep = z_sep
+        self.ncells = nchannels // 4
+        # Chamber dimensions and z of the bottom of each chamber [SL 0/2 measure x, SL 1/3 measure y]
+        self.width = (self.ncells + 0.5) * xcell
+        self.height = 4 * zcell
+        self.chamber_z = np.array([0., 4*zcell, z_sep, 4*zcell + z_sep])
+        # Wire z position of each layer [index 0 is unused] and the 4 possible z values in a chamber
+        self.layer_z = np.zeros(5, dtype=np.float64)
+        self.layer_z[CHANNEL_LAYER] = CHANNEL_Z_POS
+        self.z_pts = np.sort(self.layer_z[1:])
+        self.layer_bounds = [[i*zcell, (i+1)*zcell] for i in range(4)]
+        # Wires of the staggered layers (2, 4) lie on the cell edges of layers 1, 3 and vice versa
+        self.x_edges = np.arange(self.ncells) * xcell
+        self.x_edges_shifted = self.x_edges + xcell/2
+
+        fpga, channel = np.meshgrid(np.arange(N_FPGA), np.arange(N_TDC_CHANNEL), indexing='ij')
+        # SL <- superlayer = chamber number from 0 to 3 (0,1 FPGA#0 --- 2,3 FPGA#1)
+        conditions_SL = [
+            ((fpga == 0) & (channel <= nchannels)),
+            ((fpga == 0) & (channel > nchannels) & (channel <= 2*nchannels)),
+            ((fpga == 1) & (channel <= nchannels)),
+            ((fpga == 1) & (channel > nchannels) & (channel <= 2*nchannels)),
+        ]
+        self.sl = np.select(conditions_SL, [0, 1, 2, 3], default=-1).astype(np.int8)
+        pos = channel % 4
+        self.layer = CHANNEL_LAYER[pos]
+        self.x_chshift = CHANNEL_X_CHSHIFT[pos]
+        self.x_posshift = CHANNEL_X_POSSHIFT[pos]
+        self.z_pos = CHANNEL_Z_POS[pos]
+        # define channel within SL
+        self.channel_norm = (channel - nchannels * (self.sl % 2)).astype(np.uint8)
+        # Wire position inside the chamber and in the global frame
+        self.wire_x = (np.floor((self.channel_norm - 0.5) / 4) + self.x_posshift) * xcell + xcell/2
+        self.wire_z = self.z_pos.astype(np.float64)
+        self.chamber_offset = np.where(self.sl >= 0, self.chamber_z[self.sl], 0.)
+        self.wire_z_global = self.wire_z + self.chamber_offset
+        # Relative signal offset of each chamber
+        self.time_offset = np.where(self.sl >= 0, np.asarray(time_offset_sl, dtype=np.float64)[self.sl], 0.)
+
+    @staticmethod
+    def index(fpga, channel):
+        """Returns flat positions in the lookup tables for arrays of FPGA and TDC_CHANNEL values"""
+        return np.asarray(fpga, dtype=np.intp) * N_TDC_CHANNEL + np.asarray(channel, dtype=np.intp)
+
+    def lookup(self, name, idx):
+        """Gathers values of the table `name` for the flat positions returned by `index`"""
+        return getattr(self, name).ravel()[idx]
+
+    def assign(self, df):
+        """Adds the per-hit geometry columns to a dataframe of hits and returns the table positions used"""
+        idx = self.index(df['FPGA'].values, df['TDC_CHANNEL'].values)
+        df['LAYER']            = self.lookup('layer', idx)
+        df['X_CHSHIFT']        = self.lookup('x_chshift', idx)
+        df['X_POSSHIFT']       = self.lookup('x_posshift', idx)
+        df['Z_POS']            = self.lookup('z_pos', idx)
+        df['SL']               = self.lookup('sl', idx)
+        df['TDC_CHANNEL_NORM'] = self.lookup('channel_norm', idx)
+        return idx
+
+
+GEOMETRY = Geometry()
@@ -0,0 +1,62 @@
+"""Ragged layout of a table of hits: sorted once by event, SL and layer and addressed by offsets"""
+
+import numpy as np
+
+### Hits with SL outside this range are kept before the SL 0 hits of their event
+N_SL = 4
+
+
+class EventLayout(object):
+    """Column arrays of hits sorted by (event, SL, layer) with the offsets of every event and chamber
+
+    Hits of event i are rows offsets[i]:offsets[i+1] of the sorted columns, those of its SL sl
+    are rows sl_offsets[i, sl]:sl_offsets[i, sl+1]. Slices of the columns are views, so iterating
+    events doesn't create any pandas objects. The sort is stable: hits with the same event, SL
+    and layer keep their order in the input table.
+    """
+
+    def __init__(self, hits, columns=None, event_col='EVENT_NR'):
+        columns = list(hits.columns) if columns is None else columns
+        events = hits[event_col].values
+        sl = hits['SL'].values.astype(np.int64)
+        self.order = np.lexsort((hits['LAYER'].values, sl, events))
+        self.index = hits.index.values[self.order]
+        self.columns = dict([(name, hits[name].values[self.order]) for name in columns])
+        events, sl = events[self.order], sl[self.order]
+        starts = np.flatnonzero(np.r_[True, events[1:] != events[:-1]]) if len(events) else np.zeros(0, dtype=np.int64)
+        self.events = events[starts]
+        self.offsets = np.r_[starts, len(events)].astype(np.int64)
+        # First hit of each SL and the end of the last one, from a key ordered like the hits
+        event_idx = np.repeat(np.arange(len(self.events)), np.diff(self.offsets))
+        keys = event_idx * (N_SL + 2) + np.clip(sl, -1, N_SL) + 1
+        targets = np.arange(len(self.events))[:, np.newaxis] * (N_SL + 2) + np.arange(N_SL + 1)[np.newaxis, :] + 1
+        self.sl_offsets = np.searchsorted(keys, targets, side='left')
+
+    def __len__(self):
+        return len(self.events)
+
+    def rows(self, i, sl=None):
+        """Slice of the sorted columns with the hits of event i, or only of its SL sl"""
+        if sl is None:
+            return slice(self.offsets[i], self.offsets[i+1])
+        return slice(self.sl_offsets[i, sl], self.sl_offsets[i, sl+1])
+
+    def column(self, name, i, sl=None):
+        return self.columns[name][self.rows(i, sl)]
+
+    def sizes(self):
+        """Number of hits of each event"""
+        return np.diff(self.offsets)
+
+    def sl_sizes(self):
+        """Number of hits in each SL of each event: shape (n_events, 4)"""
+        return np.diff(self.sl_offsets, axis=1)
+
+    def event_sum(self, values):
+        """Sum of per-hit values, given in the sorted order, over the hits of each event"""
+        values = np.asarray(values)
+        if values.dtype == bool:
+            values = values.astype(np.int64)
+        if len(self.events) == 0:
+            return np.zeros(0, dtype=values.dtype)
+        return np.add.reduceat(values, self.offsets[:-1])
@@ -0,0 +1,135 @@
+"""Data-quality histograms with fixed binning, filled during processing and mergeable across processes"""
+
+import threading
+import numpy as np
+
+from modules.analysis.config import NCHANNELS, max_slope, chisq_local, chisq_2d, chisq_3d
+
+### Binning of the data-quality histograms: name -> (number of bins, low edge, high edge)
+DQM_BINNING = {
+    'chisq_local':       (100, 0., chisq_local),          # chi squared of local segments
+    'chisq_2d':          (100, 0., chisq_2d),             # chi squared between chambers along the same axis
+    'chisq_3d':          (100, 0., chisq_3d),             # chi squared of the global planes
+    'slope_local':       (100, -max_slope, max_slope),    # dx/dz of local segments
+    'slope_xz':          (100, -max_slope, max_slope),    # dx/dz of global tracks
+    'slope_yz':          (100, -max_slope, max_slope),    # dy/dz of global tracks
+    'residual_local':    (100, -5., 5.),                  # hit position - segment position in mm
+    't0_dev':            (200, -100., 100.),              # event t0 - meantimer t0 in ns
+    't0_dev_calibrated': (200, -100., 100.),              # event t0 - meantimer t0 in ns after --calibrate_tzero
+    'hits_per_event':    (200, 0., 200.),                 # physical hits written per event
+    'channel_occupancy': (4*NCHANNELS, 0., 4*NCHANNELS),  # hits per channel: SL*NCHANNELS + TDC_CHANNEL_NORM - 1
+}
+
+
+class Histogram(object):
+    """1D histogram with uniform bins, the first and last counts are underflow and overflow"""
+
+    def __init__(self, nbins, low, high, counts=None):
+        self.nbins = int(nbins)
+        self.low = float(low)
+        self.high = float(high)
+        self.counts = np.zeros(self.nbins + 2, dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+
+    @property
+    def edges(self):
+        return np.linspace(self.low, self.high, self.nbins + 1)
+
+    @property
+    def binning(self):
+        return (self.nbins, self.low, self.high)
+
+    def fill(self, values):
+        """Adds an array of values, NaNs are ignored"""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        pos = (values - self.low) * (self.nbins / (self.high - self.low))
+        idx = np.clip(np.floor(pos), -1, self.nbins).astype(np.int64) + 1
+        self.counts += np.bincount(idx, minlength=self.nbins + 2)
+
+    def merge(self, other):
+        """Adds the counts of a histogram with the same binning"""
+        if other.binning != self.binning:
+            raise ValueError('can\'t merge histograms with binning {0} and {1}'.format(self.binning, other.binning))
+        self.counts += other.counts
+
+    def entries(self):
+        return int(self.counts.sum())
+
+
+class Monitor(object):
+    """Set of data-quality histograms of a run"""
+
+    def __init__(self, binning=DQM_BINNING):
+        self.histograms = dict([(name, Histogram(*bins)) for name, bins in binning.items()])
+
+    def __getitem__(self, name):
+        return self.histograms[name]
+
+    def fill(self, name, values):
+        self.histograms[name].fill(values)
+
+    def fill_segment(self, x, z, fit_pts, chisq):
+        """Fills the histograms of a local segment from the output of a segment finder"""
+        if len(x) == 0:
+            return
+        x, z, fit_pts = np.asarray(x), np.asarray(z), np.asarray(fit_pts)
+        self.fill('chisq_local', [chisq])
+        self.fill('residual_local', x - fit_pts)
+        if z.max() > z.min():
+            self.fill('slope_local', [np.polyfit(z, fit_pts, 1)[0]])
+
+    def reset(self):
+        for hist in self.histograms.values():
+            hist.counts[:] = 0
+
+    def merge(self, other):
+        """Adds the histograms of another monitor, e.g. from a different worker process"""
+        for name, hist in other.histograms.items():
+            if name in self.histograms:
+                self.histograms[name].merge(hist)
+            else:
+                self.histograms[name] = Histogram(*hist.binning, counts=hist.counts.copy())
+
+    def save(self, path):
+        """Writes all histograms into a single compressed .npz file"""
+        arrays = {}
+        for name, hist in self.histograms.items():
+            arrays['counts_' + name] = hist.counts
+            arrays['binning_' + name] = np.array(hist.binning, dtype=np.float64)
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        monitor = cls(binning={})
+        with np.load(path) as data:
+            for key in data.files:
+                if not key.startswith('counts_'):
+                    continue
+                name = key[len('counts_'):]
+                nbins, low, high = data['binning_' + name]
+                monitor.histograms[name] = Histogram(nbins, low, high, counts=data[key])
+        return monitor
+
+
+def merge_files(paths):
+    """Merges the histograms saved by several processes into one monitor"""
+    monitor = Monitor(binning={})
+    for path in paths:
+        monitor.merge(Monitor.load(path))
+    return monitor
+
+
+class CurrentMonitor(threading.local):
+    """Monitor selected separately in each thread, so that groups of files processed at once fill their own histograms"""
+
+    def __init__(self):
+        self.monitor = Monitor()
+
+    def use(self, monitor):
+        """Makes the calling thread fill the given monitor"""
+        self.monitor = monitor
+
+    def __getattr__(self, name):
+        return getattr(self.monitor, name)
@@ -0,0 +1,156 @@
+"""Per-event occupancy bitmaps for fast acceptance and layer-coverage checks"""
+
+import numpy as np
+
+from modules.analysis.config import NCHANNELS, NHITS_SL, MEANTIMER_SL_MULT_MIN
+from modules.analysis.geometry import CHANNEL_LAYER
+
+### Number of bits set in each possible byte
+POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(values):
+    """Number of bits set in each element of an array of unsigned integers"""
+    values = np.ascontiguousarray(values)
+    nbytes = values.dtype.itemsize
+    return POPCOUNT8[values.view(np.uint8)].reshape(values.shape + (nbytes,)).sum(axis=-1, dtype=np.int64)
+
+
+def channel_mask(channels):
+    """64-bit mask with one bit set for each normalised channel number (1..NCHANNELS)"""
+    mask = np.uint64(0)
+    for ch in channels:
+        if 1 <= ch <= NCHANNELS:
+            mask |= np.uint64(1) << np.uint64(ch - 1)
+    return mask
+
+
+def acceptance_masks(sl_channels):
+    """Channel masks of the 4 SLs from a {SL: [channels]} dictionary like ACCEPTANCE_CHANNELS"""
+    return np.array([channel_mask(sl_channels.get(sl, [])) for sl in range(4)], dtype=np.uint64)
+
+
+def channel_bits(sl, channels):
+    """Bit of each hit in the channel bitmap of its SL, 0 for hits outside the physical channels"""
+    sl = np.asarray(sl, dtype=np.int64)
+    channels = np.asarray(channels, dtype=np.int64)
+    sel = (sl >= 0) & (sl < 4) & (channels >= 1) & (channels <= NCHANNELS)
+    return np.where(sel, np.left_shift(np.uint64(1), np.where(sel, channels - 1, 0).astype(np.uint64)), np.uint64(0))
+
+
+def in_masks(sl, channels, masks):
+    """Whether each hit is in the channel mask of its SL"""
+    bits = channel_bits(sl, channels)
+    return (bits & masks[np.clip(np.asarray(sl, dtype=np.int64), 0, 3)]) != 0
+
+
+### Channels of each layer of a SL as 64-bit masks [index 0 is unused]
+LAYER_CHANNELS = np.array([channel_mask([ch for ch in range(1, NCHANNELS+1) if CHANNEL_LAYER[ch % 4] == layer])
+                           for layer in range(5)], dtype=np.uint64)
+
+
+def layer_masks(channels):
+    """4x4 layer masks from the channel bitmaps: bit (4*sl + layer-1) is set if that layer of the SL has hits"""
+    hit = (channels[:, :, np.newaxis] & LAYER_CHANNELS[np.newaxis, np.newaxis, 1:]) != 0
+    weights = np.left_shift(1, np.arange(16)).reshape(4, 4)
+    return (hit * weights).sum(axis=(1, 2)).astype(np.uint16)
+
+
+def _or_reduce(keys, bits, size):
+    """OR of `bits` grouped by integer `keys` in the range [0, size)"""
+    out = np.zeros(size, dtype=bits.dtype)
+    if len(keys) == 0:
+        return out
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    out[keys[starts]] = np.bitwise_or.reduceat(bits[order], starts)
+    return out
+
+
+class EventOccupancy(object):
+    """Occupancy of every event as fixed-width bitmaps: 4 SLs x 64 channels and a 4x4 layer mask
+
+    Channel bit (ch-1) of channels[i, sl] is set if the normalised channel ch has a hit,
+    bit (4*sl + layer-1) of layers[i] is set if that layer of the SL has a hit.
+    Layer masks are derived from the channel bitmaps, so that both can be restricted
+    to a set of channels, e.g. the acceptance region, with a single AND.
+    """
+
+    def __init__(self, events, channels):
+        self.events = events
+        self.channels = channels
+        self.layers = layer_masks(channels)
+
+    @classmethod
+    def from_hits(cls, hits, event_col='EVENT_NR'):
+        """Builds the bitmaps of all events in a dataframe of hits in one vectorised pass"""
+        sl = hits['SL'].values.astype(np.int64)
+        bits = channel_bits(sl, hits['TDC_CHANNEL_NORM'].values)
+        events, inv = np.unique(hits[event_col].values, return_inverse=True)
+        # Only physical channels contribute to the bitmaps
+        sel = bits != 0
+        keys = inv.ravel()[sel]*4 + sl[sel]
+        channels = _or_reduce(keys, bits[sel], len(events)*4).reshape(-1, 4)
+        return cls(events, channels)
+
+    def __len__(self):
+        return len(self.events)
+
+    def index(self, events):
+        """Positions of the given event numbers in the bitmaps"""
+        return np.searchsorted(self.events, events)
+
+    def masked(self, masks=None):
+        """Channel bitmaps restricted to per-SL channel masks"""
+        return self.channels if masks is None else self.channels & masks
+
+    def n_layers(self, masks=None):
+        """Number of layers with hits in each SL: shape (n_events, 4)"""
+        layers = self.layers if masks is None else layer_masks(self.masked(masks))
+        nibbles = (layers[:, np.newaxis] >> (4*np.arange(4, dtype=np.uint16))) & np.uint16(0xf)
+        return popcount(nibbles.astype(np.uint8))
+
+    def n_channels(self, masks=None):
+        """Number of different channels with hits in each SL: shape (n_events, 4)"""
+        return popcount(self.masked(masks))
+
+    def any_hits(self, masks=None):
+        """Whether the event has any hits"""
+        return (self.masked(masks) != 0).any(axis=1)
+
+    def all_chambers(self, masks=None):
+        """Whether every SL has at least one hit"""
+        return (self.masked(masks) != 0).all(axis=1)
+
+    def accepted(self, chambers, masks=None):
+        """Layer-coverage and chamber-presence cuts of event_accepted for all events at once"""
+        # Minimum number of chambers with 3+ layers of hits
+        ok = (self.n_layers(masks) >= 3).sum(axis=1) >= MEANTIMER_SL_MULT_MIN
+        # Minimum number of chambers with enough different channels hit
+        ok &= (self.n_channels(masks) >= NHITS_SL[0]).sum(axis=1) >= chambers
+        return ok
+
+
+def cell_hit_stats(events, sl, channels, times):
+    """Statistics of cells with 2+ hits in each event that has any, from a single lexicographic sort
+
+    Returns the event numbers, the maximum number of hits in a cell, the minimum time between
+    the first two hits of a cell and the maximum time between the first and last hits of a cell.
+    """
+    order = np.lexsort((times, channels, sl, events))
+    events, sl, channels, times = events[order], sl[order], channels[order], times[order]
+    new_cell = np.r_[True, (events[1:] != events[:-1]) | (sl[1:] != sl[:-1]) | (channels[1:] != channels[:-1])]
+    starts = np.flatnonzero(new_cell)
+    ends = np.r_[starts[1:], len(events)]
+    # Keeping only cells with multiple hits
+    multi = ends - starts >= 2
+    starts, ends = starts[multi], ends[multi]
+    if len(starts) == 0:
+        return events[:0], np.zeros(0, dtype=np.int64), times[:0], times[:0]
+    cell_events = events[starts]
+    ev_starts = np.flatnonzero(np.r_[True, cell_events[1:] != cell_events[:-1]])
+    return (cell_events[ev_starts],
+            np.maximum.reduceat(ends - starts, ev_starts),
+            np.minimum.reduceat(times[starts + 1] - times[starts], ev_starts),
+            np.maximum.reduceat(times[ends - 1] - times[starts], ev_starts))
@@ -0,0 +1,73 @@
+"""Pipelined processing of a sequence of work items through stages running in separate threads"""
+
+import threading
+import queue
+
+# Marks the end of the items in the queues between stages
+_END = object()
+
+
+class Pipeline(object):
+    """Runs items through a sequence of stages, each in its own thread, connected by bounded queues
+
+    Item N+1 goes through the first stage while item N is in the second one, N-1 in the third
+    and so on, so the wall time approaches that of the slowest stage. At most `max_in_flight`
+    items are between the start of the first stage and the end of the last one, which caps the
+    memory taken by intermediate results. Results of the last stage are returned in the input
+    order. The first exception raised by a stage stops the pipeline and is raised by run().
+    """
+
+    def __init__(self, stages, max_in_flight=None):
+        self.stages = list(stages)
+        self.max_in_flight = len(self.stages) if max_in_flight is None else max(1, int(max_in_flight))
+
+    def run(self, items):
+        slots = threading.Semaphore(self.max_in_flight)
+        queues = [queue.Queue(maxsize=1) for _ in self.stages] + [queue.Queue()]
+        failed = threading.Event()
+        errors = []
+
+        def work(stage, inputs, outputs, last):
+            while True:
+                item = inputs.get()
+                if item is _END:
+                    outputs.put(_END)
+                    return
+                # Dropping the items still in flight after a failure
+                if failed.is_set():
+                    slots.release()
+                    continue
+                try:
+                    result = stage(item)
+                except BaseException as e:
+                    errors.append(e)
+                    failed.set()
+                    slots.release()
+                    continue
+                if last:
+                    slots.release()
+                outputs.put(result)
+
+        threads = []
+        for i, stage in enumerate(self.stages):
+            thread = threading.Thread(target=work, args=(stage, queues[i], queues[i+1], i == len(self.stages) - 1), daemon=True)
+            thread.start()
+            threads.append(thread)
+        # Feeding the items, waiting for a free slot before starting each one
+        for item in items:
+            slots.acquire()
+            if failed.is_set():
+                break
+            queues[0].put(item)
+        queues[0].put(_END)
+        results = []
+        while True:
+            result = queues[-1].get()
+            if result is _END:
+                break
+            results.append(result)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
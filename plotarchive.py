@@ -0,0 +1,55 @@
+"""Archive of the per-event figures as pages of a few multi-page PDF files, with an index from event number to page"""
+
+import os
+import pandas as pd
+
+### Maximum number of pages of each PDF file, to keep them quick to open
+PLOT_ARCHIVE_PAGES = 1000
+
+
+class PlotArchive(object):
+    """Figures appended as pages of <base>_000.pdf, <base>_001.pdf, ... with their index in <base>.csv
+
+    Each row of the index gives the event, the kind of figure, the PDF file and the page [from 0].
+    """
+
+    def __init__(self, base, max_pages=PLOT_ARCHIVE_PAGES):
+        self.base = base
+        self.max_pages = max_pages
+        self.pdf = None
+        self.files = []
+        self.pages = 0
+        self.index = []
+
+    def savefig(self, fig, event, kind):
+        """Appends a figure as the next page"""
+        if self.pdf is None or self.pages == self.max_pages:
+            from matplotlib.backends.backend_pdf import PdfPages
+            if self.pdf is not None:
+                self.pdf.close()
+            self.files.append('{0:s}_{1:03d}.pdf'.format(self.base, len(self.files)))
+            self.pdf = PdfPages(self.files[-1])
+            self.pages = 0
+        self.pdf.savefig(fig)
+        self.index.append((int(event), kind, os.path.basename(self.files[-1]), self.pages))
+        self.pages += 1
+
+    def close(self):
+        """Closes the last PDF file and writes the index"""
+        if self.pdf is not None:
+            self.pdf.close()
+            self.pdf = None
+        pd.DataFrame(self.index, columns=['EVENT_NR', 'KIND', 'FILE', 'PAGE']).to_csv(self.base+'.csv', index=False)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def find_pages(index_path, event, kind=None):
+    """PDF files [next to the index] and pages with the figures of an event, optionally of one kind only"""
+    index = pd.read_csv(index_path)
+    sel = index['EVENT_NR'] == event
+    if kind is not None:
+        sel &= index['KIND'] == kind
+    folder = os.path.dirname(index_path)
+    return [(os.path.join(folder, row['FILE']), int(row['PAGE'])) for _, row in index[sel].iterrows()]
@@ -1,60 +1,132 @@
 #!/usr/bin/env python
-from pdb import set_trace as br
-from time import clock
-from multiprocessing import Process
+"""
+Processing of unpacked miniDT hits: event building, t0 determination and local/global reconstruction
+
+Runs as a script, or can be imported to use the processing stages with an Options object:
+
+    from process_hits_v2 import Options, process
+    process(['data_000000.txt'], Options(triplets=True, root=True, no_plots=True))
+"""
+from multiprocessing import Process, Pool
 import math
 import numpy as np
 import pandas as pd
 import itertools
 import os 
 import sys
+import json
 import operator
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-from matplotlib.backends.backend_pdf import PdfPages
+import argparse
+import threading
+import contextlib
+import time
 
 # Importing custom code snippets
-from modules.analysis.patterns import PATTERNS, PATTERN_NAMES, ACCEPTANCE_CHANNELS, MEAN_TZERO_DIFF, meantimereq, mean_tzero, tzero_clusters
+from modules.analysis.patterns import PATTERNS, PATTERN_NAMES, ACCEPTANCE_CHANNELS, MEAN_TZERO_DIFF, meantimereq, mean_tzero
 from modules.analysis.config import NCHANNELS, XCELL, ZCELL, Z_SEP, TDRIFT, VDRIFT, CHANNELS_TRIGGER, CHANNEL_TRIGGER, EVENT_NR_CHANNELS
 from modules.analysis.config import max_slope,chisq_local,chisq_2d,chisq_3d
 from modules.analysis.config import EVENT_TIME_GAP, TIME_OFFSET, TIME_OFFSET_SL, TIME_WINDOW, DURATION, TRIGGER_TIME_ARRAY
 from modules.analysis.config import NHITS_SL, MEANTIMER_ANGLES, MEANTIMER_CLUSTER_SIZE, MEANTIMER_SL_MULT_MIN
 from modules.analysis.utils import print_progress, mem
+from modules.analysis.geometry import GEOMETRY
+from modules.analysis.eventbuilder import build_events
+from modules.analysis.segments import hough_fit
+from modules.analysis.fitting import LINE_FITS
+from modules.analysis.occupancy import EventOccupancy, acceptance_masks, in_masks, cell_hit_stats
+from modules.analysis.textio import AsyncTextWriter, HIT_COLUMNS
+from modules.analysis.monitoring import Monitor, CurrentMonitor
+from modules.analysis.cleaning import clean_hits
+from modules.analysis.tzero import TzeroClusters, TriggerCalibration
+from modules.analysis.layout import EventLayout
+from modules.analysis.pipeline import Pipeline
+from modules.analysis.quicklook import QuickLook, sampled
+from modules.analysis.profiler import EventProfiler, load_slow_events
+from modules.analysis.cutflow import Selection, CutFlow, COST_PER_EVENT
+from modules.analysis.query import TRACK_FIT_COLUMNS, save_tracks
+from modules.analysis.plotarchive import PlotArchive
+from modules.analysis.budget import ComputeBudget, MEANTIMER_REDUCED, SEGMENTS_HOUGH, BUDGET_FLAGS
+from modules.analysis.channels import channel_table, flag_channels, save_mask, load_mask, masked
 
 
 
 ############################################# INPUT ARGUMENTS 
-import argparse
-parser = argparse.ArgumentParser(description='Offline analysis of unpacked data. t0 id performed based on pattern matching.')
-parser.add_argument('inputs', metavar='FILE', help='Unpacked input file to analyze', nargs='+')
-parser.add_argument('-a', '--accepted',  help='Save only events that passed acceptance cuts', action='store_true', default=False)
-parser.add_argument('-c', '--csv',  help='Print final selected hits into CSV files', action='store_true', default=False)
-parser.add_argument('--chambers',  help='Minimum number of chambers with 1+ hits', action='store', default=4, type=int)
-parser.add_argument('-d', '--double_hits',  help='Accept only events with 2+ hits in a cell', action='store_true', default=False)
-parser.add_argument('-e', '--event',  help='Split hits in events based on event number', action='store_true', default=False)
-parser.add_argument('-E', '--events', metavar='N',  help='Only process events with specified numbers', type=int, default=None, nargs='+')
-parser.add_argument('-g', '--group', metavar='N', type=int, help='Process input files sequentially in groups of N', action='store', default=999999)
-parser.add_argument('-l', '--layer',   action='store', default=None, dest='layer',   type=int, help='Layer to process [default: process all 4 layers]')
-parser.add_argument('-m', '--max_hits',   action='store', default=200, dest='max_hits',   type=int, help='Maximum number of hits allowed in one event [default: 200]')
-parser.add_argument('-n', '--number', action='store', default=None,  dest='number', type=int, help='Number of hits to analyze. (Note: this is applied to each file if multiple files are analyzed with -g)')
-parser.add_argument('-r', '--root',  help='Print output to a ROOT friendly text file', action='store_true', default=False)
-parser.add_argument('-s', '--suffix',  action='store', default=None, help='Suffix to add to output file names', type=str)
-parser.add_argument('-t', '--triplets',  help='Do triplet search', action='store_true', default=False)
-parser.add_argument('-u', '--update_tzero',  help='Update TIME0 with meantimer solution', action='store_true', default=False)
-parser.add_argument('-v', '--verbose',  help='Increase verbosity of the log', action='store', default=0)
-parser.add_argument('--range',  help='Specify a range of acceptable events to process', action='store', default=[0,None],nargs = 2)
-parser.add_argument('-j','--join',  help='Specify a range of reconstructions to plot together on the same figure', action='store', default=[0,None],nargs = 2)
-args = parser.parse_args()
-for file_path in args.inputs:
-    if not os.path.exists(os.path.expandvars(file_path)):
-        print('--- ERROR ---')
-        print('file not found')
-        print('  please point to the correct path to the file containing the unpacked data' )
-        print()
-        exit()
-
-VERBOSE = int(args.verbose)
-EVT_COL = 'EVENT_NR' if args.event else 'ORBIT_CNT'
+def build_parser():
+    """Command-line arguments, also defining names and defaults of the processing options"""
+    parser = argparse.ArgumentParser(description='Offline analysis of unpacked data. t0 id performed based on pattern matching.')
+    parser.add_argument('inputs', metavar='FILE', help='Unpacked input file to analyze', nargs='+')
+    parser.add_argument('-a', '--accepted',  help='Save only events that passed acceptance cuts', action='store_true', default=False)
+    parser.add_argument('-c', '--csv',  help='Print final selected hits into CSV files', action='store_true', default=False)
+    parser.add_argument('--budget', metavar='N', type=int, help='Maximum number of combinations tried in one chamber of an event: over it the meantimer only uses the first hit of each channel, segments are found by the Hough transform and the event is flagged in DEGRADED [default: no limit]', action='store', default=None)
+    parser.add_argument('--budget_us', metavar='US', type=float, help='Maximum time spent on one event [microseconds]: once over it, the remaining meantimer and segment steps of the event use the same approximations as --budget and the event is flagged in DEGRADED [default: no limit]', action='store', default=None)
+    parser.add_argument('--calibrate_tzero',  help='Fit the deviations of the trigger TIME0 from the meantimer t0 of all events against the trigger time differences and correct TIME0 of every event before computing the hit positions [with -e, implies -t]', action='store_true', default=False)
+    parser.add_argument('--channel_mask', metavar='FILE', help='Remove hits of the channels flagged as noisy or dead in a channel mask file made by --find_channels', action='store', default=None)
+    parser.add_argument('--chambers',  help='Minimum number of chambers with 1+ hits', action='store', default=4, type=int)
+    parser.add_argument('--clean',  action='store', default=None, choices=['duplicates', 'afterpulses'], help='Remove repeated hits in the same channel within the dead time [duplicates] or also afterpulses [afterpulses] before building events')
+    parser.add_argument('-d', '--double_hits',  help='Accept only events with 2+ hits in a cell', action='store_true', default=False)
+    parser.add_argument('-e', '--event',  help='Split hits in events based on event number', action='store_true', default=False)
+    parser.add_argument('-E', '--events', metavar='N',  help='Only process events with specified numbers', type=int, default=None, nargs='+')
+    parser.add_argument('--find_channels',  help='Only compute the hit rate of every channel and save the noisy and dead ones as a channel mask file', action='store_true', default=False)
+    parser.add_argument('-g', '--group', metavar='N', type=int, help='Process input files sequentially in groups of N', action='store', default=999999)
+    parser.add_argument('-l', '--layer',   action='store', default=None, dest='layer',   type=int, help='Layer to process [default: process all 4 layers]')
+    parser.add_argument('-m', '--max_hits',   action='store', default=None, dest='max_hits',   type=int, help='Maximum number of hits allowed in one event [default: 200, no limit with --segments hough]')
+    parser.add_argument('--no_plots',  help='Don\'t save plots of each reconstructed event, only the data-quality histograms', action='store_true', default=False)
+    parser.add_argument('-n', '--number', action='store', default=None,  dest='number', type=int, help='Number of hits to analyze. (Note: this is applied to each file if multiple files are analyzed with -g)')
+    parser.add_argument('--pipeline', metavar='N', type=int, help='Number of groups of input files (-g) in flight at once: group N+1 is read while group N is reconstructed and group N-1 is written [default: 1]', action='store', default=1)
+    parser.add_argument('--plots',  action='store', default='png', choices=['png', 'pdf'], help='Save the plots of each reconstructed event as PNG files in plots/ [png] or as pages of a few PDF files next to the text output, with an index from event number to page [pdf] [default: png]')
+    parser.add_argument('-p', '--processes', action='store', default=None, type=int, help='Number of worker processes reading input files in parallel [default: one per file, up to the number of CPUs]')
+    parser.add_argument('--replay', metavar='N', type=int, help='Rerun the N-th event captured by --profile under cProfile, the input file being the _profile.json output', action='store', default=None)
+    parser.add_argument('-r', '--root',  help='Print output to a ROOT friendly text file', action='store_true', default=False)
+    parser.add_argument('--segments',  action='store', default='combinatorial', choices=['combinatorial', 'hough'], help='Local segment finder: all left/right combinations or Hough transform for busy chambers [default: combinatorial]')
+    parser.add_argument('-S', '--summary',  help='Save the event table and counters of each group of input files next to the text output', action='store_true', default=False)
+    parser.add_argument('-s', '--suffix',  action='store', default=None, help='Suffix to add to output file names', type=str)
+    parser.add_argument('-t', '--triplets',  help='Do triplet search', action='store_true', default=False)
+    parser.add_argument('-u', '--update_tzero',  help='Update TIME0 with meantimer solution', action='store_true', default=False)
+    parser.add_argument('-v', '--verbose',  help='Increase verbosity of the log', action='store', default=0)
+    parser.add_argument('--profile', metavar='MS', type=float, help='Time every event in the meantimer, triplet and reconstruction stages and capture the hits of events slower than MS milliseconds', action='store', default=None)
+    parser.add_argument('--prescale', metavar='N', type=int, help='Quick look: process only 1 in N blocks of QUICKLOOK_BLOCK_ORBITS orbits over the whole run and report estimates with their sampling uncertainty [default: 1, all orbits]', action='store', default=1)
+    parser.add_argument('--range',  help='Specify a range of acceptable events to process', action='store', default=[0,None],nargs = 2)
+    parser.add_argument('-j','--join',  help='Specify a range of reconstructions to plot together on the same figure', action='store', default=[0,None],nargs = 2)
+    return parser
+
+
+class Options(argparse.Namespace):
+    """Processing options with the names and defaults of the command-line arguments"""
+
+    def __init__(self, **kwargs):
+        options = dict([(action.dest, action.default) for action in build_parser()._actions if action.dest != 'help'])
+        unknown = set(kwargs) - set(options)
+        if unknown:
+            raise TypeError('unknown options: {0:s}'.format(', '.join(sorted(unknown))))
+        options.update(kwargs)
+        argparse.Namespace.__init__(self, **options)
+
+    @property
+    def verbosity(self):
+        return int(self.verbose)
+
+
+def parse_args(argv=None):
+    """Parses command-line arguments into Options"""
+    return build_parser().parse_args(argv, namespace=Options())
+
+
+def pyplot():
+    """Imports matplotlib only when plots are actually produced"""
+    import matplotlib.pyplot as plt
+    # Registering the 3d projection
+    from mpl_toolkits.mplot3d import Axes3D
+    return plt
+
+# Acceptance region of each SL as a channel bitmap
+ACCEPTANCE_MASKS = acceptance_masks(ACCEPTANCE_CHANNELS)
+# Data-quality histograms of the input files being processed [by each thread of the pipeline]
+DQM = CurrentMonitor()
+# Matplotlib is not thread-safe: plots of different groups of files are produced one at a time
+PLOT_LOCK = threading.Lock()
+
+def plotting(plots):
+    """Context holding PLOT_LOCK if plots are produced in it"""
+    return PLOT_LOCK if plots else contextlib.nullcontext()
 
 #                         / z-axis (beam direction)
 #                        .
@@ -85,53 +157,39 @@ EVT_COL = 'EVENT_NR' if args.event else 'ORBIT_CNT'
 #      3         |    2    |    6    |   10    |
 #      4              |    4    |    8    |   12    |
 
-def analyse_parallel(args):
-    """Wrapper around the main function to properly pass arguments"""
-    return analyse(*args)
-
 ############################################# ANALYSIS
-def analyse(dfhits, SL):
-
-    meantimer_info = {
-        't0_diff': [],
-        't0_mult': [],
-        'triplet_angle': [],
-        'nhits/event': [],
-    }
-    tzerodiff = []
-    tzeromult = []
-    hitperorbit = []
-
-    # Selecting only physical channels of this layer
+def analyse(dfhits, opts):
+    """Calculates positions of the hits of all SLs from the TIME0 of their events"""
+    # Selecting only physical channels
     sel = dfhits['TDC_CHANNEL_NORM'] <= NCHANNELS
-
-    events = dfhits[sel].groupby('EVENT_NR')
+    # Numbers of hits in each SL of each event
+    nhits = dfhits[sel].groupby(['SL', 'EVENT_NR']).size()
+    meantimer_info = {}
+    for SL in nhits.index.levels[0]:
+        nhits_sl = nhits.loc[SL]
+        meantimer_info[SL] = {
+            't0_diff': [],
+            't0_mult': [],
+            'triplet_angle': [],
+            'nhits/event': list(nhits_sl.values),
+        }
+        print('### SL {0:d}: Starting analysis with {1:d} hits in {2:d} events'.format(SL, int(nhits_sl.sum()), len(nhits_sl)))
+        if opts.verbosity:
+            print('Number of hits per event:  min: {0:d}   max: {1:d}'.format(nhits_sl.min(), nhits_sl.max()))
     # # Excluding groups that have multiple time measurements with the same channel
-    # # They strongly degrade performance of meantimer
-    # idx = dfhits.loc[dfhits['TDC_CHANNEL_NORM'] <= NCHANNELS].groupby(EVT_COL).filter(lambda x: x['TDC_CHANNEL_NORM'].size == x['TDC_CHANNEL_NORM'].nunique()).index
-
-    n_events = len(events)
-    n_events_processed = 0
+    # # They strongly degrade performance of meantimer [see --clean]
 
-    print('### SL {0:d}: Starting analysis with {1:d} hits in {2:d} events'.format(SL, dfhits.shape[0], len(events)))
-    if VERBOSE:
-        nhits = events['TDC_CHANNEL'].size()
-        print('Number of hits per event:  min: {0:d}   max: {1:d}'.format(nhits.min(), nhits.max()))
-    for event, df in events:
-        print_progress(n_events_processed, n_events, SL)
-        n_events_processed += 1
-        n_hits = df.shape[0]
+    # Positions are only computed once TIME0 is calibrated
+    if opts.calibrate_tzero:
+        return (dfhits, dfhits.loc[dfhits['TIME0'] > 0], meantimer_info)
+    dfhits, df = hit_positions(dfhits)
 
-        if VERBOSE > 1:
-            print('analyzing event', event)
-            print('# hits =', n_hits)
-
-        meantimer_info['nhits/event'].append(n_hits)
+    # Returning the calculated results
+    return (dfhits, df, meantimer_info)
 
-        # Getting the TIME0
-        tzero = df.iloc[0]['TIME0']
-        tzeromult.append(1)
 
+def hit_positions(dfhits):
+    """Drift times and left/right positions of the hits from the TIME0 of their events"""
     # Selecting only hits that are from events with TIME0 properly estimated
     idx = dfhits['TIME0'] > 0
     
@@ -140,19 +198,23 @@ def analyse(dfhits, SL):
     
     # assign hits position (left/right wrt wire)
 
-    dfhits.loc[idx, 'X_POS_LEFT']  = ((dfhits['TDC_CHANNEL_NORM']-0.5).floordiv(4) + dfhits['X_POSSHIFT'])*XCELL + XCELL/2 - np.maximum(dfhits['TIMENS'], 0)*VDRIFT
-    dfhits.loc[idx, 'X_POS_RIGHT'] = ((dfhits['TDC_CHANNEL_NORM']-0.5).floordiv(4) + dfhits['X_POSSHIFT'])*XCELL + XCELL/2 + np.maximum(dfhits['TIMENS'], 0)*VDRIFT
-    df = dfhits.loc[idx]
-
-    # Returning the calculated results
-    return (SL, dfhits, df, meantimer_info)
+    wire_x = pd.Series(GEOMETRY.lookup('wire_x', GEOMETRY.index(dfhits['FPGA'].values, dfhits['TDC_CHANNEL'].values)), index=dfhits.index)
+    dfhits.loc[idx, 'X_POS_LEFT']  = wire_x - np.maximum(dfhits['TIMENS'], 0)*VDRIFT
+    dfhits.loc[idx, 'X_POS_RIGHT'] = wire_x + np.maximum(dfhits['TIMENS'], 0)*VDRIFT
+    return (dfhits, dfhits.loc[idx])
 
 
 def event_nr(numbers):
     return (numbers.iloc[0] << 12) | (numbers.iloc[1] << 8) | (numbers.iloc[2] << 4) | (numbers.iloc[3])
 
 
-def calc_event_numbers(allhits):
+def trigger_bits(present):
+    """Bits of the trigger signals present in an event, in the order of CHANNELS_TRIGGER"""
+    # Packing bits into 8bit integer and shifting by 5 positions to the right
+    return int(np.packbits(present)[0] >> 5)
+
+
+def calc_event_numbers(allhits, opts):
     """Calculates event number for groups of hits based on trigger hits"""
     # Creating a dataframe to be filled with hits from found events (for better performance)
     hits = allhits.loc[:1, ['EVENT_NR', 'TIME0']]
@@ -173,8 +235,8 @@ def calc_event_numbers(allhits):
     # Adding column to be used for grouping hits with event number and trigger
     allhits['evt_group'] = evt_group
     allhits['evt_group'] = allhits['evt_group'].fillna(-1).astype(int)
-    # Getting back rows with relevant channels with grouping column updated
-    ev_hits = allhits.loc[evt_group]
+    # Getting back rows with relevant channels with grouping column updated [by their row index, not group id]
+    ev_hits = allhits.loc[evt_group.index]
     ev_hits.set_index(['FPGA', 'TDC_CHANNEL'], inplace=True)
     # Checking each group to calculate event number for it
     evt_groups = ev_hits.groupby('evt_group')
@@ -199,7 +261,7 @@ def calc_event_numbers(allhits):
             vals_int = df['TDC_MEAS'].reindex(EVENT_NR_CHANNELS, fill_value=0)
         except Exception:
             # Removing duplicate entries with the same channel value (very rare occasion)
-            if VERBOSE:
+            if opts.verbosity:
                 print('WARNING: duplicate entries with the same channel for event number:')
                 print(df[['ORBIT_CNT', 'BX_COUNTER', 'TDC_MEAS']])
             df = df[~df.index.duplicated(keep='first')]
@@ -207,7 +269,7 @@ def calc_event_numbers(allhits):
 
         evt_id = event_nr(vals_int)
         # Skipping if only one specific event should be processed
-        if args.events and evt_id not in args.events:
+        if opts.events and evt_id not in opts.events:
             continue
 
         # Check whether trigger signal is present
@@ -216,10 +278,9 @@ def calc_event_numbers(allhits):
             print('         Event skipped')
             # Storing information about available trigger signals
             df_trg = df['TDC_MEAS'].reindex(CHANNELS_TRIGGER, fill_value=-111)
-            # Packing bits into 8bit integer and shifting by 5 positions to the right
-            trg_bits = np.packbits(df_trg != -111) >> 5
+            trg_bits = trigger_bits(df_trg != -111)
             df_events.loc[grp, ['EVENT_NR', 'TRG_BITS']] = (evt_id, trg_bits)
-            if VERBOSE:
+            if opts.verbosity:
               print(allhits.loc[allhits["ORBIT_CNT"].isin(range(orbit_event-10,orbit_event+10))].loc[allhits["TDC_CHANNEL"].isin(channels)])
             continue
 
@@ -229,17 +290,17 @@ def calc_event_numbers(allhits):
         if evt_id <= last_evt_id:
           print('WARNING: Backward-jump in event number (current={0}, last={1})'.format(evt_id, last_evt_id))
           print('         Event skipped')
-          if VERBOSE:
+          if opts.verbosity:
             print(allhits.loc[allhits["ORBIT_CNT"].isin(range(orbit_event-10,orbit_event+10))].loc[allhits["TDC_CHANNEL"].isin(channels)])
           continue
         
         # check for events with way larger ID than previous one
-        if not args.events and last_evt_id > 0 and (evt_id - last_evt_id) > 20:
+        if not opts.events and last_evt_id > 0 and (evt_id - last_evt_id) > 20:
           print('WARNING: Large forward-jump in event number (current={0}, last={1})'.format(evt_id, last_evt_id))
           print('         Retaining current and removing previous event')
           # allhits.drop(allhits[allhits['EVENT_NR'] == last_evt_id].index, inplace=True)
           allhits.loc[allhits['EVENT_NR'] == last_evt_id, 'EVENT_NR'] = -1
-          if VERBOSE:
+          if opts.verbosity:
             print(allhits.loc[allhits["ORBIT_CNT"].isin(range(orbit_event-10,orbit_event+10))].loc[allhits["TDC_CHANNEL"].isin(channels)])
           # don't 'continue' as this indicates only an issue when opening a new file (first event ID of a file being a result of a backward-jump)
         # Storing ID of the last event to detect jumps in EVENT_NR
@@ -265,8 +326,7 @@ def calc_event_numbers(allhits):
         # Calculating time of arrival of the different trigger signals
         df_trg = df['TIME_ABS'].reindex(CHANNELS_TRIGGER, fill_value=-111)
         times_trg = df_trg.values
-        # Packing bits into 8bit integer and shifting by 5 positions to the right
-        trg_bits = np.packbits(df_trg != -111) >> 5
+        trg_bits = trigger_bits(df_trg != -111)
         df_events.loc[grp, ['TIMEDIFF_TRG_20', 'TIMEDIFF_TRG_21', 'TRG_BITS', 'EVENT_NR', 'TIME0']] = (
             times_trg[2] - times_trg[0], times_trg[2] - times_trg[1], trg_bits, evt_id, tzero)
         # start = clock()
@@ -291,37 +351,38 @@ def calc_event_numbers(allhits):
         df_events.drop(-1, inplace=True)
     return df_events
 
-def meantimer_results(df_hits, verbose=False):
-    """Run meantimer over the group of hits"""
-    sl = df_hits['SL'].iloc[0]
-    # Getting a TIME column as a Series with TDC_CHANNEL_NORM as index
-    df_time = df_hits.loc[:, ['TDC_CHANNEL_NORM', 'TIME_ABS', 'LAYER']]
-    df_time.sort_values('TIME_ABS', inplace=True)
+def meantimer_results(sl, channels, times, verbose=False, budget=None):
+    """Run meantimer over the hits of one SL given as arrays of TDC_CHANNEL_NORM and TIME_ABS, within the compute budget if given"""
+    order = np.argsort(times, kind='stable')
+    channels = np.asarray(channels)[order].astype(np.int16)
+    times = np.asarray(times)[order]
     # Split hits in groups where time difference is larger than maximum event duration
-    grp = df_time['TIME_ABS'].diff().fillna(0)
     event_width_max = 1.1*TDRIFT
-    grp[grp <= event_width_max] = 0
-    grp[grp > 0] = 1
-    grp = grp.cumsum().astype(np.uint16)
-    df_time['grp'] = grp
-    # Removing groups with less than 3 unique hits
-    df_time = df_time[df_time.groupby('grp')['TDC_CHANNEL_NORM'].transform('nunique') >= 3]
+    bounds = np.r_[0, np.flatnonzero(np.diff(times) > event_width_max) + 1, len(times)]
     # Determining the TIME0 using triplets [no external trigger]
     tzeros = []
     angles = []
     # Processing each group of hits
     patterns = PATTERN_NAMES.keys()
-    for grp, df_grp in df_time.groupby('grp'):
-        df_grp.set_index('TDC_CHANNEL_NORM', inplace=True)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        channels_grp = channels[start:end]
+        # Skipping groups with less than 3 unique hits
+        channels_set = set(channels_grp.tolist())
+        if len(channels_set) < 3:
+            continue
+        times_grp = times[start:end]
         # Selecting only triplets present among physically meaningful hit patterns
-        channels = set(df_grp.index.astype(np.int16))
-        triplets = set(itertools.permutations(channels, 3))
+        triplets = set(itertools.permutations(channels_set, 3))
         triplets = triplets.intersection(patterns)
-        # Grouping hits by the channel for quick triplet retrieval
-        times = df_grp.groupby(df_grp.index)['TIME_ABS']
+        # Keeping only the first hit of each channel if there are too many combinations of hit times
+        if budget is not None and budget.limited:
+            counts = dict(zip(*np.unique(channels_grp, return_counts=True)))
+            if budget.exceeded(sum([counts[a]*counts[b]*counts[c] for a, b, c in triplets]), MEANTIMER_REDUCED):
+                first = np.sort(np.unique(channels_grp, return_index=True)[1])
+                channels_grp, times_grp = channels_grp[first], times_grp[first]
         # Analysing each triplet
         for triplet in triplets:
-            triplet_times = [times.get_group(ch).values for ch in triplet]
+            triplet_times = [times_grp[channels_grp == ch] for ch in triplet]
             for t1 in triplet_times[0]:
                 for t2 in triplet_times[1]:
                     for t3 in triplet_times[2]:
@@ -345,141 +406,149 @@ def removezeros(arr):
     arr = arr[~zeros]
     return arr
 
-def allowed_slope(xs,ys):
-#checks if the slope is at most 60 degrees from the vertical between the start and end point
-    x = sorted(xs)
-    y = sorted(ys)
-    if np.around(y[-1]-y[0]) == 0:
-        slope = 100
-    else:
-        slope = float((x[-1]-x[0])/(y[-1]-y[0]))
-    if slope > max_slope:
-        return False
-    else:
-        return True
+def allowed_slope(x_fit,ys):
+#checks which fits have a slope of at most 60 degrees from the vertical between the start and end point
+#x_fit holds the fitted x at the positions ys of each fit in a row
+    y_range = np.max(ys)-np.min(ys)
+    if np.around(y_range) == 0:
+        return np.zeros(len(x_fit), dtype=bool)
+    slope = (x_fit.max(axis=1)-x_fit.min(axis=1))/y_range
+    return slope <= max_slope
 
 
-def find_fit(df):
+def find_fit(df, budget=None):
 # function to try possible combinations of points and select the one with the best line of fit
     chambs = df.groupby('y')
     list1 = []
     for i,chamb in chambs:
         list1.append(chamb.to_numpy())
-    points = np.array(list(itertools.product(*list1)))
-
-    #iterate over all possible combinations of points and return the fit with best chi squared
-    chisq_best = 20. #maximum acceptable chi squared
+    ys = [chamb[0,1] for chamb in list1]
+    #too many combinations for the compute budget: Hough transform, with a cost linear in the number of points
+    if budget is not None and budget.exceeded(np.prod([len(chamb) for chamb in list1], dtype=np.float64), SEGMENTS_HOUGH):
+        return hough_fit(df)
+    #all possible combinations of one point per layer, one combination per row
+    points = np.stack(np.meshgrid(*[chamb[:,0] for chamb in list1], indexing='ij'), axis=-1).reshape(-1, len(list1))
+
+    #fit all combinations at once with the solvers precomputed for this pattern of layers
+    chisq_max = 20. #maximum acceptable chi squared
     dof = 2 #degrees of freedom in the fit
-    fit_best = []
-    x_best = []
-    y_best = []
-    count = np.arange(len(points))
-    for i in count:
-        xs = [x[0] for x in points[i]]
-        ys = [x[1] for x in points[i]]
-        fit, chisq, _, _, _ = np.polyfit(ys,xs,1,full = True)
-        x_fit = list(np.poly1d(fit)(ys))
-        
-        #ignore combinations with slopes that aren't allowed
-        if allowed_slope(x_fit,ys) == True:
-            #handles a combination with chisq << 1
-            if chisq.size == 0:
-                chisq_best = 0
-                fit_best = fit
-                x_best = xs
-                y_best = ys 
-            elif float(chisq)/dof < chisq_best:
-                chisq_best = chisq/dof
-                fit_best = fit
-                x_best = xs
-                y_best = ys
-    
-    fit_pts = list(np.poly1d(fit_best)(y_best))
+    slopes, intercepts, chisq = LINE_FITS.fit(ys, points)
+    x_fit = slopes[:,np.newaxis]*np.asarray(ys, dtype=np.float64)[np.newaxis,:] + intercepts[:,np.newaxis]
+    #ignore combinations with slopes that aren't allowed
+    allowed = np.flatnonzero(allowed_slope(x_fit,ys))
+    best = None
+    chisq_best = chisq_max
+    if len(ys) <= 2:
+        #a line through 2 points has no residuals: keeping the last allowed combination
+        if len(allowed):
+            best = allowed[-1]
+            chisq_best = 0
+    elif len(allowed):
+        #the first combination with the lowest chi squared
+        i = allowed[np.argmin(chisq[allowed])]
+        if chisq[i]/dof < chisq_max:
+            best = i
+            chisq_best = chisq[i]/dof
+    if best is None:
+        return [],[],[],float(chisq_best)
+    x_best = list(points[best])
+    y_best = ys
+    fit_pts = list(np.poly1d([slopes[best], intercepts[best]])(y_best))
     return x_best,y_best,fit_pts,float(chisq_best)
 
-def local_reconstruction_xleft_xright(data,n):
+# Local segment finders selectable with --segments
+SEGMENT_FINDERS = {'combinatorial': find_fit, 'hough': hough_fit}
+
+def chamber_points(layout, i, sl):
+    """Left and right positions of the hits in a chamber as (x, y=z) points for the segment finders"""
+    rows = layout.rows(i, sl)
+    x = np.concatenate([layout.columns['X_POS_LEFT'][rows], layout.columns['X_POS_RIGHT'][rows]])
+    z = np.tile(layout.columns['Z_POS'][rows], 2)
+    return pd.DataFrame({'x': x, 'y': z})
+
+def save_plot(fig, label, event, kind, archive=None):
+    """Saves the figure of an event as plots/<label>.png, or as a page of the PlotArchive if provided"""
+    if archive is None:
+        fig.savefig('plots/'+label+'.png')
+    else:
+        archive.savefig(fig, event, kind)
+
+def local_reconstruction_xleft_xright(layout,i,opts,track=None,archive=None,budget=None):
 #local reconstructions in parallel with processing
+#chi squared of the segments is stored in track if provided, NaN for chambers without a segment
+#combinatorial segments are limited by the compute budget if provided
     df = pd.DataFrame()
+    n = layout.events[i]
     rej_count = 0
     accepted = 0
-    xl0 = pd.DataFrame(data[data['SL'] == 0],columns = ('X_POS_LEFT','Z_POS'))
-    xr0 = pd.DataFrame(data[data['SL'] == 0],columns = ('X_POS_RIGHT','Z_POS'))
-    xl0 = xl0.rename({'X_POS_LEFT':'x','Z_POS':'y'},axis = 1)
-    xr0 = xr0.rename({'X_POS_RIGHT':'x','Z_POS':'y'},axis = 1)
-    pts0 = pd.concat([xl0,xr0])
-    xl1 = pd.DataFrame(data[data['SL'] == 1],columns = ('X_POS_LEFT','Z_POS'))
-    xr1 = pd.DataFrame(data[data['SL'] == 1],columns = ('X_POS_RIGHT','Z_POS'))
-    xl1 = xl1.rename({'X_POS_LEFT':'x','Z_POS':'y'},axis = 1)
-    xr1 = xr1.rename({'X_POS_RIGHT':'x','Z_POS':'y'},axis = 1)
-    pts1 = pd.concat([xl1,xr1])
-    xl2 = pd.DataFrame(data[data['SL'] == 2],columns = ('X_POS_LEFT','Z_POS'))
-    xr2 = pd.DataFrame(data[data['SL'] == 2],columns = ('X_POS_RIGHT','Z_POS'))
-    xl2 = xl2.rename({'X_POS_LEFT':'x','Z_POS':'y'},axis = 1)
-    xr2 = xr2.rename({'X_POS_RIGHT':'x','Z_POS':'y'},axis = 1)
-    pts2 = pd.concat([xl2,xr2])
-    xl3 = pd.DataFrame(data[data['SL'] == 3],columns = ('X_POS_LEFT','Z_POS'))
-    xr3 = pd.DataFrame(data[data['SL'] == 3],columns = ('X_POS_RIGHT','Z_POS'))
-    xl3 = xl3.rename({'X_POS_LEFT':'x','Z_POS':'y'},axis = 1)
-    xr3 = xr3.rename({'X_POS_RIGHT':'x','Z_POS':'y'},axis = 1)
-    pts3 = pd.concat([xl3,xr3])
-              
     #filter out events where a chamber didn't have enough hits for a reconstruction
-    if len(pts0) == 0 or len(pts1) == 0 or len(pts2) == 0 or len(pts3) == 0:
+    if not (layout.sl_sizes()[i] > 0).all():
         #print('Invalid event: One or more chambers had no hits')
+        return df,accepted
+    pts0, pts1, pts2, pts3 = [chamber_points(layout, i, sl) for sl in range(4)]
+              
+    #return a local reconstruction (reconstruction within 1 chamber) for each event
+    find_segment = SEGMENT_FINDERS[opts.segments]
+    if find_segment is find_fit:
+        find_segment = lambda pts: find_fit(pts, budget)
+    x0,z0,fit0,chi0 = find_segment(pts0)
+    x1,z1,fit1,chi1 = find_segment(pts1)
+    x2,z2,fit2,chi2 = find_segment(pts2)
+    x3,z3,fit3,chi3 = find_segment(pts3)
+    for sl, segment in enumerate([(x0,z0,fit0,chi0), (x1,z1,fit1,chi1), (x2,z2,fit2,chi2), (x3,z3,fit3,chi3)]):
+        DQM.fill_segment(*segment)
+        if track is not None:
+            track['CHISQ_LOCAL_{0:d}'.format(sl)] = segment[3] if len(segment[0]) else np.nan
+            
+    #filter out events with fits below the chi squared threshold
+    if len(x0) == 0 or len(x1) == 0 or len(x2) == 0 or len(x3) == 0:
+        #print('This event had no good fits')
         rej_count += 1
+            
+    #put the relevant information into a dataframe
     else:
-        #return a local reconstruction (reconstruction within 1 chamber) for each event
-        x0,z0,fit0,chi0 = find_fit(pts0)
-        x1,z1,fit1,chi1 = find_fit(pts1)
-        x2,z2,fit2,chi2 = find_fit(pts2)
-        x3,z3,fit3,chi3 = find_fit(pts3)
-                
-        #filter out events with fits below the chi squared threshold
-        if len(x0) == 0 or len(x1) == 0 or len(x2) == 0 or len(x3) == 0:
-            #print('This event had no good fits')
-            rej_count += 1
-                
-        #put the relevant information into a dataframe
-        else:
-            accepted += 1
+        accepted += 1
+        if not opts.no_plots:
+            plt = pyplot()
             fig1,axes = plt.subplots(nrows = 2,ncols = 2,figsize =(8,8),constrained_layout=True)
             axes[0,0].plot(fit0,z0)
             axes[0,0].scatter(x0,z0,color = 'black',marker = '.')
             axes[0,0].set_title('Event '+str(n)+' Chamber 1')
             axes[0,0].set_xlim(min(x0)-5,max(x0)+5)
-            axes[0,0].set_ylim(0, 52)
+            axes[0,0].set_ylim(0, GEOMETRY.height)
             axes[0,1].plot(fit1,z1)
             axes[0,1].scatter(x1,z1,color = 'black',marker = '.')
             axes[0,1].set_title('Event '+str(n)+' Chamber 2')
             axes[0,1].set_xlim(min(x1)-5,max(x1)+5)
-            axes[0,1].set_ylim(0, 52)
+            axes[0,1].set_ylim(0, GEOMETRY.height)
             axes[1,0].plot(fit2,z2)
             axes[1,0].scatter(x2,z2,color = 'black',marker = '.')
             axes[1,0].set_title('Event '+str(n)+' Chamber 3')
             axes[1,0].set_xlim(min(x2)-5,max(x2)+5)
-            axes[1,0].set_ylim(0, 52)
+            axes[1,0].set_ylim(0, GEOMETRY.height)
             axes[1,1].plot(fit3,z3)
             axes[1,1].scatter(x3,z3,color = 'black',marker = '.')
             axes[1,1].set_title('Event '+str(n)+' Chamber 4')
             axes[1,1].set_xlim(min(x3)-5,max(x3)+5)
-            axes[1,1].set_ylim(0, 52)
+            axes[1,1].set_ylim(0, GEOMETRY.height)
             label = 'Local Reconstructions: Event '+str(n)
-            fig1.savefig('plots/'+label+'.png')
+            save_plot(fig1, label, n, 'local', archive)
             plt.close(fig1)
-            ch1 = x0+z0
-            ch2 = x1+list(np.asarray(z1)+4*ZCELL)
-            ch3 = x2+list(np.asarray(z2)+Z_SEP)
-            ch4 = x3+list(np.asarray(z3)+4*ZCELL+Z_SEP)
-            chambs = [ch1,ch2,ch3,ch4]
-                    
-            for i in np.arange(len(chambs)):
-                df2 = pd.DataFrame(chambs[i],dtype = float)
-                df = df.append(df2.T,ignore_index = True)
+        ch1 = x0+z0
+        ch2 = x1+list(np.asarray(z1)+GEOMETRY.chamber_z[1])
+        ch3 = x2+list(np.asarray(z2)+GEOMETRY.chamber_z[2])
+        ch4 = x3+list(np.asarray(z3)+GEOMETRY.chamber_z[3])
+        chambs = [ch1,ch2,ch3,ch4]
+                
+        for i in np.arange(len(chambs)):
+            df2 = pd.DataFrame(chambs[i],dtype = float)
+            df = df.append(df2.T,ignore_index = True)
 
     return df,accepted
 
-def total_reconstruction(df,n,fig):
+def total_reconstruction(df,n,fig,opts,track=None,archive=None):
 #reconstructing paths in parallel with Nazar's processing
+#chi squared and slopes of the track are stored in track if provided
     count = len(df.index)
     accepted = 0
     j = 0
@@ -515,6 +584,10 @@ def total_reconstruction(df,n,fig):
         y2new = y2+y4
         z2new = z2+z4
         x2new,chisq2,_,_,_ = np.polyfit(y2new,z2new,1,full = True)
+        DQM.fill('chisq_2d', np.concatenate([chisq1, chisq2])/2)
+        if track is not None:
+            track['CHISQ_2D_X'] = float(chisq1/2)
+            track['CHISQ_2D_Y'] = float(chisq2/2)
 
         if float(chisq1/2) < chisq_2d and float(chisq2/2) < chisq_2d:
             x1.extend(x2)
@@ -533,42 +606,55 @@ def total_reconstruction(df,n,fig):
             A_yz = np.vstack((y1, np.ones(len(y1)))).T
             m_yz,chiy,_,_ = np.linalg.lstsq(A_yz, z1,rcond=None)
 
+            DQM.fill('chisq_3d', np.concatenate([chix, chiy])/3)
+            if track is not None:
+                track['CHISQ_3D_X'] = float(chix/3)
+                track['CHISQ_3D_Y'] = float(chiy/3)
             if chix/3 < chisq_3d and chiy/3 < chisq_3d:
-                #calculate points along the intersection of the planes to get best fit line for data overall
-                z_final = np.linspace(0,888)
-                x_final = (z_final - m_xz[1])/m_xz[0]
-                y_final = (z_final - m_yz[1])/m_yz[0]
-                label = 'Event '+str(n)
-                #fig = plt.figure(figsize =(6,6))
-                ax = fig.add_subplot(111, projection='3d')
-                ax.scatter(x1,y1,z1)
-                ax.plot(x_final,y_final,z_final,label = label)
-                ax.set_xlabel("X")
-                ax.set_ylabel("Y")
-                ax.set_zlabel("Z")
-                ax.set_title(label)
-                # set limits of the axes so that they match the dimensions of the chambers
-                ax.set_xlim(0, 693)
-                ax.set_ylim(0, 693)
-                ax.set_proj_type('ortho')
-                fig.savefig('plots/'+label+'.png')
+                # Slopes dx/dz and dy/dz of the track from the planes z = m*x + c
+                DQM.fill('slope_xz', [1./m_xz[0]])
+                DQM.fill('slope_yz', [1./m_yz[0]])
+                if track is not None:
+                    track['SLOPE_XZ'] = 1./m_xz[0]
+                    track['SLOPE_YZ'] = 1./m_yz[0]
                 accepted += 1
-                plt.clf()
-                plt.close(fig)
+                if not opts.no_plots:
+                    plt = pyplot()
+                    #calculate points along the intersection of the planes to get best fit line for data overall
+                    z_final = np.linspace(0,888)
+                    x_final = (z_final - m_xz[1])/m_xz[0]
+                    y_final = (z_final - m_yz[1])/m_yz[0]
+                    label = 'Event '+str(n)
+                    #fig = plt.figure(figsize =(6,6))
+                    ax = fig.add_subplot(111, projection='3d')
+                    ax.scatter(x1,y1,z1)
+                    ax.plot(x_final,y_final,z_final,label = label)
+                    ax.set_xlabel("X")
+                    ax.set_ylabel("Y")
+                    ax.set_zlabel("Z")
+                    ax.set_title(label)
+                    # set limits of the axes so that they match the dimensions of the chambers
+                    ax.set_xlim(0, GEOMETRY.width)
+                    ax.set_ylim(0, GEOMETRY.width)
+                    ax.set_proj_type('ortho')
+                    save_plot(fig, label, n, 'global', archive)
+                    # Clearing the figure shared by all events, which would otherwise pile up the axes of every event
+                    fig.clf()
+                    plt.close(fig)
                
         j += 4
     return accepted
 
-def reconstruct(df,n,fig):
+def reconstruct(layout,i,fig,opts,track=None,archive=None,budget=None):
  #version of reconstruction that runs simultaneously with processing
-    data,local = local_reconstruction_xleft_xright(df,n)
+    data,local = local_reconstruction_xleft_xright(layout,i,opts,track,archive,budget)
     if len(data.index) != 0:
-        count = total_reconstruction(data,n,fig)
+        count = total_reconstruction(data,layout.events[i],fig,opts,track,archive)
         return local,count
     else:
         return local,0
 
-def local_reconstruction_all(path):
+def local_reconstruction_all(path,opts):
     df= pd.DataFrame(columns = np.arange(20))
     rej_count = 0
     events = 0
@@ -623,10 +709,11 @@ def local_reconstruction_all(path):
                 continue
             
             #return a local reconstruction (reconstruction within 1 chamber) for each event
-            x0,z0,fit0,chi0 = find_fit(pts0)
-            x1,z1,fit1,chi1 = find_fit(pts1)
-            x2,z2,fit2,chi2 = find_fit(pts2)
-            x3,z3,fit3,chi3 = find_fit(pts3)
+            find_segment = SEGMENT_FINDERS[opts.segments]
+            x0,z0,fit0,chi0 = find_segment(pts0)
+            x1,z1,fit1,chi1 = find_segment(pts1)
+            x2,z2,fit2,chi2 = find_segment(pts2)
+            x3,z3,fit3,chi3 = find_segment(pts3)
                 
             #filter out events with fits below the chi squared threshold
             if len(x0) == 0 or len(x1) == 0 or len(x2) == 0 or len(x3) == 0:
@@ -635,9 +722,9 @@ def local_reconstruction_all(path):
             #put the relevant information into a dataframe
             else:
                 ch1 = x0+z0
-                ch2 = x1+list(np.asarray(z1)+4*ZCELL)
-                ch3 = x2+list(np.asarray(z2)+Z_SEP)
-                ch4 = x3+list(np.asarray(z3)+4*ZCELL+Z_SEP)
+                ch2 = x1+list(np.asarray(z1)+GEOMETRY.chamber_z[1])
+                ch3 = x2+list(np.asarray(z2)+GEOMETRY.chamber_z[2])
+                ch4 = x3+list(np.asarray(z3)+GEOMETRY.chamber_z[3])
                 ch1.insert(0,events)
                 ch2.insert(0,events)
                 ch3.insert(0,events)
@@ -653,6 +740,8 @@ def local_reconstruction_all(path):
     return df
 
 def total_reconstruction_all(df,start,end):
+    plt = pyplot()
+    from mpl_toolkits.mplot3d import Axes3D
     plt.close('all')
     fig = plt.figure(figsize =(6,6))
     ax = Axes3D(fig)
@@ -725,156 +814,261 @@ def total_reconstruction_all(df,start,end):
                     label = 'Event '+str(event_nr)
                     ax.scatter(x1,y1,z1)
                     ax.plot(x_final,y_final,z_final,label = label)
-                    ax.set_xlim(0, 693)
-                    ax.set_ylim(0, 693)
+                    ax.set_xlim(0, GEOMETRY.width)
+                    ax.set_ylim(0, GEOMETRY.width)
                     ax.legend(loc = 'upper left')
 
         j+=4
     #print('Events With Acceptable Global Reconstruction: '+str(accepted)+' out of '+str(count//4))
     plt.show()
 
-def reconstruct_all(filein,start = 0,end = None):
+def reconstruct_all(filein,opts,start = 0,end = None):
     #version of reconstruct that runs after processing to plot multiple events together if desired
-    data = local_reconstruction_all(filein)
+    data = local_reconstruction_all(filein,opts)
     total_reconstruction_all(data,start,end)
 
-def save_root(dfs, df_events, output_path,start,end):
-    """Prints output to a text file with one event per line, sequence of hits in a line"""
-    if not dfs:
+def save_root(dfhits, df_events, output_path,start,end,opts,writer=None,quicklook=None,cutflow=None,profiler=None,budget=None):
+    """Prints output to a text file with one event per line, sequence of hits in a line
+
+    Events are queued to the given AsyncTextWriter instead if provided, which is then left open.
+    Written and reconstructed events of each sampled block are counted in quicklook if provided,
+    events passing each reconstruction cut in cutflow. The chi squared and slopes of every written
+    event are saved to <output>_tracks.csv for the query service. Each event is timed by the
+    EventProfiler and reconstructed within the ComputeBudget if provided.
+    """
+    if len(dfhits) == 0:
         print('WARNING: No hits for writing into a text file')
-        return
-    # Concatenating dataframe from different SLs
-    df_all = pd.concat(dfs)
+        return 0, 0, 0
+    profiler = profiler or EventProfiler()
+    budget = budget or ComputeBudget()
     # Selecting only physical or trigger hits [for writing empty events as well]
-    df_all = df_all[(df_all['TIME0'] > 0) | ((df_all['FPGA'] == CHANNEL_TRIGGER[0]) & (df_all['TDC_CHANNEL'] == CHANNEL_TRIGGER[1]))]
-    events = df_all.groupby('EVENT_NR')
-    local_count = 0
-    global_count = 0
+    df_all = dfhits[(dfhits['TIME0'] > 0) | ((dfhits['FPGA'] == CHANNEL_TRIGGER[0]) & (dfhits['TDC_CHANNEL'] == CHANNEL_TRIGGER[1]))]
+    layout = EventLayout(df_all, columns=['X_POS_LEFT', 'X_POS_RIGHT', 'Z_POS', 'ORBIT_CNT'])
+    occupancy = EventOccupancy.from_hits(df_all)
     if end == None:
         start = int(start)
-        end = len(events)
+        end = len(layout)
     else:
         start = int(start)
-        end = int(end)
-    layers = range(4)
-    print('### Writing {0:d} events to file: {1:s}'.format(end, output_path))
+        end = min(int(end), len(layout))
+    # Physical hits of the events in the range, grouped by event and SL in the order of the input
+    event_nr = df_all['EVENT_NR'].values
+    event_ids = layout.events[start:end]
+    ch_sel = (df_all['TDC_CHANNEL'] != CHANNEL_TRIGGER[1]).values & np.isin(event_nr, event_ids)
+    hit_events = np.searchsorted(event_ids, event_nr[ch_sel])
+    order = np.lexsort((df_all['SL'].values[ch_sel], hit_events))
+    hits = np.column_stack([df_all[col].values[ch_sel].astype(np.float64) for col in HIT_COLUMNS])[order]
+    nhits = np.bincount(hit_events, minlength=len(event_ids))
+    DQM.fill('hits_per_event', nhits)
+    print('### Writing {0:d} events to file: {1:s}'.format(len(event_ids), output_path))
     print('### Reconstructing events...')
-    with open(output_path, 'w') as outfile:
-        fig = plt.figure(figsize =(6,6))
-        i = 0
-        for event, df in events:
-            if start <= i < end:
-                local,globe = reconstruct(df,event,fig)
-                ch_sel = (df['TDC_CHANNEL'] != CHANNEL_TRIGGER[1])
-                n_layer_hits = df.loc[ch_sel].sort_values('SL').groupby('SL').size().reindex(layers).fillna(0).astype(int).tolist()
-                nhits = df.loc[ch_sel].shape[0]
-                orbit, tzero = df.iloc[0][['ORBIT_CNT', 'TIME0']]
-                # Merging all hits
-                line = '{0:d} {1:d}'.format(event, nhits)
-                if nhits > 0:
-                    line += ' ' + ' '.join(['{0:.0f} {1:.0f} {2:.8f} {3:.8f} {4:.1f}'.format(*values)
-                                           for values in df.loc[ch_sel, ['SL','LAYER', 'X_POS_LEFT', 'X_POS_RIGHT','Z_POS']].values])
-                outfile.write(line+'\n')
-                i += 1
-                local_count += local
-                global_count += globe
-
-    print('### Locally Reconstructed '+str(local_count)+' out of '+str(i)+' events in the range given')
+    # Formatting and writing the text output in the background while reconstructing
+    orbits = np.minimum.reduceat(layout.columns['ORBIT_CNT'], layout.offsets[:-1]) if len(layout) else np.zeros(0, dtype=np.uint32)
+    if quicklook is not None:
+        monitor = DQM.monitor
+    # Local and global reconstruction of each event in the range, with the chi squared and slopes of its track
+    reco = np.zeros((max(end - start, 0), 2), dtype=bool)
+    fitted = np.full((len(reco), len(TRACK_FIT_COLUMNS)), np.nan)
+    degraded = np.zeros(len(reco), dtype=np.int64)
+    def reconstruct_events(idx):
+        for i in idx:
+            # Histograms of each sampled block are filled separately for the sampling uncertainties
+            if quicklook is not None:
+                DQM.use(quicklook.monitor(orbits[i]))
+            track = {}
+            with profiler.event('reconstruct', layout.events[i], lambda: df_all.loc[layout.index[layout.rows(i)]]), budget.event() as work:
+                reco[i - start] = reconstruct(layout,i,fig,opts,track,archive,budget)
+            degraded[i - start] = work.flags
+            fitted[i - start] = [track.get(name, np.nan) for name in TRACK_FIT_COLUMNS]
+        return reco[idx - start]
+    selection = Selection()
+    selection.quantity('n_layers', lambda idx: occupancy.n_layers()[idx])
+    selection.quantity('reconstruction', reconstruct_events)
+    selection.cut('all_chambers', lambda n: (n > 0).all(axis=1), needs=['n_layers'])
+    selection.cut('local', lambda reco: reco[:, 0], needs=['reconstruction'], cost=COST_PER_EVENT)
+    selection.cut('global', lambda reco: reco[:, 1], needs=['reconstruction'], cost=COST_PER_EVENT)
+    own_writer = writer is None
+    if own_writer:
+        writer = AsyncTextWriter(output_path)
+    # Plots of all events in a few PDF files instead of 2 PNG files per event
+    archive = None
+    if not opts.no_plots and opts.plots == 'pdf':
+        archive = PlotArchive(os.path.splitext(output_path)[0]+'_plots')
+    try:
+        writer.write_batches(event_ids, nhits, hits)
+        fig = None if opts.no_plots else pyplot().figure(figsize =(6,6))
+        selection.apply(np.arange(start, end), cutflow)
+    finally:
+        if own_writer:
+            writer.close()
+        if archive is not None:
+            archive.close()
+            print('### Saved {0:d} event plots to {1:d} files: {2:s}_*.pdf, index {2:s}.csv'.format(len(archive), len(archive.files), archive.base))
+        if quicklook is not None:
+            DQM.use(monitor)
+    if quicklook is not None:
+        for block_monitor in quicklook.monitors.values():
+            DQM.merge(block_monitor)
+        quicklook.fill('written', orbits[start:end])
+        quicklook.fill('local', orbits[start:end][reco[:, 0]])
+        quicklook.fill('global', orbits[start:end][reco[:, 1]])
+    local_count = int(reco[:, 0].sum())
+    global_count = int(reco[:, 1].sum())
+    flag_events(df_events, event_ids, degraded)
+    degraded |= df_events['DEGRADED'].reindex(event_ids, fill_value=0).values.astype(np.int64)
+    # Bit mask of the chambers with hits in each event
+    chambers = ((occupancy.channels[start:end] != 0) << np.arange(4)).sum(axis=1)
+    tracks = dict([('EVENT_NR', event_ids), ('ORBIT_CNT', orbits[start:end]), ('NHITS', nhits), ('CHAMBERS', chambers),
+                   ('LOCAL', reco[:, 0].astype(np.uint8)), ('GLOBAL', reco[:, 1].astype(np.uint8)), ('DEGRADED', degraded)])
+    tracks.update([(name, fitted[:, k]) for k, name in enumerate(TRACK_FIT_COLUMNS)])
+    save_tracks(os.path.splitext(output_path)[0]+'_tracks.csv', tracks)
+
+    print('### Locally Reconstructed '+str(local_count)+' out of '+str(len(event_ids))+' events in the range given')
     print('### Globally Reconstructed '+str(global_count)+' out of '+str(local_count)+' events in the range given')
+    return len(event_ids), local_count, global_count
 
 ############################################# READING DATA FROM CSV INPUT
-def read_data(input_files):
+def read_file(job):
+    """Reads a single input file in a worker process and returns its selected hits as column arrays"""
+    file, nrows, prescale, mask = job
+    skipLines = 0
+    if 'data_000000' in file:
+        skipLines = range(1,131072)
+    df = pd.read_csv(file, nrows=nrows, skiprows=skipLines, engine='c')
+    # Removing possible incomplete rows e.g. last line of last file
+    df.dropna(inplace=True)
+    nhits_read = df.shape[0]
+    # Converting to memory-optimised data types
+    for name in ['HEAD', 'FPGA', 'TDC_CHANNEL', 'TDC_MEAS']:
+        df[name] = df[name].astype(np.uint8)
+    for name in ['BX_COUNTER']:
+        df[name] = df[name].astype(np.uint16)
+    for name in ['ORBIT_CNT']:
+        df[name] = df[name].astype(np.uint32)
+    # retain all words with HEAD=1 and remove hits with TDC_CHANNEL 139
+    sel = ((df['HEAD'] == 1) & (df['TDC_CHANNEL'] != 139)).values
+    # Skipping orbits outside the sampled blocks before any further processing
+    if prescale > 1:
+        sel &= sampled(df['ORBIT_CNT'].values, prescale)
+    # Dropping hits of noisy and dead channels
+    if mask is not None:
+        sel &= ~masked(df['FPGA'].values, df['TDC_CHANNEL'].values, mask)
+    # Returning plain arrays without the HEAD column to keep the transfer to the parent process small
+    columns = {name: df[name].values[sel] for name in df.columns if name != 'HEAD'}
+    return columns, nhits_read
+
+
+def read_files(input_files, nrows=None, processes=None, prescale=1, mask=None):
+    """Reads input files in a pool of worker processes and concatenates their hits stream by stream
+
+    Each file is a time-ordered stream, and the streams follow each other in the order of their first orbit.
+    Streams can overlap in time, so the table is not in orbit order: build_events merges the streams
+    using the returned offsets of their first hits, and calc_event_numbers sorts the hits it needs.
+    Hits in the channels of mask [positions in the geometry tables] are dropped while reading
+    """
+    jobs = [(file, nrows, prescale, mask) for file in input_files]
+    if processes is None:
+        processes = min(len(jobs), os.cpu_count() or 1)
+    if processes > 1 and len(jobs) > 1:
+        pool = Pool(processes)
+        try:
+            chunks = pool.map(read_file, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        chunks = [read_file(job) for job in jobs]
+    nhits_read = sum(nhits for _, nhits in chunks)
+    # Concatenating the time-ordered streams in the order of their first orbit [overlapping streams are not merged here]
+    chunks = [columns for columns, _ in chunks if len(columns['ORBIT_CNT']) > 0]
+    chunks.sort(key=lambda columns: columns['ORBIT_CNT'][0])
+    # Position of the first hit of each stream in the merged table
+    offsets = np.cumsum([0] + [len(chunk['ORBIT_CNT']) for chunk in chunks[:-1]]) if chunks else np.zeros(0, dtype=np.int64)
+    if not chunks:
+        columns = {name: np.empty(0, dtype=dtype) for name, dtype in [
+            ('FPGA', np.uint8), ('TDC_CHANNEL', np.uint8), ('ORBIT_CNT', np.uint32), ('BX_COUNTER', np.uint16), ('TDC_MEAS', np.uint8)]}
+    else:
+        columns = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+    return pd.DataFrame(columns), nhits_read, offsets
+
+
+def absolute_time(hits):
+    """Absolute time in ns of each hit from its orbit, BX and TDC counters"""
+    return (hits['ORBIT_CNT'].astype(np.float64)*DURATION['orbit'] + 
+            hits['BX_COUNTER'].astype(np.float64)*DURATION['bx'] + 
+            hits['TDC_MEAS'].astype(np.float64)*DURATION['tdc']).astype(np.float64)
+
+
+def read_data(input_files, opts, quicklook=None, cutflow=None, profiler=None, budget=None):
     """
     Reading data from CSV file into a Pandas dataframe, applying selection and sorting
+
+    Hits, events and accepted events of each sampled block are counted in quicklook if provided,
+    events passing each cut in cutflow, the meantimer being timed by profiler within budget
     """
-    # Reading each file and merging into 1 dataframe
-    hits = []
-    for index, file in enumerate(input_files):
-        skipLines = 0
-        if 'data_000000' in file:
-            skipLines = range(1,131072)
-        df = pd.read_csv(file, nrows=args.number, skiprows=skipLines, engine='c')
-        # Removing possible incomplete rows e.g. last line of last file
-        df.dropna(inplace=True)
-        # Converting to memory-optimised data types
-        for name in ['HEAD', 'FPGA', 'TDC_CHANNEL', 'TDC_MEAS']:
-            df[name] = df[name].astype(np.uint8)
-        for name in ['BX_COUNTER']:
-            df[name] = df[name].astype(np.uint16)
-        for name in ['ORBIT_CNT']:
-            df[name] = df[name].astype(np.uint32)
-        hits.append(df)
-    allhits = pd.concat(hits, ignore_index=True, copy=False)
+    mask = None
+    if opts.channel_mask:
+        mask = load_mask(opts.channel_mask)
+        print('### Masking {0:d} noisy and dead channels from file: {1:s}'.format(len(mask), opts.channel_mask))
+    # Reading files in parallel and merging into 1 dataframe
+    allhits, nhits_read, streams = read_files(input_files, nrows=opts.number, processes=opts.processes, prescale=opts.prescale, mask=mask)
     df_events = None
-    print('### Read {0:d} hits from {1:d} input files'.format(allhits.shape[0], len(hits)))
-    # retain all words with HEAD=1
-    allhits.drop(allhits.index[allhits['HEAD'] != 1], inplace=True)
-    # Removing hits with TDC_CHANNEL 139
-    allhits.drop(allhits.index[allhits['TDC_CHANNEL'] == 139], inplace=True)
-    # Removing unused columns to save memory foot-print
-    allhits.drop('HEAD', axis=1, inplace=True)
+    print('### Read {0:d} hits from {1:d} input files'.format(nhits_read, len(input_files)))
     ### # Increase output of all channels with id below 130 by 1 ns --> NOT NEEDED
     ### allhits.loc[allhits['TDC_CHANNEL'] <= 130, 'TDC_MEAS'] = allhits['TDC_MEAS']+1 
     # Calculate absolute time in ns of each hit
-    allhits['TIME_ABS'] = (allhits['ORBIT_CNT'].astype(np.float64)*DURATION['orbit'] + 
-                           allhits['BX_COUNTER'].astype(np.float64)*DURATION['bx'] + 
-                           allhits['TDC_MEAS'].astype(np.float64)*DURATION['tdc']).astype(np.float64)
+    allhits['TIME_ABS'] = absolute_time(allhits)
     # Adding columns to be calculated
     nHits = allhits.shape[0]
     allhits['TIME0'] = np.zeros(nHits, dtype=np.float64)
     allhits['EVENT_NR'] = np.ones(nHits, dtype=np.uint32) * -1
-    # Calculating additional info about the hits
-    conditions  = [
-        (allhits['TDC_CHANNEL'] % 4 == 1 ),
-        (allhits['TDC_CHANNEL'] % 4 == 2 ),
-        (allhits['TDC_CHANNEL'] % 4 == 3 ),
-        (allhits['TDC_CHANNEL'] % 4 == 0 ),
-    ]
-    chanshift_x = [  0,            -1,           0,            -1,        ]
-    layer_z     = [  1,            3,            2,            4,         ]
-    pos_z       = [  ZCELL*3.5,    ZCELL*1.5,    ZCELL*2.5,    ZCELL*0.5, ]
-    posshift_x  = [  0,            0,            0.5,          0.5,       ]
-    # Adding columns
-    allhits['LAYER']      = np.select(conditions, layer_z,      default=0).astype(np.uint8)
-    allhits['X_CHSHIFT']  = np.select(conditions, chanshift_x,  default=0).astype(np.int8)
-    allhits['X_POSSHIFT'] = np.select(conditions, posshift_x,   default=0).astype(np.float16)
-    allhits['Z_POS']      = np.select(conditions, pos_z,        default=0).astype(np.float16)
-
-    # conditions  = FPGA number and TDC_CHANNEL in range
-    # SL         <- superlayer = chamber number from 0 to 3 (0,1 FPGA#0 --- 2,3 FPGA#1)
-    conditions_SL = [
-        ((allhits['FPGA'] == 0) & (allhits['TDC_CHANNEL'] <= NCHANNELS )),
-        ((allhits['FPGA'] == 0) & (allhits['TDC_CHANNEL'] > NCHANNELS ) & (allhits['TDC_CHANNEL'] <= 2*NCHANNELS )),
-        ((allhits['FPGA'] == 1) & (allhits['TDC_CHANNEL'] <= NCHANNELS )),
-        ((allhits['FPGA'] == 1) & (allhits['TDC_CHANNEL'] > NCHANNELS ) & (allhits['TDC_CHANNEL'] <= 2*NCHANNELS )),
-    ]
-    allhits['SL'] = np.select(conditions_SL, [0, 1, 2, 3], default=-1).astype(np.int8)
+    # Calculating additional info about the hits from the precomputed channel maps
+    geo_idx = GEOMETRY.assign(allhits)
     # Correcting absolute time by per-chamber latency
-    for sl in range(4):
-        sel = allhits['SL'] == sl
-        allhits.loc[sel, 'TIME_ABS'] = allhits.loc[sel, 'TIME_ABS'] + TIME_OFFSET_SL[sl]
-
-    # define channel within SL
-    allhits['TDC_CHANNEL_NORM'] = (allhits['TDC_CHANNEL'] - NCHANNELS * (allhits['SL']%2)).astype(np.uint8)
+    allhits['TIME_ABS'] += GEOMETRY.lookup('time_offset', geo_idx)
+    # Filling occupancy of all physical channels before any selection
+    sl, ch = allhits['SL'].values, allhits['TDC_CHANNEL_NORM'].values
+    physical = (sl >= 0) & (ch >= 1) & (ch <= NCHANNELS)
+    DQM.fill('channel_occupancy', sl[physical].astype(np.int64)*NCHANNELS + ch[physical] - 1)
+    if quicklook is not None:
+        quicklook.set_orbits(allhits['ORBIT_CNT'].values)
+        for s in range(4):
+            quicklook.fill('hits_sl{0:d}'.format(s), allhits['ORBIT_CNT'].values[physical & (sl == s)])
+    # Removing repeated hits in the same channel, which multiply the candidates of meantimer and local fits
+    if opts.clean:
+        keep, n_duplicates, n_afterpulses = clean_hits(allhits, remove_afterpulses=(opts.clean == 'afterpulses'))
+        # Positions of the first hit of each stream among the remaining hits
+        streams = np.searchsorted(np.flatnonzero(keep), streams)
+        print('### Removed {0:d} hits: {1:d} duplicates, {2:d} afterpulses {3:s}'.format(
+            int((~keep).sum()), n_duplicates, n_afterpulses, 'removed' if opts.clean == 'afterpulses' else 'tagged and kept'))
 
     # Detecting events based on EVENT_NR signals
-    if args.event:
-        df_events = calc_event_numbers(allhits)
+    if opts.event:
+        df_events = calc_event_numbers(allhits, opts)
     # Assigning orbit counter as event number
     else:
-        # Grouping hits separated by large time gaps together
-        allhits.sort_values('TIME_ABS', inplace=True)
-        grp = allhits['TIME_ABS'].diff().fillna(0)
-        grp[grp <= 1.1*TDRIFT] = 0
-        grp[grp > 0] = 1
-        grp = grp.cumsum().astype(np.int32)
-        allhits['EVENT_NR'] = grp
-        events = allhits.groupby('EVENT_NR')
-        nHits = events.size()
-        nHits_unique = events['TDC_CHANNEL'].nunique()
-        nSL = events['SL'].nunique()
-        # Selecting only events with manageable numbers of hits
-        events = nHits.index[(nSL >= args.chambers) & (nHits_unique >= (MEANTIMER_CLUSTER_SIZE * 3)) & (nHits <= args.max_hits)]
+        # Grouping hits separated by large time gaps together while merging the time-ordered input files
+        allhits['EVENT_NR'] = build_events(allhits['TIME_ABS'].values, streams, 1.1*TDRIFT)
+        numbers, event_idx, nHits = np.unique(allhits['EVENT_NR'].values, return_inverse=True, return_counts=True)
+        def n_different(column):
+            # Numbers of different values of a column in the given events, counted only over their hits
+            values = allhits[column].values
+            def count(idx):
+                sel = np.isin(event_idx, idx)
+                return pd.Series(values[sel]).groupby(event_idx[sel]).nunique().reindex(idx, fill_value=0).values
+            return count
+        # Selecting only events with manageable numbers of hits [the Hough segment finder copes with any number]
+        max_hits = opts.max_hits
+        if max_hits is None:
+            max_hits = 200 if opts.segments == 'combinatorial' else np.inf
+        selection = Selection()
+        selection.quantity('n_hits', lambda idx: nHits[idx])
+        selection.quantity('n_sl', n_different('SL'))
+        selection.quantity('n_channels', n_different('TDC_CHANNEL'))
+        selection.cut('max_hits', lambda n: n <= max_hits, needs=['n_hits'])
+        selection.cut('chambers', lambda n: n >= opts.chambers, needs=['n_sl'], cost=2.)
+        selection.cut('unique_hits', lambda n: n >= MEANTIMER_CLUSTER_SIZE * 3, needs=['n_channels'], cost=2.)
+        events = numbers[selection.apply(np.arange(len(numbers)), cutflow)]
         # Marking events that don't pass the basic selection
         sel = allhits['EVENT_NR'].isin(events)
         allhits.loc[~sel, 'EVENT_NR'] = -1
@@ -889,6 +1083,8 @@ def read_data(input_files):
     # Calculating event times
     df_events['TIME0_BEFORE'] = df_events['TIME0'].diff().fillna(0)
     df_events['TIME0_AFTER'] = df_events['TIME0'].diff(-1).fillna(0)
+    # Approximations used for the events over the compute budget
+    df_events['DEGRADED'] = 0
     
     # Removing hits with irrelevant tdc channels
     allhits.drop(allhits.index[(allhits['TDC_CHANNEL_NORM'] > NCHANNELS)
@@ -896,8 +1092,12 @@ def read_data(input_files):
                      & (allhits['TDC_CHANNEL'] == CHANNEL_TRIGGER[1])
                  )], inplace=True)
     # Removing events that don't pass acceptance cuts
-    if args.accepted:
-        select_accepted_events(allhits, df_events)
+    if quicklook is not None:
+        quicklook.fill('events', allhits.groupby('EVENT_NR')['ORBIT_CNT'].min().values)
+    if opts.accepted:
+        select_accepted_events(allhits, df_events, opts, cutflow=cutflow, profiler=profiler, budget=budget)
+        if quicklook is not None:
+            quicklook.fill('accepted', allhits.groupby('EVENT_NR')['ORBIT_CNT'].min().values)
     nHits = allhits.shape[0]
     # Adding extra columns to be filled in the analyse method
     allhits['TIMENS'] = np.zeros(nHits, dtype=np.float16)
@@ -908,12 +1108,12 @@ def read_data(input_files):
     #############################################
     ### DATA HANDLING 
 
-    if VERBOSE:
+    if opts.verbosity:
         print('')
         print('dataframe size                   :', len(allhits))
         print('')
 
-    if VERBOSE:
+    if opts.verbosity:
         print('dataframe size (no trigger hits) :', len(allhits))
         print('')
         print('min values in dataframe')
@@ -926,273 +1126,489 @@ def read_data(input_files):
     return allhits, df_events
 
 
-def event_accepted(df, cut_max_hits=False):
-    """Checks whether the event passes acceptance cuts"""
-    # Calculating numbers of hit layers in each chamber
-    nLayers = df.groupby('SL')['LAYER'].agg('nunique')
-    # Skipping events that have no minimum number of chambers with 3+ layers of hits
-    if nLayers[nLayers >= 3].shape[0] < MEANTIMER_SL_MULT_MIN:
-        return False
-    # Calculating numbers of hits in each chamber
-    grp = df.groupby('SL')['TDC_CHANNEL_NORM']
-    nHits = grp.agg('nunique')
-    # Skipping if has at least one chamber with too few hits
-    if nHits[nHits >= NHITS_SL[0]].shape[0] < args.chambers:
-        return False
-    nHits = grp.agg('size')
-    # Skipping if has at least one chamber with too many hits
-    if cut_max_hits and nHits[nHits > NHITS_SL[1]].shape[0] > 0:
-        return False
-    # return True
-    # Skipping events that don't have the minimum number of similar meantimer solutions
-    tzeros_all = {}
-    # Starting from SLs with smallest N of hits
-    sl_ids = nHits.loc[nLayers >= 3].sort_values().index
-    nSLs = len(sl_ids)
-    nSLs_meant = 0
-    event = df.iloc[0]['EVENT_NR']
-    for iSL, SL in enumerate(sl_ids):
-        # Stopping if required number of SLs can't be regardless of the following SLs
-        # if nSLs - iSL + nSLs_meant < MEANTIMER_SL_MULT_MIN:
-        #     break
-        tzeros = meantimer_results(df[df['SL'] == SL])[0]
-        if len(tzeros) > 0:
-            nSLs_meant += 1
-        tzeros_all[SL] = tzeros
-    tzero, tzeros, nSLs = mean_tzero(tzeros_all)
-    if len(tzeros) < MEANTIMER_CLUSTER_SIZE:
-        return False
-    return tzero, tzeros, tzeros_all
-
-
-def select_accepted_events(allhits, events): 
-    """Removes events that don't pass acceptance cuts"""
+def event_meantimers(layout, i, nHits, nLayers, budget=None):
+    """Meantimer t0 solutions of an event, from the numbers of hits and layers of its chambers"""
+    tzeros = []
+    # Collecting meantimer solutions of chambers with 3+ layers, starting from SLs with smallest N of hits
+    for SL in np.argsort(nHits, kind='stable'):
+        if nLayers[SL] < 3:
+            continue
+        rows = layout.rows(i, SL)
+        tzeros_sl = meantimer_results(SL, layout.columns['TDC_CHANNEL_NORM'][rows], layout.columns['TIME_ABS'][rows], budget=budget)[0]
+        tzeros.extend(tzeros_sl)
+    return tzeros
+
+
+def flag_events(df_events, events, flags):
+    """Adds the flags of the approximations used under the compute budget to the DEGRADED column of events"""
+    sel = (flags != 0) & np.isin(events, df_events.index.values)
+    if sel.any():
+        df_events.loc[events[sel], 'DEGRADED'] = df_events.loc[events[sel], 'DEGRADED'].values | flags[sel]
+
+
+def select_accepted_events(allhits, events, opts, cutflow=None, profiler=None, budget=None):
+    """Removes events that don't pass acceptance cuts, counting the events passing each cut in cutflow"""
     print('### Removing events outside acceptance')
+    profiler = profiler or EventProfiler()
+    budget = budget or ComputeBudget()
     hits = allhits[allhits['TDC_CHANNEL_NORM'] <= NCHANNELS]
-    sel = pd.concat([(hits['SL'] == sl) & (hits['TDC_CHANNEL_NORM'].isin(ch)) 
-                    for sl, ch in ACCEPTANCE_CHANNELS.items()], axis=1).any(axis=1)
-    groups = hits[sel].groupby('EVENT_NR')
-    events_accepted = []
-    n_events = len(groups)
-    n_events_processed = 0
+    sel = in_masks(hits['SL'].values, hits['TDC_CHANNEL_NORM'].values, ACCEPTANCE_MASKS)
+    # Applying layer-coverage and chamber-presence cuts to all events at once from their occupancy bitmaps
+    occupancy = EventOccupancy.from_hits(hits)
+    n_events = int(occupancy.any_hits(ACCEPTANCE_MASKS).sum())
     print('### Checking {0:d} events'.format(n_events))
+    if not opts.double_hits:
+        events_ok = occupancy.events[occupancy.accepted(opts.chambers, ACCEPTANCE_MASKS)]
+        sel &= hits['EVENT_NR'].isin(events_ok).values
+        print('### Rejected {0:d} events by occupancy'.format(n_events - len(events_ok)))
+        if cutflow is not None:
+            cutflow.count('acceptance', n_events, len(events_ok))
     events['CELL_HITS_MULT_MAX'] = 1
     events['CELL_HITS_DT_MIN'] = -1
     events['CELL_HITS_DT_MAX'] = -1
-    sl_channels = None
-
-    for event, df in groups:
-        n_events_processed += 1
-        print_progress(n_events_processed, n_events)
-        # Accepting only specified events if provided
-        if args.events and event not in args.events:
-            continue
-        # Selecting only events that have 1+ hits in a single cell
-        if args.double_hits:
-            cellHits = df.groupby(['SL', 'TDC_CHANNEL_NORM'])['TIME_ABS']
-            nHits_max = cellHits.agg('size').max()
-            if nHits_max < 2:
-                continue
-            dt_min = 999
-            dt_max = -1
-            for cell, hits in cellHits:
-                if len(hits) < 2:
-                    continue
-                hits_sorted = np.sort(hits.values)
-                dt_min = min(dt_min, hits_sorted[1] - hits_sorted[0])
-                dt_max = max(dt_max, hits_sorted[-1] - hits_sorted[0])
-            events.loc[event, ['CELL_HITS_MULT_MAX', 'CELL_HITS_DT_MIN', 'CELL_HITS_DT_MAX']] = [nHits_max, dt_min, dt_max]
-            # Accepting the event
-            events_accepted.append(event)
-        # Skipping events that don't have hits exactly in the defined channels
-        channels_ok = True
-        if sl_channels:
-            for sl, chs in sl_channels.items():
-                if sorted(df[df['SL']==sl]['TDC_CHANNEL_NORM'].tolist()) == chs:
-                    continue
-                channels_ok = False
-                break
-            if not channels_ok:
-                continue
-        tzero_result = event_accepted(df, cut_max_hits=args.event)
-        if not tzero_result:
-            continue
-        # Checking event for acceptance with different t0 candidates
-        tzero, tzeros, tzeros_all = tzero_result
-        df_clusters = tzero_clusters(tzeros_all)
-        nClusters = df_clusters['cluster'].nunique()
-        # Skipping event if no t0 cluster found
-        if nClusters < 1:
-            continue
-        tzero = -1.0
-        for cluster_id, df_cluster in df_clusters.groupby('cluster'):
-            if len(df_cluster) < MEANTIMER_CLUSTER_SIZE:
-                continue
-            cluster = df_cluster['t0'].values
-            tzero_cand = cluster.mean()
-            # Trying acceptance cuts with a subset of hits from this orbit within the event time window
-            window = ((df['TIME_ABS'] >= (tzero_cand + TIME_WINDOW[0])) & (df['TIME_ABS'] <= (tzero_cand + TIME_WINDOW[1]))).index
-            tzero_result_cand = event_accepted(df.loc[window], cut_max_hits=True)
-            if not tzero_result_cand:
-                continue
-            tzero = tzero_cand
-            break
-        if tzero < 0:
-            continue
-        # Accepting the event
-        events_accepted.append(event)
-        # Updating the TIME0 with meantimer result
-        if args.update_tzero or not args.event:
-            events.loc[event, 'TIME0'] = tzero
-            if args.event:
-                # Updating t0 of all hits directly if using external trigger
-                allhits.loc[allhits['EVENT_NR'] == event, 'TIME0'] = tzero
-            else:
-                # Removing the old event number and applying only to hits in the window
-                allhits.loc[allhits['EVENT_NR'] == event, 'EVENT_NR'] = -1
-                # Updating t0 of hits in the event time window
-                start = tzero + TIME_WINDOW[0]
-                end = tzero + TIME_WINDOW[1]
-                window = (allhits['TIME_ABS'] >= start) & (allhits['TIME_ABS'] <= end)
-                allhits.loc[window, ['TIME0', 'EVENT_NR']] = [tzero, event]
+    # Selecting only events that have 2+ hits in a single cell, with statistics of such cells calculated for all events at once
+    if opts.double_hits:
+        hits_sel = hits[sel]
+        double_events, nHits_max, dt_min, dt_max = cell_hit_stats(
+            hits_sel['EVENT_NR'].values, hits_sel['SL'].values, hits_sel['TDC_CHANNEL_NORM'].values, hits_sel['TIME_ABS'].values)
+        events.loc[double_events, ['CELL_HITS_MULT_MAX', 'CELL_HITS_DT_MIN', 'CELL_HITS_DT_MAX']] = np.column_stack([nHits_max, dt_min, dt_max])
+        sel &= hits['EVENT_NR'].isin(double_events).values
+        print('### Found {0:d} events with 2+ hits in a cell'.format(len(double_events)))
+    hits = hits[sel]
+    layout = EventLayout(hits, columns=['TDC_CHANNEL_NORM', 'TIME_ABS'])
+    occupancy = EventOccupancy.from_hits(hits)
+    nHits = layout.sl_sizes()
+    nLayers = occupancy.n_layers()
+    events_accepted = []
+    if opts.double_hits:
+        # Accepting the events
+        events_accepted.extend(layout.events[np.isin(layout.events, opts.events)] if opts.events else layout.events)
+    # t0 of the best meantimer cluster of each event, NaN if there is none
+    tzero_all = np.full(len(layout), np.nan)
+    degraded = np.zeros(len(layout), dtype=np.int64)
+    def meantimer_tzeros(idx):
+        # Meantimer solutions of all events, clustered together afterwards
+        tzero_events = []
+        tzero_values = []
+        for n_events_processed, i in enumerate(idx):
+            print_progress(n_events_processed + 1, len(idx))
+            with profiler.event('meantimer', layout.events[i], lambda: hits.loc[layout.index[layout.rows(i)]]), budget.event() as work:
+                tzeros = event_meantimers(layout, i, nHits[i], nLayers[i], budget)
+            degraded[i] = work.flags
+            tzero_events.extend([layout.events[i]]*len(tzeros))
+            tzero_values.extend(tzeros)
+        # Accepting events with a cluster of enough similar meantimer solutions, t0 being the mean of the best cluster
+        clusters = TzeroClusters(tzero_events, tzero_values)
+        tzero_events, best = clusters.best(min_size=MEANTIMER_CLUSTER_SIZE)
+        tzero_all[idx[np.searchsorted(layout.events[idx], tzero_events)]] = clusters.mean[best]
+        return tzero_all[idx]
+    selection = Selection()
+    selection.quantity('event_nr', lambda idx: layout.events[idx])
+    selection.quantity('occupancy', lambda idx: occupancy.accepted(opts.chambers)[idx])
+    selection.quantity('sl_hits', lambda idx: nHits[idx])
+    selection.quantity('tzero', meantimer_tzeros)
+    # Skipping events without enough chambers with 3+ layers or with enough different channels hit
+    selection.cut('occupancy', lambda ok: ok, needs=['occupancy'])
+    # Skipping events with at least one chamber with too many hits
+    selection.cut('sl_hits', lambda n: (n <= NHITS_SL[1]).all(axis=1), needs=['sl_hits'])
+    # Accepting only specified events if provided
+    if opts.events:
+        selection.cut('events', lambda events: np.isin(events, opts.events), needs=['event_nr'])
+    selection.cut('meantimer', lambda tzero: ~np.isnan(tzero), needs=['tzero'], cost=COST_PER_EVENT)
+    events_idx = selection.apply(np.arange(len(layout)), cutflow)
+    flag_events(events, layout.events, degraded)
+    tzero_events = layout.events[events_idx]
+    tzero_values = tzero_all[events_idx]
+    events_accepted.extend(tzero_events)
+    # Updating the TIME0 with meantimer result
+    if opts.update_tzero or not opts.event:
+        events.loc[tzero_events, 'TIME0'] = tzero_values
+    if opts.update_tzero and opts.event:
+        # Updating t0 of all hits directly if using external trigger
+        sel = allhits['EVENT_NR'].isin(tzero_events).values
+        allhits.loc[sel, 'TIME0'] = tzero_values[np.searchsorted(tzero_events, allhits['EVENT_NR'].values[sel])]
+    elif not opts.event:
+        for event, tzero in zip(tzero_events, tzero_values):
+            # Removing the old event number and applying only to hits in the window
+            allhits.loc[allhits['EVENT_NR'] == event, 'EVENT_NR'] = -1
+            # Updating t0 of hits in the event time window
+            start = tzero + TIME_WINDOW[0]
+            end = tzero + TIME_WINDOW[1]
+            window = (allhits['TIME_ABS'] >= start) & (allhits['TIME_ABS'] <= end)
+            allhits.loc[window, ['TIME0', 'EVENT_NR']] = [tzero, event]
     events.drop(events.index[~events.index.isin(events_accepted)], inplace=True)
     allhits.drop(allhits.index[~allhits['EVENT_NR'].isin(events_accepted)], inplace=True)
     print('### Selected {0:d}/{1:d} events in acceptance'.format(len(events_accepted), n_events))
 
 
-def sync_triplets(results, df_events):
-    """Synchronise events from triplet results in different SLs that were processed in parallel"""
-    df_events['MEANTIMER_SL_MULT'] = -1
-    df_events['MEANTIMER_MIN'] = -1
-    df_events['MEANTIMER_MAX'] = -1
-    df_events['MEANTIMER_MEAN'] = -1
-    df_events['MEANTIMER_MULT'] = -1
-    df_events['HITS_MULT'] = -1
-    df_events['HITS_MULT_ACCEPTED'] = -1
-    if not results:
+def chamber_meantimers(layout, i, accepted, budget=None):
+    """Meantimer solutions and angles of the chambers of an event with 3+ layers of hits in the acceptance"""
+    chambers = {}
+    for sl in range(4):
+        rows = layout.rows(i, sl)
+        sel = accepted[rows]
+        # Skipping chambers that don't have 3 layers of hits
+        if len(np.unique(layout.columns['LAYER'][rows][sel])) < 3:
+            continue
+        chambers[sl] = meantimer_results(sl, layout.columns['TDC_CHANNEL_NORM'][rows][sel], layout.columns['TIME_ABS'][rows][sel], budget=budget)
+    return chambers
+
+
+def sync_triplets(hits, meantimer_info, df_events, opts, profiler=None, budget=None):
+    """Synchronise events from triplet results in different SLs"""
+    columns = ['MEANTIMER_MEAN', 'MEANTIMER_MIN', 'MEANTIMER_MAX', 'MEANTIMER_MULT', 'MEANTIMER_SL_MULT']
+    for column in ['MEANTIMER_SL_MULT', 'MEANTIMER_MIN', 'MEANTIMER_MAX', 'MEANTIMER_MEAN', 'MEANTIMER_MULT', 'HITS_MULT', 'HITS_MULT_ACCEPTED']:
+        df_events[column] = -1
+    if len(hits) == 0:
         return
-    groups = pd.concat([result[2] for result in results]).groupby(EVT_COL)
-    print('### Performing triplets analysis on {0:d} events'.format(len(groups)))
-    # Splitting event numbers into groups with different deviations from the trigger
-    deviations = [0,2,4,6,8,10]
-    event_deviations = {}
-    for dev in deviations:
-        event_deviations[dev] = []
+    profiler = profiler or EventProfiler()
+    budget = budget or ComputeBudget()
+    layout = EventLayout(hits, columns=['SL', 'LAYER', 'TDC_CHANNEL_NORM', 'TIME_ABS'])
+    print('### Performing triplets analysis on {0:d} events'.format(len(layout)))
+    # Selecting only hits in the acceptance region
+    accepted = in_masks(layout.columns['SL'], layout.columns['TDC_CHANNEL_NORM'], ACCEPTANCE_MASKS)
+    df_events.loc[layout.events, 'HITS_MULT'] = layout.sizes()
+    df_events.loc[layout.events, 'HITS_MULT_ACCEPTED'] = layout.event_sum(accepted)
+    time0s = df_events.loc[layout.events, 'TIME0'].values
+    results = np.full((len(layout), len(columns)), -1.0)
+    degraded = np.zeros(len(layout), dtype=np.int64)
     # Analysing each event
-    n_events = len(groups)
-    n_events_processed = 0
-    for event, df in groups:
-        n_events_processed += 1
-        print_progress(n_events_processed, n_events)
-        nHits = df.shape[0]
-        # Selecting only hits in the acceptance region
-        sel = pd.concat([(df['SL'] == sl) & (df['TDC_CHANNEL_NORM'].isin(ch)) 
-                    for sl, ch in ACCEPTANCE_CHANNELS.items()], axis=1).any(axis=1)
-        df = df[sel]
-        nHitsAcc = df.shape[0]
-        df_events.loc[event, ['HITS_MULT_ACCEPTED', 'HITS_MULT']] = (nHitsAcc, nHits)
+    n_events = len(layout)
+    for i in range(n_events):
+        print_progress(i + 1, n_events)
+        with profiler.event('triplets', layout.events[i], lambda: hits.loc[layout.index[layout.rows(i)]]), budget.event() as work:
+            chambers = chamber_meantimers(layout, i, accepted, budget)
+        degraded[i] = work.flags
         # Checking TIME0 found in each chamber
         tzeros = {}
-        time0 = df_events.loc[event, 'TIME0']
-        for sl, df_sl in df.groupby('SL'):
-            # print('--- SL: {0:d}'.format(sl))
-            nLayers = len(df_sl.groupby('LAYER'))
-            # Skipping chambers that don't have 3 layers of hits
-            if nLayers < 3:
-                continue
-            tzeros_sl, angles_sl = meantimer_results(df_sl, verbose=False)
-            if sl not in tzeros:
-                tzeros[sl] = []
-            tzeros[sl].extend(tzeros_sl)
-            meantimers_info = results[sl][3]
+        time0 = time0s[i]
+        for sl, (tzeros_sl, angles_sl) in chambers.items():
+            tzeros[sl] = list(tzeros_sl)
+            meantimers_info = meantimer_info.setdefault(sl, {})
             for name in ['t0_dev', 't0_angle', 'hit_angles_diff', 'hit_means_diff']:
                 if name not in meantimers_info:
                     meantimers_info[name] = []
-            meantimers_info['t0_dev'].extend([time0 - tzero for tzero in tzeros_sl])
+            t0_devs = [time0 - tzero for tzero in tzeros_sl]
+            meantimers_info['t0_dev'].extend(t0_devs)
+            DQM.fill('t0_dev', t0_devs)
             meantimers_info['t0_angle'].extend(angles_sl)
         # Calculating the mean of the t0 candidates excluding outliers
         tzero, tzeros, nSLs = mean_tzero(tzeros)
         if len(tzeros) < 1:
-            df_events.loc[event, 'MEANTIMER_MULT'] = 0
+            results[i, 3] = 0
         else:
-            df_events.loc[event, ['MEANTIMER_MEAN', 'MEANTIMER_MIN', 'MEANTIMER_MAX', 'MEANTIMER_MULT', 'MEANTIMER_SL_MULT']
-            ] = (tzero, np.min(tzeros), np.max(tzeros), len(tzeros), nSLs)
-        deviation = abs(tzero - time0)
-        for dev in reversed(deviations):
-            if deviation > float(dev):
-                event_deviations[dev].append(event)
-                break
-
-def process(input_files,start,end):
-    """Do the processing of input files and produce all outputs split into groups if needed"""
-    jobs = []  
-    results = []
+            results[i] = (tzero, np.min(tzeros), np.max(tzeros), len(tzeros), nSLs)
+    df_events.loc[layout.events, columns] = results
+    flag_events(df_events, layout.events, degraded)
+
+
+def calibrate_tzero(hits, df_events, opts):
+    """Calibrates the trigger TIME0 of a run against the meantimer t0 and corrects it for all events and their hits
 
+    Returns the fitted TriggerCalibration, None if TIME0 doesn't come from the trigger or too few events have a meantimer t0
+    """
+    if not opts.event:
+        print('WARNING: --calibrate_tzero needs TIME0 from the external trigger [-e], TIME0 not calibrated')
+        return None
+    time0 = df_events['TIME0'].values.astype(np.float64)
+    timediffs = df_events[['TIMEDIFF_TRG_20', 'TIMEDIFF_TRG_21']].values.astype(np.float64)
+    # Time differences between the trigger signals are only measured in events with all of them
+    complete = df_events['TRG_BITS'].values == 7
+    sel = (time0 > 0) & (df_events['MEANTIMER_MULT'].values > 0)
+    meantimer = df_events['MEANTIMER_MEAN'].values[sel]
+    calibration = TriggerCalibration(time0[sel] - meantimer, timediffs[sel], complete[sel])
+    if calibration.offset is None:
+        print('WARNING: only {0:d} events with a meantimer t0, TIME0 not calibrated'.format(calibration.events))
+        return None
+    # Correcting TIME0 of all events in bulk, then of their hits
+    correction = np.where(time0 > 0, -calibration.correction(timediffs, complete), 0.)
+    df_events['TIME0'] = time0 + correction
+    df_events['TIME0_CORRECTION'] = correction
+    DQM.fill('t0_dev_calibrated', df_events['TIME0'].values[sel] - meantimer)
+    # Event numbers can repeat in the table [events without the trigger signal, jumps of the counter]:
+    # hits get the correction of the last event with a trigger TIME0, as they got its TIME0
+    corrections = df_events['TIME0_CORRECTION'][time0 > 0]
+    corrections = corrections[~corrections.index.duplicated(keep='last')]
+    idx = hits['TIME0'].values > 0
+    hits.loc[idx, 'TIME0'] = hits['TIME0'].values[idx] + corrections.reindex(hits['EVENT_NR'].values[idx], fill_value=0.).values
+    print('### Calibrated trigger TIME0 with {0:d} events [{1:d} outliers]: TIME0 - meantimer t0 = {2:.2f} ns, TIME_OFFSET = {3:.2f} ns'.format(
+        calibration.events, calibration.outliers, calibration.offset, TIME_OFFSET - calibration.offset))
+    if calibration.coefficients is not None:
+        print('    corrected in {0:d} events with all trigger signals: {1:.2f} ns + {2:.3f} x TIMEDIFF_TRG_20 + {3:.3f} x TIMEDIFF_TRG_21'.format(
+            calibration.events_complete, *calibration.coefficients))
+    print('    trigger jitter: {0:.2f} ns [{1:.3f} mm] before and {2:.2f} ns [{3:.3f} mm] after the correction'.format(
+        calibration.jitter_before, calibration.jitter_before*VDRIFT, calibration.jitter_after, calibration.jitter_after*VDRIFT))
+    return calibration
+
+
+def output_base(input_files, opts):
+    """Path of the outputs of a group of input files without extension: text/<run>/<first file>[_<options>]"""
     parts = os.path.split(input_files[0])
     run = os.path.split(parts[0])[-1]
+    file = os.path.splitext(parts[-1])[0]
+    if opts.events:
+        file += '_e'+'_'.join(['{0:d}'.format(ev) for ev in opts.events])
+    if opts.update_tzero:
+        file += '_t0'
+    if opts.prescale > 1:
+        file += '_p{0:d}'.format(opts.prescale)
+    if opts.suffix:
+        file += '_{0:s}'.format(opts.suffix)
+    return os.path.join('text', run, file)
 
-    if args.layer is None:
-        # Processing all layers in parallel threads
-        allhits, df_events = read_data(input_files)
-        # br()
-        for sl in range(4):
-        # Avoiding parallel processing due to memory duplication by child processes
-            results.append(analyse(allhits[allhits['SL'] == sl].copy(), sl))
-        # pool = Pool(4)
-        # results = pool.map(analyse_parallel, jobs)
+
+def read_group(input_files, opts, profiler=None, budget=None):
+    """First stage of the processing: reads the input files and finds hit positions and triplets
+
+    Events are timed by the EventProfiler and processed within the ComputeBudget of the run if given,
+    otherwise by ones set up from opts for this group alone.
+    """
+    profiler = profiler or EventProfiler(opts.profile)
+    budget = budget or ComputeBudget(opts.budget, opts.budget_us)
+    monitor = Monitor()
+    DQM.use(monitor)
+    # Counting sampled hits, events and reconstructions of each block of orbits in the quick-look mode
+    quicklook = QuickLook(opts.prescale) if opts.prescale > 1 else None
+    cutflow = CutFlow()
+
+    allhits, df_events = read_data(input_files, opts, quicklook=quicklook, cutflow=cutflow, profiler=profiler, budget=budget)
+    # Running the analysis on all SLs at once or on a single SL
+    if opts.layer is None:
+        dfhits = allhits[allhits['SL'] >= 0].copy()
     else:
-        # Running the analysis on SL 0
-        allhits, df_events = read_data(input_files)
-        results.append(analyse(allhits[allhits['SL'] == args.layer], args.layer))
+        dfhits = allhits[allhits['SL'] == opts.layer].copy()
+    dfhits, hits, meantimer_info = analyse(dfhits, opts)
     # Matching triplets from same event
-    if args.triplets:
-        sync_triplets(results, df_events)
+    if opts.triplets or opts.calibrate_tzero:
+        sync_triplets(hits, meantimer_info, df_events, opts, profiler, budget)
+    calibration = None
+    if opts.calibrate_tzero:
+        calibration = calibrate_tzero(dfhits, df_events, opts)
+        dfhits, hits = hit_positions(dfhits)
     
     print('### Filling output')
-    for result in results:
-        if not result:
-            continue
-
-        # Writing data to CSV
-        SL = result[0]
-        if args.csv:
+    # Writing data to CSV
+    if opts.csv:
+        for SL, df in hits.groupby('SL'):
             df_out = df[['SL','LAYER','WIRE_NUM','TDC_CHANNEL_NORM','TIMENS','TIME0','X_POS_LEFT','X_POS_RIGHT','Z_POS']]
             df_out.to_csv('out_df_{0:d}.csv'.format(SL))
 
-    # Determining output file path
-    file = os.path.splitext(parts[-1])[0]
-    if args.events:
-        file += '_e'+'_'.join(['{0:d}'.format(ev) for ev in args.events])
-    if args.update_tzero:
-        file += '_t0'
-    if args.suffix:
-        file += '_{0:s}'.format(args.suffix)
+    return {
+        'inputs': input_files,
+        'base': output_base(input_files, opts),
+        'n_hits': int(allhits.shape[0]),
+        'hits': dfhits,
+        'events': df_events,
+        'monitor': monitor,
+        'quicklook': quicklook,
+        'cutflow': cutflow,
+        'calibration': calibration,
+        'profiler': profiler,
+        'budget': budget,
+    }
+
 
+def reconstruct_group(group, opts):
+    """Second stage of the processing: queues the text output and reconstructs the events"""
+    DQM.use(group['monitor'])
+    group['counts'] = (0, 0, 0)
+    group['writer'] = None
+    # Hits are not needed by the last stage
+    dfhits = group.pop('hits')
     ### GENERATE TEXT OUTPUT [one event per line]
-    if args.root:
-        dfs = []
-        for result in results:
-            if not len(result) > 2:
-                continue
-            # Collecting dataframes with all hits
-            dfs.append(result[1])
-        out_path = os.path.join('text', run, file+'.txt')
+    if opts.root:
+        out_path = group['base']+'.txt'
         try:
             os.makedirs(os.path.dirname(out_path))
         except:
             pass
-        save_root(dfs, df_events, out_path,start,end)
+        group['writer'] = AsyncTextWriter(out_path)
+        with plotting(not opts.no_plots):
+            group['counts'] = save_root(dfhits, group['events'], out_path, opts.range[0], opts.range[1], opts, writer=group['writer'], quicklook=group['quicklook'], cutflow=group['cutflow'],
+                                        profiler=group['profiler'], budget=group['budget'])
+    return group
+
+
+def write_group(group, opts):
+    """Last stage of the processing: finishes writing the text output and saves the histograms and the event table"""
+    base = group['base']
+    out_path = base+'.txt'
+    if group['writer'] is not None:
+        group['writer'].close()
+    counts = group['counts']
+
+    ### SAVE DATA-QUALITY HISTOGRAMS [one file per group of input files]
+    dqm_path = base+'_dqm.npz'
+    try:
+        os.makedirs(os.path.dirname(dqm_path))
+    except:
+        pass
+    group['monitor'].save(dqm_path)
+    print('### Saved data-quality histograms to file: {0:s}'.format(dqm_path))
+
+    group['cutflow'].report()
+    if group['calibration'] is not None:
+        calibration = dict(group['calibration'].summary(), time_offset=TIME_OFFSET - group['calibration'].offset)
+        with open(base+'_calibration.json', 'w') as outfile:
+            json.dump(calibration, outfile, indent=1, sort_keys=True)
+        print('### Saved trigger t0 calibration to file: {0:s}_calibration.json'.format(base))
+    if group['budget'].limited:
+        degraded = group['events']['DEGRADED'].values
+        print('### {0:d} events over the compute budget of {1:s}'.format(int((degraded != 0).sum()), str(group['budget'])))
+        for flag, name in sorted(BUDGET_FLAGS.items()):
+            print('    {0:<28s} {1:10d}'.format(name, int(((degraded & flag) != 0).sum())))
+
+    ### QUICK-LOOK ESTIMATES [from the sampled blocks of orbits]
+    if group['quicklook'] is not None:
+        group['quicklook'].report()
+        group['quicklook'].save(base+'_quicklook.json')
+        print('### Saved quick-look estimates to file: {0:s}_quicklook.json'.format(base))
+
+    ### SAVE EVENT TABLE AND COUNTERS [for merging results of batch jobs]
+    if opts.summary:
+        df_events = group['events']
+        df_events.to_csv(base+'_events.csv')
+        group['cutflow'].save(base+'_cutflow.csv')
+        summary = {
+            'inputs': [os.path.abspath(path) for path in group['inputs']],
+            'hits': group['n_hits'],
+            'events': int(df_events.shape[0]),
+            'events_written': int(counts[0]),
+            'events_degraded': int((df_events['DEGRADED'] != 0).sum()),
+            'reconstructed_local': int(counts[1]),
+            'reconstructed_global': int(counts[2]),
+        }
+        with open(base+'_summary.json', 'w') as outfile:
+            json.dump(summary, outfile, indent=1, sort_keys=True)
+        print('### Saved event table, cut flow and counters to: {0:s}_events.csv, {0:s}_cutflow.csv, {0:s}_summary.json'.format(base))
+
+    with plotting(not opts.no_plots or opts.join[1] != None):
+        if not opts.no_plots:
+            pyplot().close('all')
+        if opts.join[1] != None:
+            reconstruct_all(out_path, opts, start = opts.join[0], end = opts.join[1])
+    return out_path
+
+
+def find_channels(input_files, opts):
+    """Fast first pass over the hits: flags noisy and dead channels and saves them as a channel mask file"""
+    allhits, nhits_read, _ = read_files(input_files, nrows=opts.number, processes=opts.processes)
+    print('### Read {0:d} hits from {1:d} input files'.format(nhits_read, len(input_files)))
+    table = flag_channels(channel_table(allhits['FPGA'].values, allhits['TDC_CHANNEL'].values,
+                                        allhits['ORBIT_CNT'].values, absolute_time(allhits).values))
+    noisy = table[table['STATUS'] == 'noisy']
+    print('### Found {0:d} noisy channels'.format(len(noisy)))
+    for _, row in noisy.iterrows():
+        print('    SL {0:d} channel {1:3d} [FPGA {2:d} TDC_CHANNEL {3:3d}]: {4:9.3g} Hz, {5:.0%} of hits in bursts'.format(
+            int(row['SL']), int(row['TDC_CHANNEL_NORM']), int(row['FPGA']), int(row['TDC_CHANNEL']), row['RATE'], row['BURST_FRACTION']))
+    dead = table[table['STATUS'] == 'dead']
+    print('### Found {0:d} dead channels'.format(len(dead)))
+    for sl, channels in dead.groupby('SL')['TDC_CHANNEL_NORM']:
+        print('    SL {0:d} channels {1:s}'.format(int(sl), ' '.join(['{0:d}'.format(ch) for ch in channels])))
+    mask_path = output_base(input_files, opts)+'_channels.csv'
+    try:
+        os.makedirs(os.path.dirname(mask_path))
+    except:
+        pass
+    save_mask(table, mask_path)
+    print('### Saved channel mask to file: {0:s}'.format(mask_path))
+    return mask_path
+
+
+def save_profile(profiler, out_path, opts):
+    """Prints the event latency of a run and saves it with the slow events next to its text output"""
+    if opts.profile is None:
+        return
+    profiler.report()
+    profile_path = os.path.splitext(out_path)[0]+'_profile.json'
+    profiler.save(profile_path, options=vars(opts))
+    print('### Saved event latency and {0:d} slow events to file: {1:s}'.format(len(profiler.slow), profile_path))
 
+
+def process(input_files, opts):
+    """Do the processing of input files and produce all outputs split into groups if needed"""
+    profiler = EventProfiler(opts.profile)
+    budget = ComputeBudget(opts.budget, opts.budget_us)
+    out_path = write_group(reconstruct_group(read_group(input_files, opts, profiler, budget), opts), opts)
+    save_profile(profiler, out_path, opts)
     return out_path
 
 
-for i in range(0, len(args.inputs), args.group):
-    files = args.inputs[i:i+args.group]
-    print('############### Starting processing files {0:d}-{1:d} out of total {2:d}'.format(i, i+len(files)-1, len(args.inputs)))
-    # Processing the input files
-    fp = process(files,start = args.range[0],end = args.range[1])
-    plt.close('all')
-    if args.join[1] != None:
-    	reconstruct_all(fp,start = args.join[0],end = args.join[1])
-    print('### Done')
-    
+def replay(path, index, opts):
+    """Reruns a slow event captured by --profile under cProfile, with the options of the profiled run"""
+    import cProfile
+    import pstats
+    options, events = load_slow_events(path)
+    if not 0 <= index < len(events):
+        print('--- ERROR ---')
+        print('event {0:d} not found: {1:d} events captured in {2:s}'.format(index, len(events), path))
+        sys.exit(1)
+    options.update(no_plots=True, profile=None, replay=None)
+    opts = Options(**options)
+    budget = ComputeBudget(opts.budget, opts.budget_us)
+    captured = events[index]
+    hits = captured['hits']
+    print('### Replaying event {0:d} [{1:s}]: {2:d} hits, {3:.1f} ms when captured'.format(
+        captured['event'], captured['stage'], len(hits), captured['duration_ms']))
+    if captured['stage'] == 'meantimer':
+        layout = EventLayout(hits, columns=['TDC_CHANNEL_NORM', 'TIME_ABS'])
+        nLayers = EventOccupancy.from_hits(hits).n_layers()
+        run = lambda: event_meantimers(layout, 0, layout.sl_sizes()[0], nLayers[0], budget)
+    elif captured['stage'] == 'triplets':
+        layout = EventLayout(hits, columns=['SL', 'LAYER', 'TDC_CHANNEL_NORM', 'TIME_ABS'])
+        accepted = in_masks(layout.columns['SL'], layout.columns['TDC_CHANNEL_NORM'], ACCEPTANCE_MASKS)
+        run = lambda: mean_tzero(dict([(sl, list(result[0])) for sl, result in chamber_meantimers(layout, 0, accepted, budget).items()]))
+    else:
+        layout = EventLayout(hits, columns=['X_POS_LEFT', 'X_POS_RIGHT', 'Z_POS'])
+        run = lambda: reconstruct(layout, 0, None, opts, budget=budget)
+    profile = cProfile.Profile()
+    start = time.perf_counter()
+    with budget.event():
+        profile.runcall(run)
+    print('### Replayed in {0:.1f} ms'.format((time.perf_counter() - start)*1e3))
+    pstats.Stats(profile).sort_stats('cumulative').print_stats(25)
+
+
+def main(argv=None):
+    """Processes the input files given on the command line"""
+    opts = parse_args(argv)
+    if opts.replay is not None:
+        replay(opts.inputs[0], opts.replay, opts)
+        return
+    for file_path in opts.inputs:
+        if not os.path.exists(os.path.expandvars(file_path)):
+            print('--- ERROR ---')
+            print('file not found')
+            print('  please point to the correct path to the file containing the unpacked data' )
+            print()
+            sys.exit(1)
+
+    # Only finding the noisy and dead channels of each group of input files
+    if opts.find_channels:
+        for i in range(0, len(opts.inputs), opts.group):
+            find_channels(opts.inputs[i:i+opts.group], opts)
+        return
+
+    def start_group(i):
+        files = opts.inputs[i:i+opts.group]
+        print('############### Starting processing files {0:d}-{1:d} out of total {2:d}'.format(i, i+len(files)-1, len(opts.inputs)))
+        return read_group(files, opts, profiler, budget)
+
+    def finish_group(group):
+        out_path = write_group(group, opts)
+        print('### Done')
+        return out_path
+
+    # Processing the groups of input files in a pipeline of reading, reconstruction and writing
+    profiler = EventProfiler(opts.profile)
+    budget = ComputeBudget(opts.budget, opts.budget_us)
+    pipeline = Pipeline([start_group, lambda group: reconstruct_group(group, opts), finish_group], max_in_flight=opts.pipeline)
+    out_paths = pipeline.run(range(0, len(opts.inputs), opts.group))
+
+    ### SAVE EVENT LATENCY AND SLOW EVENTS [next to the output of the first group]
+    if out_paths:
+        save_profile(profiler, out_paths[0], opts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Per-event timing of the processing stages with capture of slow events for replaying them"""
+
+import json
+import time
+import threading
+import contextlib
+import numpy as np
+import pandas as pd
+
+from modules.analysis.monitoring import Histogram
+
+### Binning of log10(duration in ms) of the latency histograms: 1 us to 1000 s
+LATENCY_BINNING = (180, -3., 6.)
+
+
+class EventTimer(object):
+    """Context measuring the time spent on one event in a stage"""
+
+    def __init__(self, profiler, stage, event, hits):
+        self.profiler = profiler
+        self.stage = stage
+        self.event = event
+        self.hits = hits
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.stage, self.event, time.perf_counter() - self.start, self.hits)
+
+
+class EventProfiler(object):
+    """Latency histograms of the processing stages and the hits of events slower than a threshold
+
+    Disabled while the threshold [ms] is None, in which case timing an event costs nothing.
+    Histograms of log10 of the durations keep the memory constant for any number of events,
+    percentiles being upper edges of the bins [12% wide].
+    """
+
+    def __init__(self, threshold=None):
+        self.threshold = threshold
+        self.histograms = {}
+        self.max = {}
+        self.slow = []
+        self.lock = threading.Lock()
+
+    def event(self, stage, event, hits):
+        """Context timing one event, `hits` being a function returning its hits to capture if it is slow"""
+        if self.threshold is None:
+            return contextlib.nullcontext()
+        return EventTimer(self, stage, event, hits)
+
+    def record(self, stage, event, seconds, hits):
+        duration = seconds * 1e3
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram(*LATENCY_BINNING)
+                self.max[stage] = 0.
+            self.histograms[stage].fill([np.log10(max(duration, 1e-9))])
+            self.max[stage] = max(self.max[stage], duration)
+        if duration <= self.threshold:
+            return
+        df = hits()
+        captured = {
+            'stage': stage,
+            'event': int(event),
+            'duration_ms': duration,
+            'hits': dict([(name, {'dtype': str(df[name].dtype), 'values': df[name].tolist()}) for name in df.columns]),
+        }
+        with self.lock:
+            self.slow.append(captured)
+
+    def percentile(self, stage, q):
+        """Duration [ms] below which a fraction q of the events of a stage were processed"""
+        hist = self.histograms[stage]
+        cumulative = np.cumsum(hist.counts)
+        i = np.searchsorted(cumulative, q * cumulative[-1])
+        edges = np.r_[hist.low, hist.edges[1:], np.inf]
+        return 10**edges[min(i, len(edges) - 1)]
+
+    def stats(self):
+        """Number of events, p50, p99 and maximum duration [ms] of each stage"""
+        return dict([(stage, {
+            'events': hist.entries(),
+            'p50_ms': min(self.percentile(stage, 0.5), self.max[stage]),
+            'p99_ms': min(self.percentile(stage, 0.99), self.max[stage]),
+            'max_ms': self.max[stage],
+            'slow': sum(1 for captured in self.slow if captured['stage'] == stage),
+        }) for stage, hist in self.histograms.items()])
+
+    def report(self):
+        """Prints the latency of each stage"""
+        print('### Event latency [ms], events slower than {0:g} ms are captured'.format(self.threshold))
+        for stage, stats in sorted(self.stats().items()):
+            print('    {0:<12s} {1:8d} events   p50 {2:9.3g}   p99 {3:9.3g}   max {4:9.3g}   slow {5:d}'.format(
+                stage, stats['events'], stats['p50_ms'], stats['p99_ms'], stats['max_ms'], stats['slow']))
+
+    def save(self, path, options=None):
+        """Writes latency statistics, histograms and captured events into a JSON file"""
+        profile = {
+            'threshold_ms': self.threshold,
+            'options': options,
+            'stages': self.stats(),
+            'histograms': dict([(stage, {'binning': list(hist.binning), 'counts': hist.counts.tolist()}) for stage, hist in self.histograms.items()]),
+            'slow_events': self.slow,
+        }
+        with open(path, 'w') as outfile:
+            json.dump(profile, outfile, indent=1, sort_keys=True)
+
+
+def load_slow_events(path):
+    """Reads the processing options and the captured events of a profile, with their hits as dataframes"""
+    with open(path) as infile:
+        profile = json.load(infile)
+    events = []
+    for captured in profile['slow_events']:
+        captured = dict(captured)
+        captured['hits'] = pd.DataFrame(dict([(name, np.array(column['values'], dtype=column['dtype']))
+                                              for name, column in captured['hits'].items()]))
+        events.append(captured)
+    return profile['options'], events
@@ -0,0 +1,312 @@
+"""Local query service over the reconstructed tracks of a run, with a Python client
+
+Run it from the miniDT folder on the _tracks.csv outputs of process_hits_v2.py:
+
+    python -m modules.analysis.query text/<run>/<file>_tracks.csv [...] --port 8765
+
+and query it from any notebook or script on the same computer:
+
+    from modules.analysis.query import TrackClient
+    client = TrackClient()
+    tracks = client.tracks(ORBIT_CNT_min=1000, CHISQ_3D_X_max=10., chambers=0b1111, limit=100)
+    hits = client.hits(tracks['PART'][0], line=tracks['LINE'][0])
+"""
+
+import os
+import json
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from urllib.parse import urlparse, parse_qs, urlencode
+from urllib.request import urlopen
+from urllib.error import HTTPError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from modules.analysis.textio import HIT_COLUMNS, HIT_DECIMALS
+
+### Default address of the service: only reachable from the same computer
+QUERY_HOST = '127.0.0.1'
+QUERY_PORT = 8765
+### Columns of the tracks table written next to the text output, one row per event in the same order
+TRACK_FIT_COLUMNS = ['CHISQ_LOCAL_0', 'CHISQ_LOCAL_1', 'CHISQ_LOCAL_2', 'CHISQ_LOCAL_3',
+                     'CHISQ_2D_X', 'CHISQ_2D_Y', 'CHISQ_3D_X', 'CHISQ_3D_Y', 'SLOPE_XZ', 'SLOPE_YZ']
+TRACK_COLUMNS = ['EVENT_NR', 'ORBIT_CNT', 'NHITS', 'CHAMBERS', 'LOCAL', 'GLOBAL', 'DEGRADED'] + TRACK_FIT_COLUMNS
+
+
+def save_tracks(path, columns):
+    """Writes the tracks table from a dictionary of its columns"""
+    pd.DataFrame(columns, columns=TRACK_COLUMNS).to_csv(path, index=False, float_format='%.6g')
+
+
+class EventLines(object):
+    """Byte offsets of the lines of a text output, to read the hits of single events without parsing the file"""
+
+    def __init__(self, path):
+        self.path = path
+        ends = np.flatnonzero(np.fromfile(path, dtype=np.uint8) == ord('\n'))
+        self.offsets = np.r_[0, ends + 1].astype(np.int64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def hits(self, line):
+        """Hits of the event on a line as a dictionary of columns"""
+        with open(self.path, 'rb') as infile:
+            infile.seek(self.offsets[line])
+            values = infile.read(self.offsets[line + 1] - self.offsets[line]).split()
+        hits = np.array(values[2:], dtype=np.float64).reshape(-1, len(HIT_COLUMNS))
+        return dict([(name, (hits[:, k] if HIT_DECIMALS[k] else hits[:, k].astype(np.int64)).tolist()) for k, name in enumerate(HIT_COLUMNS)])
+
+
+class TrackStore(object):
+    """Tracks of the parts of a run held in memory as column arrays with sorted indices for range queries
+
+    Rows are sorted by (PART, EVENT_NR), PART being the position of the tracks file they come from.
+    The first range query on a column sorts it once, after which a range is two binary searches.
+    A query starts from the most selective range and only tests the other conditions on its rows.
+    Apart from the sorted indices, built under a lock, the store is read-only once loaded,
+    so any number of threads can query it at the same time.
+    """
+
+    def __init__(self, paths):
+        tables = []
+        self.lines = []
+        for part, path in enumerate(paths):
+            table = pd.read_csv(path)
+            table.insert(0, 'PART', part)
+            table['LINE'] = np.arange(len(table))
+            tables.append(table)
+            text_path = path[:-len('_tracks.csv')]+'.txt' if path.endswith('_tracks.csv') else None
+            self.lines.append(EventLines(text_path) if text_path and os.path.exists(text_path) else None)
+        table = pd.concat(tables, ignore_index=True).sort_values(['PART', 'EVENT_NR'], kind='stable')
+        self.paths = list(paths)
+        self.columns = dict([(name, table[name].values) for name in table.columns])
+        self.sorted = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.columns['EVENT_NR'])
+
+    def index(self, name):
+        """Order of the rows by a column and the sorted values [NaN last]"""
+        with self.lock:
+            if name not in self.sorted:
+                order = np.argsort(self.columns[name], kind='stable')
+                self.sorted[name] = (order, self.columns[name][order])
+            return self.sorted[name]
+
+    def range(self, name, low=None, high=None):
+        """Rows with low <= value <= high in increasing order of the value"""
+        order, values = self.index(name)
+        first = 0 if low is None else np.searchsorted(values, low, side='left')
+        last = np.searchsorted(values, np.inf if high is None else high, side='right')
+        return order[first:last]
+
+    def select(self, ranges=None, chambers=None, columns=None, limit=None):
+        """Tracks with every column of ranges within its (low, high) and hits in all chambers of the bit mask
+
+        Returns the number of matching tracks and a dataframe of the first `limit` of them by event number
+        """
+        ranges = dict(ranges or {})
+        for name in ranges:
+            if name not in self.columns:
+                raise KeyError('unknown column {0:s}'.format(name))
+        columns = list(self.columns) if columns is None else list(columns)
+        for name in columns:
+            if name not in self.columns:
+                raise KeyError('unknown column {0:s}'.format(name))
+        if ranges:
+            candidates = dict([(name, self.range(name, *bounds)) for name, bounds in ranges.items()])
+            first = min(candidates, key=lambda name: len(candidates[name]))
+            rows = np.sort(candidates.pop(first))
+            for name, (low, high) in ranges.items():
+                if name == first:
+                    continue
+                values = self.columns[name][rows]
+                # Comparisons with NaN are false, as NaN values are never in a range of the sorted index
+                rows = rows[(values >= (-np.inf if low is None else low)) & (values <= (np.inf if high is None else high))]
+        else:
+            rows = np.arange(len(self))
+        if chambers is not None:
+            rows = rows[(self.columns['CHAMBERS'][rows] & chambers) == chambers]
+        count = len(rows)
+        if limit is not None:
+            rows = rows[:limit]
+        return count, pd.DataFrame(dict([(name, self.columns[name][rows]) for name in columns]), columns=columns)
+
+    def hits(self, part, event=None, line=None):
+        """Hits of an event read from the text output of its part, given by its LINE or by its event number
+
+        Event numbers can repeat within a part [trigger counter, merged batch units]: a number
+        matching several events is rejected, their lines being needed to tell them apart.
+        """
+        if not 0 <= part < len(self.paths) or self.lines[part] is None:
+            raise KeyError('no text output for part {0:d}'.format(part))
+        if line is not None:
+            if not 0 <= line < len(self.lines[part]):
+                raise KeyError('line {0:d} not found in part {1:d}'.format(line, part))
+            return self.lines[part].hits(line)
+        if event is None:
+            raise KeyError('event or line is needed')
+        first, last = np.searchsorted(self.columns['PART'], [part, part + 1])
+        first, last = first + np.searchsorted(self.columns['EVENT_NR'][first:last], [event, event + 1])
+        if first == last:
+            raise KeyError('event {0:d} not found in part {1:d}'.format(event, part))
+        if last - first > 1:
+            raise KeyError('event {0:d} is on {1:d} lines of part {2:d}, ask for one of lines {3:s}'.format(
+                event, last - first, part, ', '.join(['{0:d}'.format(line) for line in np.sort(self.columns['LINE'][first:last])])))
+        return self.lines[part].hits(int(self.columns['LINE'][first]))
+
+    def info(self):
+        """Files, number of tracks and ranges of the columns"""
+        return {
+            'paths': self.paths,
+            'tracks': len(self),
+            'columns': dict([(name, _bounds(values)) for name, values in self.columns.items()]),
+        }
+
+
+def _bounds(values):
+    """Minimum and maximum of a column without NaN"""
+    if values.dtype.kind == 'f':
+        values = values[~np.isnan(values)]
+    return [_json_value(values.min()), _json_value(values.max())] if len(values) else [None, None]
+
+
+def _json_value(value):
+    """Plain Python value of a numpy scalar, None for NaN"""
+    value = value.item() if hasattr(value, 'item') else value
+    return None if isinstance(value, float) and value != value else value
+
+
+def parse_query(params):
+    """Arguments of TrackStore.select from the parameters of a /tracks request
+
+    <COLUMN>_min and <COLUMN>_max give inclusive ranges, chambers a bit mask of SLs that must have hits,
+    columns a comma-separated list of the columns to return and limit the maximum number of tracks
+    """
+    ranges = {}
+    kwargs = {}
+    for key, value in params.items():
+        if key == 'chambers':
+            kwargs['chambers'] = int(value, 0)
+        elif key == 'columns':
+            kwargs['columns'] = value.split(',')
+        elif key == 'limit':
+            kwargs['limit'] = int(value)
+        elif key.endswith('_min') or key.endswith('_max'):
+            name = key[:-4].upper()
+            bounds = ranges.get(name, [None, None])
+            bounds[key.endswith('_max')] = float(value)
+            ranges[name] = bounds
+        else:
+            raise KeyError('unknown parameter {0:s}'.format(key))
+    kwargs['ranges'] = dict([(name, tuple(bounds)) for name, bounds in ranges.items()])
+    return kwargs
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Answers GET /info, /tracks?<query> and /hits?part=P&line=L [or &event=N] with JSON"""
+
+    store = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict([(key, values[-1]) for key, values in parse_qs(url.query).items()])
+        try:
+            if url.path == '/info':
+                result = self.store.info()
+            elif url.path == '/tracks':
+                count, tracks = self.store.select(**parse_query(params))
+                result = {'count': count, 'columns': dict([(name, [_json_value(v) for v in tracks[name].values]) for name in tracks.columns])}
+            elif url.path == '/hits':
+                result = self.store.hits(int(params.get('part', 0)),
+                                         event=int(params['event']) if 'event' in params else None,
+                                         line=int(params['line']) if 'line' in params else None)
+            else:
+                self.reply(404, {'error': 'unknown path {0:s}'.format(url.path)})
+                return
+        except (KeyError, ValueError) as e:
+            self.reply(400, {'error': str(e).strip("'")})
+            return
+        self.reply(200, result)
+
+    def reply(self, status, result):
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(store, host=QUERY_HOST, port=QUERY_PORT):
+    """HTTP server answering queries on a store, each request in its own thread"""
+    handler = type('StoreQueryHandler', (QueryHandler,), {'store': store})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+class TrackClient(object):
+    """Client of a running query service"""
+
+    def __init__(self, url='http://{0:s}:{1:d}'.format(QUERY_HOST, QUERY_PORT)):
+        self.url = url.rstrip('/')
+
+    def get(self, path, params=None):
+        url = self.url + path + ('?' + urlencode(params) if params else '')
+        try:
+            with urlopen(url) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except HTTPError as e:
+            raise ValueError(json.loads(e.read().decode('utf-8'))['error'])
+
+    def info(self):
+        return self.get('/info')
+
+    def tracks(self, chambers=None, columns=None, limit=None, **ranges):
+        """Tracks matching <COLUMN>_min=/<COLUMN>_max= ranges as a dataframe, with the number of matches in attrs['count']"""
+        params = dict(ranges)
+        if chambers is not None:
+            params['chambers'] = int(chambers)
+        if columns is not None:
+            params['columns'] = ','.join(columns)
+        if limit is not None:
+            params['limit'] = int(limit)
+        result = self.get('/tracks', params)
+        tracks = pd.DataFrame(result['columns'], columns=list(result['columns']))
+        tracks.attrs['count'] = result['count']
+        return tracks
+
+    def hits(self, part, event=None, line=None):
+        """Hits of an event given by its LINE [unique] or its event number as a dataframe"""
+        params = {'part': int(part)}
+        if event is not None:
+            params['event'] = int(event)
+        if line is not None:
+            params['line'] = int(line)
+        return pd.DataFrame(self.get('/hits', params), columns=HIT_COLUMNS)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve queries on the reconstructed tracks of a run')
+    parser.add_argument('inputs', metavar='FILE', nargs='+', help='_tracks.csv outputs of process_hits_v2.py, next to their text outputs')
+    parser.add_argument('--host', default=QUERY_HOST, help='Address to listen on [default: {0:s}, this computer only]'.format(QUERY_HOST))
+    parser.add_argument('--port', default=QUERY_PORT, type=int, help='Port to listen on [default: {0:d}]'.format(QUERY_PORT))
+    args = parser.parse_args(argv)
+    store = TrackStore(args.inputs)
+    server = serve(store, args.host, args.port)
+    print('### Serving {0:d} tracks from {1:d} files on http://{2:s}:{3:d}'.format(len(store), len(args.inputs), args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
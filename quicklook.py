@@ -0,0 +1,132 @@
+"""Quick look at a run from a prescaled sample of orbit blocks, with the sampling uncertainty of the estimates"""
+
+import json
+import numpy as np
+
+from modules.analysis.config import QUICKLOOK_BLOCK_ORBITS
+from modules.analysis.monitoring import Monitor
+
+
+def orbit_blocks(orbits, block_orbits=QUICKLOOK_BLOCK_ORBITS):
+    """Index of the block of orbits each hit or event belongs to"""
+    return np.asarray(orbits, dtype=np.int64) // block_orbits
+
+
+def sampled(orbits, prescale, block_orbits=QUICKLOOK_BLOCK_ORBITS):
+    """Mask of the orbits in every `prescale`-th block, spread uniformly over the whole run"""
+    return orbit_blocks(orbits, block_orbits) % prescale == 0
+
+
+def ratio_estimate(y, x, prescale=1):
+    """Ratio of totals sum(y)/sum(x) from per-block sums and its standard error
+
+    Blocks are the sampling units, so the error follows from the spread of the blocks around
+    the ratio, with the finite-population correction for sampling 1 in `prescale` blocks.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    total = x.sum()
+    if total == 0:
+        return np.nan, np.nan
+    ratio = y.sum() / total
+    if len(x) < 2:
+        return ratio, np.nan
+    var = (1. - 1./prescale) * len(x) / (len(x) - 1.) * ((y - ratio*x)**2).sum() / total**2
+    return ratio, np.sqrt(var)
+
+
+class QuickLook(object):
+    """Per-block counts of the sampled hits, events and reconstructions of a group of input files
+
+    Counts are filled with the block index of every entry, the acceptance being estimated only if
+    accepted events were counted. Each block also gets its own
+    data-quality histograms, from which the mean chi squared of local segments is estimated.
+    """
+
+    def __init__(self, prescale, block_orbits=QUICKLOOK_BLOCK_ORBITS):
+        self.prescale = int(prescale)
+        self.block_orbits = block_orbits
+        self.counts = {}
+        self.monitors = {}
+        self.orbit_range = None
+
+    def fill(self, name, orbits):
+        """Counts entries of a quantity by the orbit they belong to"""
+        blocks = orbit_blocks(orbits, self.block_orbits)
+        if name not in self.counts:
+            self.counts[name] = {}
+        counts = self.counts[name]
+        for block, n in zip(*np.unique(blocks, return_counts=True)):
+            counts[block] = counts.get(block, 0) + int(n)
+
+    def set_orbits(self, orbits):
+        """Records the orbits covered by the input files, to count blocks without any hits too"""
+        if len(orbits):
+            self.orbit_range = (int(np.min(orbits)), int(np.max(orbits)))
+
+    def monitor(self, orbit):
+        """Data-quality histograms of the block of an orbit"""
+        block = int(orbit) // self.block_orbits
+        if block not in self.monitors:
+            self.monitors[block] = Monitor()
+        return self.monitors[block]
+
+    def blocks(self):
+        """Sampled blocks within the orbits covered by the input files"""
+        if self.orbit_range is None:
+            return np.zeros(0, dtype=np.int64)
+        blocks = np.arange(self.orbit_range[0] // self.block_orbits, self.orbit_range[1] // self.block_orbits + 1)
+        return blocks[blocks % self.prescale == 0]
+
+    def totals(self, name, blocks=None):
+        """Counts of a quantity in each sampled block"""
+        blocks = self.blocks() if blocks is None else blocks
+        counts = self.counts.get(name, {})
+        return np.array([counts.get(block, 0) for block in blocks], dtype=np.float64)
+
+    def chisq_local(self, blocks):
+        """Sums of the local chi squared [from the bin centres] and numbers of segments in each block"""
+        sums = np.zeros(len(blocks))
+        entries = np.zeros(len(blocks))
+        for i, block in enumerate(blocks):
+            if block not in self.monitors:
+                continue
+            hist = self.monitors[block]['chisq_local']
+            centres = 0.5*(hist.edges[1:] + hist.edges[:-1])
+            sums[i] = (hist.counts[1:-1] * centres).sum()
+            entries[i] = hist.counts[1:-1].sum()
+        return sums, entries
+
+    def estimates(self):
+        """Estimates of the run quality as name -> (value, standard error)"""
+        blocks = self.blocks()
+        orbits = np.full(len(blocks), float(self.block_orbits))
+        results = {}
+        for sl in range(4):
+            results['hits_per_orbit_sl{0:d}'.format(sl)] = ratio_estimate(self.totals('hits_sl{0:d}'.format(sl), blocks), orbits, self.prescale)
+        results['events_per_orbit'] = ratio_estimate(self.totals('events', blocks), orbits, self.prescale)
+        # Accepted events are only counted when the acceptance cuts are applied
+        if 'accepted' in self.counts:
+            results['acceptance'] = ratio_estimate(self.totals('accepted', blocks), self.totals('events', blocks), self.prescale)
+        results['local_efficiency'] = ratio_estimate(self.totals('local', blocks), self.totals('written', blocks), self.prescale)
+        results['global_efficiency'] = ratio_estimate(self.totals('global', blocks), self.totals('local', blocks), self.prescale)
+        results['chisq_local_mean'] = ratio_estimate(*self.chisq_local(blocks), prescale=self.prescale)
+        return results
+
+    def report(self):
+        """Prints the estimates"""
+        blocks = self.blocks()
+        print('### Quick look: {0:d} sampled blocks of {1:d} orbits, 1 block in {2:d}'.format(len(blocks), self.block_orbits, self.prescale))
+        for name, (value, error) in sorted(self.estimates().items()):
+            print('    {0:<24s} {1:12.4g} +- {2:.2g}'.format(name, value, error))
+
+    def save(self, path):
+        """Writes the estimates and the sampling parameters into a JSON file"""
+        summary = {
+            'prescale': self.prescale,
+            'block_orbits': self.block_orbits,
+            'blocks': len(self.blocks()),
+            'estimates': dict([(name, {'value': value, 'error': error}) for name, (value, error) in self.estimates().items()]),
+        }
+        with open(path, 'w') as outfile:
+            json.dump(summary, outfile, indent=1, sort_keys=True)
@@ -0,0 +1,386 @@
+"""Event loader and local reconstruction shared by the path_reconstruction notebooks, cached between cell runs
+
+A text output is read once into flat arrays, and the local fit of each chamber of each event is computed
+the first time it is needed and kept for the file [as long as it is not modified] and the fit parameters.
+Running the cells again with other global cuts, another range of events or plots only fits what is new:
+
+    from modules.analysis import reco
+    data,chi_local,badch1,badch2,badch3,badch4 = reco.local_reconstruction_xleft_xright(path,end = 500)
+"""
+
+import os
+import itertools
+import numpy as np
+import pandas as pd
+
+from modules.analysis.geometry import GEOMETRY
+
+### Default parameters of the local reconstructions, as in the notebooks
+MIN_HITS = 3                         # minimum number of hits in a chamber
+MAX_HITS = 99                        # maximum number of hits in a chamber
+MAX_SLOPE = float(np.sqrt(3))        # maximum slope from the vertical
+SIGMA = .4                           # expected uncertainty of the hit positions [mm]
+CHISQ_BEST = 20.                     # maximum chi squared per degree of freedom of a segment
+
+Z_PTS = list(GEOMETRY.z_pts)
+# Offset of each chamber [SL] added to the z of its segments
+Z_OFFSETS = list(GEOMETRY.chamber_z)
+
+# Loaded files by (path, orbit) and local fits by (file, fit parameters)
+_EVENT_FILES = {}
+_LOCAL_FITS = {}
+
+
+def file_key(path):
+    """Identifies a version of a file: its absolute path, modification time and size"""
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+class EventFile(object):
+    """Hits of a text output held as flat arrays, one event per line
+
+    Lines are "EVENT_NR NHITS" [followed by the ORBIT_CNT for orbit=True] and "SL LAYER X_POS_LEFT X_POS_RIGHT Z_POS"
+    of every hit. The hits of line i are at positions offsets[i]:offsets[i+1] of the hit arrays.
+    """
+
+    def __init__(self, path, orbit=False):
+        self.path = path
+        self.key = file_key(path)
+        raw = np.fromfile(path, dtype=np.uint8)
+        newline = raw == ord('\n')
+        space = newline | (raw == ord(' ')) | (raw == ord('\t')) | (raw == ord('\r'))
+        # Tokens start at non-space characters following a space, counted on the line they belong to
+        starts = ~space & np.r_[True, space[:-1]]
+        line = np.cumsum(newline) - newline
+        nlines = int(line[-1]) + 1 if len(raw) else 0
+        ntokens = np.bincount(line[starts], minlength=nlines)
+        values = np.array(raw.tobytes().split(), dtype=np.float64)
+        first = np.r_[0, np.cumsum(ntokens)[:-1]].astype(np.int64)
+        header = 3 if orbit else 2
+        # Lines too short for a header [empty lines] get -1
+        padded = np.where(ntokens >= header, first, len(values))
+        values_padded = np.r_[values, -1., -1., -1.]
+        self.event_nr = values_padded[padded].astype(np.int64)
+        self.orbit = values_padded[padded + 2].astype(np.int64) if orbit else None
+        nhits = np.maximum(ntokens - header, 0) // 5
+        self.offsets = np.r_[0, np.cumsum(nhits)].astype(np.int64)
+        # Token of the first value of every hit
+        hit = np.repeat(first + header - 5 * self.offsets[:-1], nhits) + 5 * np.arange(self.offsets[-1])
+        self.sl = values[hit].astype(np.int64)
+        self.layer = values[hit + 1].astype(np.int64)
+        self.x_left = values[hit + 2]
+        self.x_right = values[hit + 3]
+        self.z = values[hit + 4]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def label(self, line):
+        """Label of the segments of an event in the local reconstructions: its orbit if the file has them, else its line from 1"""
+        return int(self.orbit[line]) if self.orbit is not None else line + 1
+
+    def points(self, line, sl, zpos=False, jitter=0.):
+        """Left and right positions of the hits of a chamber as (x, y) rows, y being their z
+
+        The z is the one of the layer of the hit, or the Z_POS in the file for zpos=True. Left positions are
+        moved by -jitter and right ones by +jitter, to correct for the trigger jitter.
+        """
+        hits = slice(self.offsets[line], self.offsets[line + 1])
+        sel = self.sl[hits] == sl
+        z = self.z[hits][sel] if zpos else GEOMETRY.layer_z[self.layer[hits][sel]]
+        pts = np.empty((2 * len(z), 2))
+        pts[0::2, 0] = self.x_left[hits][sel] - jitter
+        pts[1::2, 0] = self.x_right[hits][sel] + jitter
+        pts[:, 1] = np.repeat(z, 2)
+        return pd.DataFrame(removezeros(pts), columns=('x', 'y'))
+
+
+def load_events(path, orbit=False):
+    """Events of a text output, read again only if the file has changed since the last call"""
+    key = (os.path.abspath(path), orbit)
+    events = _EVENT_FILES.get(key)
+    if events is None or events.key != file_key(path):
+        events = EventFile(path, orbit)
+        _EVENT_FILES[key] = events
+    return events
+
+
+def clear_cache():
+    """Forgets all loaded files and local fits"""
+    _EVENT_FILES.clear()
+    _LOCAL_FITS.clear()
+
+
+#helper function to remove unneeded zero entries from arrays
+def removezeros(arr):
+    zeros = np.all(np.equal(arr, 0), axis=1)
+    arr = arr[~zeros]
+    return arr
+
+
+#checks if the slope between the start and end point is greater than the maximum allowed value
+def allowed_slope(xs, ys, max_slope=MAX_SLOPE):
+    if np.around(ys[-1]-ys[0]) == 0:
+        slope = 100
+    else:
+        slope = abs(float((xs[-1]-xs[0])/(ys[-1]-ys[0])))
+    return slope <= max_slope
+
+
+def common(x, x2):
+    """Index of the first entry of x2 with a point in common with x, 100 if there is none"""
+    x_set = set(x)
+    for i, entry in enumerate(x2):
+        if x_set & set(entry):
+            return i
+    return 100
+
+
+def opposites(x1, x2):
+    """Index of the first entry of x2 mirroring x1 [points summing to a multiple of the cell width], 100 if there is none"""
+    for i, entry in enumerate(x2):
+        opposite = True
+        for j in np.arange(len(entry)):
+            try:
+                if np.round(x1[j]+entry[j]) % 42 != 0:
+                    opposite = False
+            except:
+                #an exception occurs if the entry is empty, in which case x1 cannot be its opposite
+                opposite = False
+        if opposite:
+            return i
+    return 100
+
+
+def find_fit(df, sigma=SIGMA, chisq_best=CHISQ_BEST, max_slope=MAX_SLOPE, min_layers=0):
+    """Looks at all combinations of one point per layer and keeps the best lines of fit
+
+    Each combination with at least min_layers points is fitted with RLM [robust linear model], and fitted
+    again without the points it marks as outliers if the chi squared is too large. Returns the points
+    and fitted x at z_pts of the accepted tracks, their chi squared per degree of freedom, and whether
+    every combination had a slope above the maximum.
+    """
+    import statsmodels.api as sm
+    #group hits by their y-coordinate so that only one hit from each height will be selected
+    list1 = [chamb.to_numpy() for i, chamb in df.groupby('y')]
+    points = np.array(list(itertools.product(*list1)))
+
+    dof = 2 #degrees of freedom in the fit
+    x_fits = []
+    x_best = []
+    y_best = []
+    chisquares = []
+    cleaned = []
+    angle = 1 #keeps track of whether an acceptable angle was found or not
+    for i in np.arange(len(points)):
+        xs = [x[0] for x in points[i]]
+        ys = [x[1] for x in points[i]]
+        if len(xs) < min_layers:
+            continue
+        xs_clean = []
+        ys_clean = []
+        clean = 0 #keeps track of whether the entry was 'cleaned' of outliers or not
+        try:
+            reg = sm.RLM(xs,sm.add_constant(ys)).fit(update_scale = False)
+            chisq = np.sum(((reg.resid)/sigma)** 2)
+            weights = reg.weights #points which RLM detected as outliers are given a weight < 1
+            fit = list(reversed(reg.params))
+            x_fit = list(np.poly1d(fit)(Z_PTS))
+
+            # if the fit is not good, try again while ignoring points RLM has marked as outliers
+            if chisq/dof > chisq_best:
+                for i in np.arange(len(xs)):
+                    if weights[i] == 1:
+                        xs_clean.append(xs[i])
+                        ys_clean.append(ys[i])
+                clean = 1
+                if len(xs_clean) < 3: #skips combinations which have too few hits left after being 'cleaned'
+                    continue
+                try:
+                    reg = sm.RLM(xs_clean,sm.add_constant(ys_clean)).fit(update_scale = False)
+                    fit = list(reversed(reg.params))
+                    chisq = np.sum(((reg.resid)/sigma)** 2)
+                    x_fit = list(np.poly1d(fit)(Z_PTS))
+                except ZeroDivisionError:
+                    #handles a combination with a 'perfect' fit, which causes RLM to divide by zero
+                    chisq = 0
+                    fit = np.polyfit(ys_clean,xs_clean,1)
+                    x_fit = list(np.poly1d(fit)(Z_PTS))
+
+        except ZeroDivisionError:
+            chisq = 0
+            fit = np.polyfit(ys,xs,1)
+            x_fit = list(np.poly1d(fit)(Z_PTS))
+
+        #ignore combinations with slopes that aren't allowed
+        if allowed_slope(x_fit, Z_PTS, max_slope):
+            angle = 0
+            if chisq/dof < chisq_best and common(xs,x_best) == 100 and opposites(xs,x_best) == 100:
+                #a good fit for a muon not already in the list
+                chisquares.append(chisq/dof)
+                x_best.append(xs)
+                y_best.append(ys)
+                x_fits.append(x_fit)
+                cleaned.append(clean)
+            elif chisq/dof < chisq_best:
+                #a fit for a muon already in the list [sharing points or mirrored], preferring un-cleaned fits and then lower chi2
+                i = common(xs,x_best)
+                if i == 100:
+                    i = opposites(xs,x_best)
+                if not (clean < cleaned[i] or (clean == cleaned[i] and chisq/dof < chisquares[i])):
+                    continue
+                # As in the notebooks, the new track replaces all tracks found so far
+                chisquares = [chisq/dof]
+                x_best = [xs]
+                y_best = [ys]
+                x_fits = [x_fit]
+                cleaned = [clean]
+    return x_best,y_best,x_fits,chisquares,angle
+
+
+class LocalFits(object):
+    """Local fits of the chambers of the events of a file with one set of fit parameters, computed on demand"""
+
+    def __init__(self, events, zpos=False, jitter=0., **params):
+        self.events = events
+        self.zpos = zpos
+        self.jitter = jitter
+        self.params = params
+        self.fits = {}
+
+    def points(self, line, sl):
+        return self.events.points(line, sl, self.zpos, self.jitter)
+
+    def fit(self, line, sl, pts=None):
+        """find_fit of a chamber of an event, computed the first time it is asked for"""
+        if (line, sl) not in self.fits:
+            self.fits[(line, sl)] = find_fit(self.points(line, sl) if pts is None else pts, **self.params)
+        return self.fits[(line, sl)]
+
+
+def local_fits(path, orbit=False, zpos=False, jitter=0., sigma=SIGMA, chisq_best=CHISQ_BEST, max_slope=MAX_SLOPE, min_layers=0):
+    """Cached local fits of a file for a set of fit parameters, dropping the fits of older versions of the file"""
+    events = load_events(path, orbit)
+    key = (events.key, orbit, zpos, float(jitter), float(sigma), float(chisq_best), float(max_slope), int(min_layers))
+    if key not in _LOCAL_FITS:
+        for old in [old for old in _LOCAL_FITS if old[0][0] == events.key[0] and old[0] != events.key]:
+            del _LOCAL_FITS[old]
+        _LOCAL_FITS[key] = LocalFits(events, zpos, jitter, sigma=sigma, chisq_best=chisq_best, max_slope=max_slope, min_layers=min_layers)
+    return _LOCAL_FITS[key]
+
+
+def hit_residuals(hits, fits, x_pts=np.concatenate((GEOMETRY.x_edges, GEOMETRY.x_edges_shifted))):
+    """Distance of each hit to its closest wire minus the distance of the fitted point, to estimate the trigger jitter"""
+    hits = np.asarray(hits, dtype=np.float64)
+    fits = np.asarray(fits, dtype=np.float64)[:len(hits)]
+    return np.abs(x_pts[np.newaxis, :] - hits[:, np.newaxis]).min(axis=1) - np.abs(x_pts[np.newaxis, :] - fits[:, np.newaxis]).min(axis=1)
+
+
+#used to draw cell outlines on plots
+def plotlines(xpts, ypts, ax):
+    for x in xpts:
+        ax.plot([x,x],ypts,color = 'black')
+
+
+def plot_local(label, chambers):
+    """Plots the hits, lines of best fit and cell outlines of each chamber with accepted segments"""
+    import matplotlib.pyplot as plt
+    fig1,axes = plt.subplots(nrows = 2,ncols = 2,figsize =(10,4),constrained_layout=True)
+    xodd = GEOMETRY.x_edges
+    xeven = GEOMETRY.x_edges_shifted
+    y = GEOMETRY.layer_bounds
+    for sl, result in enumerate(chambers):
+        if result is None or len(result[0]) == 0:
+            continue
+        x0,z0,fit0,chi0,ang0 = result
+        ax = axes[sl//2, sl%2]
+        for pt1 in np.arange(len(xodd)-1):
+            ax.plot(xodd[pt1+1],Z_PTS[0],'k.')
+            ax.plot(xodd[pt1+1],Z_PTS[2],'k.')
+        for pt2 in np.arange(len(xeven)-1):
+            ax.plot(xeven[pt2],Z_PTS[1],'k.')
+            ax.plot(xeven[pt2],Z_PTS[3],'k.')
+        for j in np.arange(len(y)):
+            plotlines(xeven if j%2 == 0 else xodd,y[j],ax)
+        ax.hlines([0,13,26,39,52],0,GEOMETRY.width)
+        for i in np.arange(len(x0)):
+            ax.plot(fit0[i],Z_PTS,label = 'Chi2: '+str(np.round(chi0[i],2)))
+            ax.scatter(x0[i],z0[i],marker = 'x')
+        ax.set_title('Event '+str(label)+' Chamber '+str(sl+1))
+        ax.set_xlabel('X' if sl%2 == 0 else 'Y')
+        ax.set_ylabel('Z')
+        ax.set_ylim(0, 53)
+        ax.set_yticks([0,13,26,39,52])
+        ax.legend(loc = 'best')
+        #sets a wider window if multiple tracks were reconstructed so the plot shows everything
+        margin = 21 if len(x0) == 1 else 100
+        ax.set_xlim(min(x0[-1])-margin,max(x0[-1])+margin)
+    plt.show()
+    plt.close('all')
+
+
+def local_reconstruction_xleft_xright(path, start=0, end=None, plot=False, orbit=False, zpos=False, jitter=0., max_hits=MAX_HITS,
+                                      max_slope=MAX_SLOPE, sigma=SIGMA, chisq_best=CHISQ_BEST, min_layers=0, residuals=False,
+                                      all_chambers=False):
+    """Local reconstructions of the events on lines start to end of a text output, as done by the notebooks
+
+    Returns the dataframe of the segments [4 rows per combination of one segment of each chamber, each row
+    the event label, the fitted x at z_pts and those z_pts moved to the chamber], the chi squared of all
+    segments and the number of chambers rejected by the chi squared cut in each SL, followed by the
+    residuals of the hits to the fits for residuals=True. Only fits not done by a previous call are computed.
+    Plots are only made for a range of events with an end.
+
+    As in the notebooks, all lines are processed if there is no end, their events being labelled from start + 1,
+    and the events are counted from start [from 0 with orbit labels]. The number of events with segments
+    in all 4 chambers is also printed for all_chambers=True.
+    """
+    fits = local_fits(path, orbit, zpos, jitter, sigma, chisq_best, max_slope, min_layers)
+    events = fits.events
+    first, last = (0, len(events)) if end is None else (start, min(end, len(events)))
+    counted = max(last - first, 0) + (0 if orbit else start)
+    rows = []
+    chis = []
+    diff_hits = []
+    accepted = 0 #count of accepted chambers
+    rej_count = 0 #count of chambers with an unacceptable number of hits
+    badangle = 0 #count of chambers with an unacceptable angle
+    badch = [0, 0, 0, 0] #count of chambers with an unacceptable chi2, per SL
+    accepted_all = 0 #count of events with acceptable fits in all 4 chambers
+    for line in range(first, last):
+        label = events.label(line) if orbit or end is not None else start + line + 1
+        segments = [[], [], [], []]
+        results = [None] * 4
+        for sl in range(4):
+            pts = fits.points(line, sl)
+            if not MIN_HITS <= len(pts)/2 <= max_hits:
+                rej_count += 1
+                continue
+            x0,z0,fit0,chi0,ang0 = results[sl] = fits.fit(line, sl, pts)
+            chis.extend(chi0)
+            if residuals:
+                for x, fit in zip(x0, fit0):
+                    diff_hits.extend(hit_residuals(x, fit))
+            if len(x0) == 0 and ang0 == 1:
+                badangle += 1
+            elif len(x0) == 0:
+                badch[sl] += 1
+            else:
+                accepted += 1
+                segments[sl] = [[label] + list(fit) + [z + Z_OFFSETS[sl] for z in Z_PTS] for fit in fit0]
+        #if all 4 chambers had an acceptable fit, add all combinations of local reconstructions
+        if all(segments):
+            accepted_all += 1
+            for combo in itertools.product(*segments):
+                rows.extend(combo)
+        if plot and end is not None:
+            plot_local(label, results)
+    df = pd.DataFrame(np.array(rows, dtype=float)) if rows else pd.DataFrame()
+    print('Events With Acceptable Local Reconstructions: '+str(accepted)+' out of '+str(counted*4))
+    if all_chambers:
+        print('Events With All 4 chambers accepted: '+str(accepted_all)+' out of '+str(counted))
+    print('Events that had a number of hits outside of the range: '+str(rej_count))
+    print('Reconstructions With Angles above the Maximum: '+str(badangle))
+    print('Chambers with reconstructions above the Chi Squared Threshold: '+str(sum(badch)))
+    result = (df, chis) + tuple(badch)
+    return result + (diff_hits,) if residuals else result
@@ -0,0 +1,108 @@
+"""Hough-transform segment finder for local reconstructions in high-occupancy chambers"""
+
+import numpy as np
+
+from modules.analysis.config import ZCELL, max_slope, chisq_local
+
+### Binning of the (slope, intercept) accumulator
+HOUGH_SLOPE_BINS = 71                # slope bins within [-max_slope, max_slope]
+HOUGH_INTERCEPT_BIN = 2.             # intercept bin width in mm
+HOUGH_TOLERANCE = 3.                 # max distance in mm of a hit from a candidate line to be used in its fit
+HOUGH_CANDIDATES = 5                 # number of best accumulator cells that get a precise fit
+HOUGH_MIN_LAYERS = 3                 # minimum number of layers voting for a candidate
+
+Z_REF = 2*ZCELL                      # slopes are measured w.r.t. the middle of the chamber to decorrelate the intercept
+
+
+def popcount4(masks):
+    """Number of bits set in 4-bit layer masks"""
+    masks = np.asarray(masks)
+    return (masks & 1) + ((masks >> 1) & 1) + ((masks >> 2) & 1) + ((masks >> 3) & 1)
+
+
+def hough_candidates(xs, zs, n_candidates=HOUGH_CANDIDATES, min_layers=HOUGH_MIN_LAYERS):
+    """Votes points into a binned (slope, intercept) accumulator and returns the best cells
+
+    Each accumulator cell keeps a bitmask of the layers voting for it, so that the left/right
+    ambiguity or several hits in the same layer can't inflate the number of votes.
+    Returns a list of (slope, intercept, n_layers) sorted by decreasing number of layers.
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    zs = np.asarray(zs, dtype=np.float64)
+    if len(xs) == 0:
+        return []
+    # Layer index of each point from its z position within the chamber
+    layers = np.clip(np.floor(zs / ZCELL).astype(np.int64), 0, 3)
+    slopes = np.linspace(-max_slope, max_slope, HOUGH_SLOPE_BINS)
+    # Intercept of the line through each point for every slope: shape (n_slopes, n_points)
+    intercepts = xs[np.newaxis, :] - slopes[:, np.newaxis] * (zs[np.newaxis, :] - Z_REF)
+    c_min = intercepts.min() - HOUGH_INTERCEPT_BIN
+    n_cbins = int((intercepts.max() - c_min) / HOUGH_INTERCEPT_BIN) + 2
+    c_idx = ((intercepts - c_min) / HOUGH_INTERCEPT_BIN).astype(np.int64)
+    s_idx = np.broadcast_to(np.arange(len(slopes))[:, np.newaxis], c_idx.shape)
+    bits = np.broadcast_to((1 << layers)[np.newaxis, :], c_idx.shape).astype(np.uint8)
+    acc = np.zeros((len(slopes), n_cbins + 1), dtype=np.uint8)
+    # Voting also into the next intercept bin so that lines close to a bin edge are not split
+    for shift in (0, 1):
+        np.bitwise_or.at(acc, (s_idx.ravel(), c_idx.ravel() + shift), bits.ravel())
+    votes = popcount4(acc).ravel().astype(np.int64)
+    n_candidates = min(n_candidates, votes.size)
+    best = np.argpartition(-votes, n_candidates - 1)[:n_candidates]
+    best = best[np.argsort(-votes[best], kind='stable')]
+    candidates = []
+    for cell in best:
+        if votes[cell] < min_layers:
+            break
+        s, c = np.unravel_index(cell, acc.shape)
+        # Centre of the intercept range covered by the two bins voted into
+        candidates.append((slopes[s], c_min + c * HOUGH_INTERCEPT_BIN, int(votes[cell])))
+    return candidates
+
+
+def closest_per_layer(xs, zs, line_x, tolerance=HOUGH_TOLERANCE):
+    """Selects in each layer the point closest to a line, if within the tolerance"""
+    dist = np.abs(xs - line_x)
+    sel = dist < tolerance
+    order = np.lexsort((dist[sel], zs[sel]))
+    x_sel, z_sel = xs[sel][order], zs[sel][order]
+    first = np.r_[True, z_sel[1:] != z_sel[:-1]] if len(z_sel) else np.zeros(0, dtype=bool)
+    return x_sel[first], z_sel[first]
+
+
+def hough_fit(df, chisq_max=chisq_local, n_candidates=HOUGH_CANDIDATES):
+    """Segment finder with cost linear in the number of hits, alternative to the combinatorial find_fit
+
+    Takes the same dataframe of candidate points [x, y] and returns the same
+    (x_best, y_best, fit_pts, chisq) as find_fit, with empty lists if no segment is found
+    """
+    xs = df['x'].values.astype(np.float64)
+    zs = df['y'].values.astype(np.float64)
+    dof = 2 #degrees of freedom in the fit
+    chisq_best = chisq_max
+    fit_best = None
+    x_best = []
+    y_best = []
+    for slope, intercept, _ in hough_candidates(xs, zs, n_candidates):
+        x_sel, z_sel = closest_per_layer(xs, zs, slope * (zs - Z_REF) + intercept)
+        if len(z_sel) < HOUGH_MIN_LAYERS:
+            continue
+        # Precise fit of the selected points, repeated once with the points closest to the fitted line
+        fit = np.polyfit(z_sel, x_sel, 1)
+        x_sel, z_sel = closest_per_layer(xs, zs, np.poly1d(fit)(zs))
+        if len(z_sel) < HOUGH_MIN_LAYERS:
+            continue
+        fit, chisq, _, _, _ = np.polyfit(z_sel, x_sel, 1, full=True)
+        chisq = float(chisq[0]) / dof if chisq.size else 0.
+        if abs(fit[0]) > max_slope or chisq >= chisq_max:
+            continue
+        # Preferring segments with more layers, then with better chi squared
+        if (len(z_sel), -chisq) <= (len(y_best), -chisq_best):
+            continue
+        chisq_best = chisq
+        fit_best = fit
+        x_best = list(x_sel)
+        y_best = list(z_sel)
+    if fit_best is None:
+        return [], [], [], float(chisq_best)
+    fit_pts = list(np.poly1d(fit_best)(y_best))
+    return x_best, y_best, fit_pts, float(chisq_best)
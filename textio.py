@@ -0,0 +1,175 @@
+"""Bulk formatting and writing of the text output read by the path_reconstruction notebooks
+
+Each line of the output is an event: "EVENT_NR NHITS" followed by
+"SL LAYER X_POS_LEFT X_POS_RIGHT Z_POS" of every hit, formatted exactly as
+'{0:.0f} {1:.0f} {2:.8f} {3:.8f} {4:.1f}'.format(...) would do.
+"""
+
+import threading
+import queue
+import numpy as np
+
+### Columns of each hit in the output and number of decimals they are printed with
+HIT_COLUMNS = ['SL', 'LAYER', 'X_POS_LEFT', 'X_POS_RIGHT', 'Z_POS']
+HIT_DECIMALS = np.array([0, 0, 8, 8, 1], dtype=np.int64)
+
+### Number of events formatted at once by the writer thread
+TEXT_BATCH_EVENTS = 10000
+
+# Scaled values are printed from at most 16 digits, computed exactly with int64 arithmetic
+_DIGITS = 16
+_SCALED_MAX = 2.**52
+_POW10 = 10 ** np.arange(_DIGITS + 1, dtype=np.int64)
+# Characters of each token are laid out right-aligned in a row of: sign, up to 16 digits, point, separator
+_WIDTH = _DIGITS + 3
+# ASCII digits of all numbers from 0000 to 9999, 4 bytes each
+_DIGITS4 = np.array([[ord(c) for c in '{0:04d}'.format(i)] for i in range(10000)], dtype=np.uint8).view(np.uint32).ravel()
+
+
+def _fallback(value, decimals):
+    """Formats a single value the slow way"""
+    return '{0:.{1:d}f}'.format(float(value), int(decimals)).encode('ascii')
+
+
+def _digits(values, width):
+    """ASCII digits of non-negative integers, zero-padded to the multiple of 4 not smaller than `width`"""
+    groups = []
+    for _ in range(max(1, -(-width // 4))):
+        groups.append(_DIGITS4[values % 10000])
+        values = values // 10000
+    return np.stack(groups[::-1], axis=1).view(np.uint8)
+
+
+def format_tokens(values, decimals, separators):
+    """Formats numbers with a fixed number of decimals into one byte string
+
+    Each value is followed by its separator byte. Digits of all values are computed at once
+    with integer arithmetic and a lookup table into a preallocated character matrix. Values
+    that can't be rounded safely this way [non-finite, huge, or too close to a rounding tie]
+    are formatted individually, so the result is always identical to Python string formatting.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    decimals = np.asarray(decimals, dtype=np.int64)
+    negative = np.signbit(values)
+    scaled = np.abs(values) * 10.**decimals
+    with np.errstate(invalid='ignore'):
+        rounded = np.rint(scaled)
+        # Rounding is ambiguous if the scaled value is within float precision of a tie
+        tie = np.abs(scaled - np.floor(scaled) - 0.5) <= 4 * np.spacing(scaled)
+        slow = ~np.isfinite(scaled) | (scaled >= _SCALED_MAX) | tie | (decimals >= _DIGITS)
+    digits = np.where(slow, 0, rounded).astype(np.int64)
+    # Number of digits before the decimal point
+    n_int = np.searchsorted(_POW10[1:], digits // _POW10[np.minimum(decimals, _DIGITS)], side='right') + 1
+    lengths = np.where(slow, -1, negative + n_int + np.where(decimals > 0, decimals + 1, 0))
+    chars = np.empty((len(values), _WIDTH), dtype=np.uint8)
+    chars[:, -1] = separators
+    for dec in np.unique(decimals[~slow]):
+        rows = np.flatnonzero(~slow & (decimals == dec))
+        text = _digits(digits[rows], int(n_int[rows].max()) + dec)
+        n_text = text.shape[1]
+        # Digits before the point end right before it, or before the separator without decimals
+        point = _WIDTH - 2 - dec if dec > 0 else _WIDTH - 1
+        chars[rows, point - n_text + dec:point] = text[:, :n_text - dec]
+        if dec > 0:
+            chars[rows, point] = ord('.')
+            chars[rows, point + 1:_WIDTH - 1] = text[:, n_text - dec:]
+    sign = np.flatnonzero(~slow & negative)
+    chars[sign, _WIDTH - 1 - lengths[sign]] = ord('-')
+    # Keeping the last characters of each row: the token and its separator
+    keep = np.arange(_WIDTH)[np.newaxis, :] >= (_WIDTH - 1 - lengths)[:, np.newaxis]
+    keep[slow] = False
+    buf = chars[keep].tobytes()
+    slow_idx = np.flatnonzero(slow)
+    if len(slow_idx) == 0:
+        return buf
+    # Inserting the individually formatted values at their positions
+    ends = np.cumsum(lengths + 1)
+    pieces = []
+    prev = 0
+    for i in slow_idx:
+        pieces.append(buf[prev:ends[i]])
+        pieces.append(_fallback(values[i], decimals[i]) + bytes([separators[i]]))
+        prev = ends[i]
+    pieces.append(buf[prev:])
+    return b''.join(pieces)
+
+
+def format_events(events, nhits, hits):
+    """Formats lines of events from their numbers, numbers of hits and a (sum(nhits), 5) array of hits"""
+    events = np.asarray(events, dtype=np.int64)
+    nhits = np.asarray(nhits, dtype=np.int64)
+    hits = np.asarray(hits, dtype=np.float64).reshape(-1, len(HIT_COLUMNS))
+    # Tokens of each line: event number, number of hits, 5 values per hit
+    n_tokens = 2 + len(HIT_COLUMNS) * nhits
+    line_ends = np.cumsum(n_tokens)
+    line_starts = line_ends - n_tokens
+    values = np.empty(line_ends[-1] if len(line_ends) else 0, dtype=np.float64)
+    decimals = np.empty(len(values), dtype=np.int64)
+    is_hit = np.ones(len(values), dtype=bool)
+    is_hit[line_starts] = False
+    is_hit[line_starts + 1] = False
+    values[line_starts] = events
+    values[line_starts + 1] = nhits
+    values[is_hit] = hits.ravel()
+    decimals[~is_hit] = 0
+    decimals[is_hit] = np.tile(HIT_DECIMALS, len(hits))
+    separators = np.full(len(values), ord(' '), dtype=np.uint8)
+    separators[line_ends - 1] = ord('\n')
+    return format_tokens(values, decimals, separators)
+
+
+class AsyncTextWriter(object):
+    """Formats and writes batches of events into a text file from a background thread
+
+    The queue is unbounded by default since batches are usually views of arrays already in memory
+    """
+
+    def __init__(self, path, queue_size=0):
+        self.outfile = open(path, 'wb')
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            # Skipping the remaining batches after a failure, it's raised in the main thread
+            if self.error is not None:
+                continue
+            try:
+                self.outfile.write(format_events(*batch))
+            except Exception as e:
+                self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, events, nhits, hits):
+        """Queues events for writing: see format_events for the arguments"""
+        self._check()
+        self.queue.put((events, nhits, hits))
+
+    def write_batches(self, events, nhits, hits, batch=TEXT_BATCH_EVENTS):
+        """Queues events for writing in batches of a fixed number of events"""
+        hit_ends = np.cumsum(nhits)
+        for start in range(0, len(events), batch):
+            end = min(start + batch, len(events))
+            hit_start = hit_ends[start - 1] if start > 0 else 0
+            self.write(events[start:end], nhits[start:end], hits[hit_start:hit_ends[end - 1]])
+
+    def close(self):
+        """Waits for all queued events to be written"""
+        self.queue.put(None)
+        self.thread.join()
+        self.outfile.close()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
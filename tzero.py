@@ -0,0 +1,133 @@
+"""Clustering of the meantimer t0 solutions of all events at once, and calibration of the trigger t0 against them"""
+
+import numpy as np
+
+from modules.analysis.patterns import MEAN_TZERO_DIFF
+from modules.analysis.config import CALIBRATION_MIN_EVENTS, CALIBRATION_CLIP, CALIBRATION_ITERATIONS
+
+# Smallest spread [ns] used to reject outliers, for fits that are exact up to rounding
+MIN_SIGMA = 1e-6
+
+
+class TzeroClusters(object):
+    """Clusters of t0 solutions of many events, from flat arrays of event numbers and t0 values
+
+    Solutions of an event are sorted by time and a new cluster starts after a gap larger than
+    `max_diff` ns. Cluster quantities are computed with one sort and segmented reductions,
+    cluster i of the sorted solutions being solutions starts[i] to starts[i] + size[i].
+    """
+
+    def __init__(self, events, tzeros, max_diff=MEAN_TZERO_DIFF):
+        events = np.asarray(events, dtype=np.int64)
+        tzeros = np.asarray(tzeros, dtype=np.float64)
+        order = np.lexsort((tzeros, events))
+        self.tzeros = tzeros[order]
+        events = events[order]
+        new = np.r_[True, (events[1:] != events[:-1]) | (np.diff(self.tzeros) > max_diff)] if len(events) else np.zeros(0, dtype=bool)
+        self.starts = np.flatnonzero(new)
+        self.size = np.diff(np.r_[self.starts, len(events)])
+        self.event = events[self.starts]
+        if len(self.starts) == 0:
+            self.mean = self.min = self.max = np.zeros(0, dtype=np.float64)
+            return
+        self.min = np.minimum.reduceat(self.tzeros, self.starts)
+        # Summing offsets from the earliest solution to keep the precision of absolute times
+        offsets = self.tzeros - np.repeat(self.min, self.size)
+        self.mean = self.min + np.add.reduceat(offsets, self.starts) / self.size
+        self.max = np.maximum.reduceat(self.tzeros, self.starts)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def values(self, cluster):
+        """t0 solutions of a single cluster"""
+        return self.tzeros[self.starts[cluster]:self.starts[cluster] + self.size[cluster]]
+
+    def best(self, min_size=1):
+        """Index of the best cluster of each event: the earliest one with at least `min_size` solutions
+
+        Events without any such cluster are missing from the result. Returns (event numbers, cluster indices).
+        """
+        # Clusters are sorted by event and time
+        sel = np.flatnonzero(self.size >= min_size)
+        first = np.r_[True, self.event[sel[1:]] != self.event[sel[:-1]]] if len(sel) else np.zeros(0, dtype=bool)
+        return self.event[sel[first]], sel[first]
+
+
+def robust_std(values):
+    """Standard deviation estimated from the median absolute deviation, insensitive to outliers"""
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return np.nan
+    return 1.4826 * np.median(np.abs(values - np.median(values)))
+
+
+def clipped_fit(design, values, clip=CALIBRATION_CLIP, iterations=CALIBRATION_ITERATIONS):
+    """Least-squares coefficients of values = design.coefficients, fitted again without the points further
+    than `clip` robust standard deviations from the fit until none is rejected. Returns the coefficients
+    and whether each point was used in the last fit.
+    """
+    used = np.ones(len(values), dtype=bool)
+    coefficients = np.linalg.lstsq(design, values, rcond=None)[0]
+    for _ in range(iterations):
+        residuals = values - design.dot(coefficients)
+        keep = np.abs(residuals) <= clip * max(robust_std(residuals[used]), MIN_SIGMA)
+        if np.array_equal(keep, used) or keep.sum() < design.shape[1]:
+            break
+        used = keep
+        coefficients = np.linalg.lstsq(design[used], values[used], rcond=None)[0]
+    return coefficients, used
+
+
+class TriggerCalibration(object):
+    """Correction of the trigger t0 of a run from the deviations TIME0 - meantimer t0 of all its events
+
+    The deviations are fitted with a constant offset over all events, and with a linear function
+    offset + slopes.(time differences between the trigger signals) over the events with all trigger
+    signals, which follows the jitter of the trigger signal from event to event. Both are single
+    least-squares fits over all events, repeated without outliers [wrong meantimer solutions].
+    The jitter is the robust spread of the deviations before and after the correction.
+    """
+
+    def __init__(self, deviations, timediffs, complete, min_events=CALIBRATION_MIN_EVENTS, clip=CALIBRATION_CLIP, iterations=CALIBRATION_ITERATIONS):
+        deviations = np.asarray(deviations, dtype=np.float64)
+        timediffs = np.asarray(timediffs, dtype=np.float64).reshape(len(deviations), -1)
+        complete = np.asarray(complete, dtype=bool)
+        self.events = len(deviations)
+        self.events_complete = int(complete.sum())
+        self.jitter_before = robust_std(deviations)
+        self.offset = None
+        self.coefficients = None
+        self.outliers = 0
+        self.jitter_after = np.nan
+        if self.events < min_events:
+            return
+        (self.offset,), used = clipped_fit(np.ones((self.events, 1)), deviations, clip, iterations)
+        self.outliers = int((~used).sum())
+        if self.events_complete >= min_events:
+            self.coefficients, used = clipped_fit(self.design(timediffs[complete]), deviations[complete], clip, iterations)
+        self.jitter_after = robust_std(deviations - self.correction(timediffs, complete))
+
+    @staticmethod
+    def design(timediffs):
+        return np.column_stack([np.ones(len(timediffs)), timediffs])
+
+    def correction(self, timediffs, complete):
+        """Deviation from the meantimer t0 predicted for the TIME0 of each event, to be subtracted from it"""
+        complete = np.asarray(complete, dtype=bool)
+        shift = np.full(len(complete), self.offset, dtype=np.float64)
+        if self.coefficients is not None:
+            shift[complete] = self.design(np.asarray(timediffs, dtype=np.float64).reshape(len(complete), -1)[complete]).dot(self.coefficients)
+        return shift
+
+    def summary(self):
+        """Fitted parameters as a dictionary"""
+        return {
+            'events': self.events,
+            'events_complete': self.events_complete,
+            'outliers': self.outliers,
+            'offset': None if self.offset is None else float(self.offset),
+            'coefficients': None if self.coefficients is None else [float(c) for c in self.coefficients],
+            'jitter_before': float(self.jitter_before),
+            'jitter_after': float(self.jitter_after),
+        }